@@ -28,8 +28,6 @@ except ImportError:
         return func
 import torch
 import logging
-from concurrent.futures import ThreadPoolExecutor
-import atexit
 import uuid
 from models.SpaTrackV2.models.vggt4track.models.vggt_moe import VGGT4Track
 from models.SpaTrackV2.models.vggt4track.utils.load_fn import preprocess_image
@@ -43,6 +41,10 @@ from fpose.recover_scale import recover_scale
 
 from one23pose.scripts.estimate_poses import estimate_poses
 from one23pose.scripts.render_normals import render_normals_to_video
+from one23pose.scripts.frame_source import get_frame_source
+from one23pose.scripts.mask_writer import SegmentationWriter
+from one23pose.scripts.result_store import ResultStore
+from one23pose.scripts.stage_cache import StageCache, hash_file, hash_params, touch
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -66,26 +68,41 @@ COLORS = [(0, 0, 255), (0, 255, 255)]  # BGR: Red for negative, Yellow for posit
 MARKERS = [1, 5]  # Cross for negative, Star for positive
 MARKER_SIZE = 8
 
-# Thread pool for delayed deletion
-thread_pool_executor = ThreadPoolExecutor(max_workers=2)
-
-def delete_later(path: Union[str, os.PathLike], delay: int = 600):
-    """Delete file or directory after specified delay (default 10 minutes)"""
-    def _delete():
-        try:
-            if os.path.isfile(path):
-                os.remove(path)
-            elif os.path.isdir(path):
-                shutil.rmtree(path)
-        except Exception as e:
-            logger.warning(f"Failed to delete {path}: {e}")
-    
-    def _wait_and_delete():
-        time.sleep(delay)
-        _delete()
-    
-    thread_pool_executor.submit(_wait_and_delete)
-    atexit.register(_delete)
+# TRELLIS 导出：'texture' 为原始的 UV 贴图烘焙，'pose' 只输出简化后的顶点着色网格 (更快，但没有材质/UV，
+# 尺度恢复用 pytorch3d 渲染时需要贴图，所以默认仍为 'texture')
+TRELLIS_EXPORT_PRESET = os.environ.get("TRELLIS_EXPORT_PRESET", "texture")
+# 预览视频分辨率与帧数，帧数为 0 时不渲染预览
+PREVIEW_RESOLUTION = int(os.environ.get("PREVIEW_RESOLUTION", 512))
+PREVIEW_FRAMES = int(os.environ.get("PREVIEW_FRAMES", 60))
+
+# Stage outputs are cached by content (video hash, frame stride, stage parameters) and evicted
+# together with stale session dirs, least recently used first, once over the disk budget
+STAGE_CACHE_MAX_BYTES = int(os.environ.get("STAGE_CACHE_MAX_BYTES", 20 * 1024 ** 3))
+stage_cache = StageCache(os.path.join("temp_local", "stage_cache"), max_bytes=STAGE_CACHE_MAX_BYTES,
+                         sessions_root="temp_local")
+
+def result_store_path(temp_dir):
+    """Tracker/depth results of a session: depths, intrinsics, extrinsics, tracks, video and poses"""
+    return os.path.join(temp_dir, "results", "result.bin")
+
+def mask_store_path(temp_dir):
+    """SAM2 label maps of a session"""
+    return os.path.join(temp_dir, "masks", "masks.bin")
+
+def get_stage_keys(temp_dir):
+    """Cache keys of the stages already run in this session"""
+    keys_file = os.path.join(temp_dir, "stage_keys.json")
+    if not os.path.exists(keys_file):
+        return {}
+    with open(keys_file, 'r') as f:
+        return json.load(f)
+
+def set_stage_key(temp_dir, stage, key):
+    keys = get_stage_keys(temp_dir)
+    keys[stage] = key
+    with open(os.path.join(temp_dir, "stage_keys.json"), 'w') as f:
+        json.dump(keys, f)
+    touch(temp_dir)
 
 def create_user_temp_dir():
     """Create a unique temporary directory for each user session"""
@@ -164,24 +181,13 @@ def load_video_with_opencv(video_path):
     return video_tensor
 
 def process_and_save_rgb(video_path, user_temp_dir, fps):
-    # import decord
-    import torchvision.transforms as T
     from torchvision.utils import save_image
-    # Load video using decord
-    # video_reader = decord.VideoReader(video_path)
-    # video_tensor = torch.from_numpy(video_reader.get_batch(range(len(video_reader))).asnumpy()).permute(0, 3, 1, 2)
-    video_tensor = load_video_with_opencv(video_path)
-    # Resize to ensure minimum side is 336
-    h, w = video_tensor.shape[2:]
-    scale = 336 / min(h, w)
-    if scale < 1:
-        new_h, new_w = int(h * scale), int(w * scale)
-        video_tensor = T.Resize((new_h, new_w))(video_tensor)
-    
-    video_tensor = video_tensor[::fps].float()[:MAX_FRAMES_OFFLINE]
-    
-    # Move to GPU
-    video_tensor = video_tensor.cuda()
+    # Decode only the kept frames (every fps-th, up to the cap), resized so the minimum side is at most 336.
+    # The uint8 frames are memory-mapped under the session dir and shared with the tracker
+    frame_source = get_frame_source(video_path, stride=fps, max_frames=MAX_FRAMES_OFFLINE, min_side=336,
+                                    cache_dir=os.path.join(user_temp_dir, 'frames'))
+    # Move the uint8 frames to GPU, converted to float there
+    video_tensor = frame_source.as_tensor(device='cuda')
     print(f"Video tensor shape: {video_tensor.shape}, device: {video_tensor.device}")
 
     # run vggt 
@@ -191,6 +197,9 @@ def process_and_save_rgb(video_path, user_temp_dir, fps):
     T_img = result.shape[0]
     output_dir = os.path.join(user_temp_dir, 'rgb')
     os.makedirs(output_dir, exist_ok=True)
+    # uint8 copy of the saved frames, read by SAM2 without decoding the JPEGs again
+    frames = np.lib.format.open_memmap(os.path.join(output_dir, 'frames.npy'), mode='w+', dtype=np.uint8,
+                                       shape=(T_img, result.shape[2], result.shape[3], 3))
     for i in range(T_img):
         img_tensor = result[i]
         filename = f"{i:06d}.jpg"
@@ -204,6 +213,8 @@ def process_and_save_rgb(video_path, user_temp_dir, fps):
 
         # Save using torchvision's save_image
         save_image(img_tensor, filepath)
+        frames[i] = img_tensor.mul(255).add_(0.5).clamp_(0, 255).permute(1, 2, 0).to(torch.uint8).cpu().numpy()
+    frames.flush()
 
 # @spaces.GPU
 def gpu_run_tracker(tracker_model_arg, tracker_viser_arg, temp_dir, video_name, grid_size, vo_points, fps, mode="offline"):
@@ -228,23 +239,12 @@ def gpu_run_tracker(tracker_model_arg, tracker_viser_arg, temp_dir, video_name,
     out_dir = os.path.join(temp_dir, "results")
     os.makedirs(out_dir, exist_ok=True)
     
-    # Load video using decord
-    # video_reader = decord.VideoReader(video_path)
-    # video_tensor = torch.from_numpy(video_reader.get_batch(range(len(video_reader))).asnumpy()).permute(0, 3, 1, 2)
-    video_tensor = load_video_with_opencv(video_path)
-    # Resize to ensure minimum side is 336
-    h, w = video_tensor.shape[2:]
-    scale = 336 / min(h, w)
-    if scale < 1:
-        new_h, new_w = int(h * scale), int(w * scale)
-        video_tensor = T.Resize((new_h, new_w))(video_tensor)
-    if mode == "offline":
-        video_tensor = video_tensor[::fps].float()[:MAX_FRAMES_OFFLINE]
-    else:
-        video_tensor = video_tensor[::fps].float()[:MAX_FRAMES_ONLINE]
-    
-    # Move to GPU
-    video_tensor = video_tensor.cuda()
+    # Shared decoded frames, the offline cap reuses the frames decoded by process_and_save_rgb
+    max_frames = MAX_FRAMES_OFFLINE if mode == "offline" else MAX_FRAMES_ONLINE
+    frame_source = get_frame_source(video_path, stride=fps, max_frames=max_frames, min_side=336,
+                                    cache_dir=os.path.join(temp_dir, 'frames'))
+    # Move the uint8 frames to GPU, converted to float there
+    video_tensor = frame_source.as_tensor(device='cuda')
     print(f"Video tensor shape: {video_tensor.shape}, device: {video_tensor.device}")
     
     depth_tensor = None
@@ -321,36 +321,22 @@ def gpu_run_tracker(tracker_model_arg, tracker_viser_arg, temp_dir, video_name,
                         tracks=track2d_pred[None][...,:2],
                         visibility=vis_pred[None],filename="test")
                         
-        # Save in tapip3d format
+        # Save in tapip3d format, depths are in meters
         data_npz_load["coords"] = (torch.einsum("tij,tnj->tni", c2w_traj[:,:3,:3].cpu(), track3d_pred[:,:,:3].cpu()) + c2w_traj[:,:3,3][:,None,:].cpu()).numpy()
         data_npz_load["extrinsics"] = torch.inverse(c2w_traj).cpu().numpy()
         data_npz_load["intrinsics"] = intrs.cpu().numpy()
-        data_npz_load["depths"] = point_map[:,2,...].cpu().numpy()
-        data_npz_load["video"] = (video_tensor).cpu().numpy()/255
+        data_npz_load["depths"] = point_map[:,2,...].float().cpu().numpy()
+        data_npz_load["video"] = (video_tensor.float()/255).cpu().numpy()
         data_npz_load["visibs"] = vis_pred.cpu().numpy()
         data_npz_load["confs"] = conf_pred.cpu().numpy()
         data_npz_load["confs_depth"] = conf_depth.cpu().numpy()
 
-        depth_names = []
-        output_path = os.path.join(temp_dir, "depth")
-        os.makedirs(output_path, exist_ok=True)
-        for frame_id, depth_map_save in enumerate(data_npz_load["depths"]):
-            depth_map_mm = (depth_map_save * 1000).astype('uint16')
-            depth_path = f"{output_path}/{frame_id:06d}.png"
-            cv2.imwrite(depth_path, depth_map_mm)
-            depth_names.append(depth_path)
-
-        intrinsic_file_path = os.path.join(temp_dir, 'intrinsics.json')
-        intrinsics_dict = {
-        str(frame_id): data_npz_load["intrinsics"][frame_id].tolist()  # 转为 list 才能被 json 序列化
-        for frame_id in range(len(data_npz_load["intrinsics"]))
-        }
-        with open(intrinsic_file_path, 'w') as f:
-            json.dump(intrinsics_dict, f, indent=2)
-        
-        np.savez(os.path.join(out_dir, f'result.npz'), **data_npz_load)
+        result_path = result_store_path(temp_dir)
+        with ResultStore(result_path, mode='w') as store:
+            for name, array in data_npz_load.items():
+                store.write(name, array)
             
-    return depth_names
+    return result_path
 
 def compress_and_write(filename, header, blob):
     header_bytes = json.dumps(header).encode("utf-8")
@@ -360,14 +346,17 @@ def compress_and_write(filename, header, blob):
         f.write(header_bytes)
         f.write(blob)
 
-def process_point_cloud_data(npz_file, width=256, height=192, fps=4):
+def process_point_cloud_data(result_path, width=256, height=192, fps=4):
     fixed_size = (width, height)
     
-    data = np.load(npz_file)
+    data = ResultStore(result_path)
     extrinsics = data["extrinsics"]
     intrinsics = data["intrinsics"]
     trajs = data["coords"]
-    T, C, H, W = data["video"].shape
+    # pose estimation stores its overlays next to the tracker output
+    video_key = "pose_video" if "pose_video" in data else "video"
+    depths_key = "pose_depths" if "pose_depths" in data else "depths"
+    T, C, H, W = data.shape(video_key)
     
     fx = intrinsics[0, 0, 0]
     fy = intrinsics[0, 1, 1]
@@ -375,11 +364,11 @@ def process_point_cloud_data(npz_file, width=256, height=192, fps=4):
     fov_x = 2 * np.arctan(W / (2 * fx)) * (180 / np.pi)
     original_aspect_ratio = (W / fx) / (H / fy)
     
-    rgb_video = (rearrange(data["video"], "T C H W -> T H W C") * 255).astype(np.uint8)
+    rgb_video = (rearrange(data[video_key], "T C H W -> T H W C") * 255).astype(np.uint8)
     rgb_video = np.stack([cv2.resize(frame, fixed_size, interpolation=cv2.INTER_AREA)
                           for frame in rgb_video])
     
-    depth_video = data["depths"].astype(np.float32)
+    depth_video = data[depths_key].astype(np.float32)
     if "confs_depth" in data.keys():
         confs = (data["confs_depth"].astype(np.float32) > 0.5).astype(np.float32)
         depth_video = depth_video * confs
@@ -562,10 +551,15 @@ def handle_video_upload(video, fps):
         'dtype': str(frame.dtype),
         'temp_dir': user_temp_dir,
         'video_name': video_name,
-        'video_path': video_path
+        'video_path': video_path,
+        'video_hash': hash_file(video_path)
     }
 
-    process_and_save_rgb(video_path, user_temp_dir, fps)
+    rgb_key = hash_params(video=frame_data['video_hash'], fps=fps)
+    if stage_cache.load('rgb', rgb_key, user_temp_dir) is None:
+        process_and_save_rgb(video_path, user_temp_dir, fps)
+        stage_cache.save('rgb', rgb_key, user_temp_dir, ['rgb'])
+    set_stage_key(user_temp_dir, 'rgb', rgb_key)
     
     # Get video-specific settings
     print(f"🎬 Video path: '{video}' -> Video name: '{video_name}'")
@@ -702,9 +696,26 @@ def segment_video(objects, original_image_state, fps=VIDEO_FPS):
     frame_data = json.loads(original_image_state)
     temp_dir = frame_data.get('temp_dir', 'temp_local')
     rgb_dir = os.path.join(temp_dir, "rgb")
+    output_video_rel_path = os.path.join("masks", "output_video_new.mp4")
+    masks_key = hash_params(rgb=get_stage_keys(temp_dir).get('rgb'), fps=fps,
+                            objects={obj_id: {"points": obj_data["points"], "color": obj_data["color"]}
+                                     for obj_id, obj_data in objects.items()})
+    if stage_cache.load('masks', masks_key, temp_dir) is not None:
+        set_stage_key(temp_dir, 'masks', masks_key)
+        return os.path.join(temp_dir, output_video_rel_path)
     frame_names = sorted([p for p in os.listdir(rgb_dir) if p.endswith('.jpg')])
 
-    inference_state = predictor_sam.init_state(video_path=rgb_dir)
+    # 直接使用解码后的帧数组，不再读取 JPEG
+    frames_file = os.path.join(rgb_dir, 'frames.npy')
+    video_frames = np.load(frames_file, mmap_mode='r') if os.path.exists(frames_file) else rgb_dir
+
+    def read_frame(frame_idx):
+        if isinstance(video_frames, np.ndarray):
+            return np.ascontiguousarray(video_frames[frame_idx][..., ::-1])  # RGB -> BGR
+        return cv2.imread(os.path.join(rgb_dir, frame_names[frame_idx]))
+
+    # 按需加载帧，流式传播时随输出一起释放，显存不随视频长度增长
+    inference_state = predictor_sam.init_state(video_path=video_frames, lazy_loading_frames=True)
     predictor_sam.reset_state(inference_state)
 
     # Initial annotation for each object
@@ -726,55 +737,33 @@ def segment_video(objects, original_image_state, fps=VIDEO_FPS):
 
     obj_mask_dir = os.path.join(temp_dir, f"masks")
     os.makedirs(obj_mask_dir, exist_ok=True)
-    video_dir = obj_mask_dir
-    output_video_path = os.path.join(video_dir, "output_video.mp4")
-    extracted_video_paths = {}
+    output_video_path = os.path.join(temp_dir, output_video_rel_path)
 
-    first_frame = cv2.imread(os.path.join(rgb_dir, frame_names[0]))
+    first_frame = read_frame(0)
     height, width = first_frame.shape[:2]
 
-    video_writer = cv2.VideoWriter(output_video_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
-    object_writers = {}
+    # 每帧的多物体标签图 (物体 i 的值为 255 - i) 写入 masks.bin，叠加视频直接通过 ffmpeg 管道编码
+    obj_ids = list(objects.keys())
+    writer = SegmentationWriter(mask_store_path(temp_dir), output_video_path, fps, width, height,
+                                [objects[obj_id]["color"] for obj_id in obj_ids])
+    label_ids = None
 
-    for obj_id in objects.keys():
-        extracted_video_paths[obj_id] = os.path.join(video_dir, f"extracted_video_obj_{obj_id}.mp4")
-        object_writers[obj_id] = cv2.VideoWriter(extracted_video_paths[obj_id], cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
-
-    for out_frame_idx, out_obj_ids, out_mask_logits in predictor_sam.propagate_in_video(inference_state):
-        frame = cv2.imread(os.path.join(rgb_dir, frame_names[out_frame_idx]))
-        overlay_frame = frame.copy()
-
-        for i, out_obj_id in enumerate(out_obj_ids):
-            mask = (out_mask_logits[i] > 0.0).cpu().numpy().squeeze()  # boolean mask
-            color = np.array(objects[out_obj_id]["color"]) * 255
-
-            # === 新增：保存为黑白二值图 ===
-            binary_mask = np.zeros(frame.shape[:2], dtype=np.uint8)  # 黑色背景
-            binary_mask[mask] = 255  # 白色前景（物体）
-
-            # 保存为 PNG 格式，保留透明通道或仅灰度
-            mask_filename = os.path.join(obj_mask_dir, f"{out_frame_idx:06d}.png")
-            cv2.imwrite(mask_filename, binary_mask)
-
-            # For output video with overlay
-            overlay_frame[mask] = overlay_frame[mask] * 0.5 + color * 0.5
-
-            # For individual object videos
-            object_frame = np.zeros_like(frame)
-            object_frame[mask] = frame[mask]
-            object_writers[out_obj_id].write(object_frame)
-
-        video_writer.write(overlay_frame)
-
-    video_writer.release()
-    for writer in object_writers.values():
-        writer.release()
-
-    output_video_path_new = os.path.join(video_dir, "output_video_new.mp4")
-    convert_video_to_mp4(output_video_path, output_video_path_new)
-    os.remove(output_video_path)
-
-    return output_video_path_new
+    try:
+        # masks are written out frame by frame, so outputs outside the memory window can be evicted
+        for out_frame_idx, out_obj_ids, out_mask_logits in predictor_sam.propagate_in_video(inference_state, streaming=True):
+            if label_ids is None:
+                label_ids = torch.tensor([obj_ids.index(obj_id) + 1 for obj_id in out_obj_ids],
+                                         dtype=torch.int32, device=out_mask_logits.device)
+            labels = SegmentationWriter.labels_from_logits(out_mask_logits, label_ids)
+            writer.write(out_frame_idx, read_frame(out_frame_idx), labels)
+    finally:
+        writer.close()
+    print(f"SAM2 image feature cache: {predictor_sam.get_feature_cache_stats(inference_state)}")
+    print(f"SAM2 inference state size: {predictor_sam.get_state_size(inference_state)}")
+
+    stage_cache.save('masks', masks_key, temp_dir, ['masks'])
+    set_stage_key(temp_dir, 'masks', masks_key)
+    return output_video_path
 
 def convert_video_to_mp4(input_path, output_path):
     """Convert video to MP4 format using ffmpeg."""
@@ -848,61 +837,67 @@ def estimate_depth_intrinsic(grid_size, vo_points, fps, original_image_state, pr
         print(f"🎯 Running tracker in {processing_mode} mode...")
         out_dir = os.path.join(temp_dir, "results")
         os.makedirs(out_dir, exist_ok=True)
-        
-        depth_names = gpu_run_tracker(None, None, temp_dir, video_name, grid_size, vo_points, fps, mode=processing_mode)
         depth_dir = os.path.join(temp_dir, 'depth')
-        depth_video_path = os.path.join(depth_dir, 'depth.mp4')   
         depth_video_path_new = os.path.join(depth_dir, 'depth_new.mp4')
-        convert_depth_images_to_video(depth_names, depth_video_path, fps=VIDEO_FPS)
+
+        mask_path = os.path.join(temp_dir, f"{video_name}.png")
+        video_hash = frame_data.get('video_hash') or hash_file(os.path.join(temp_dir, f"{video_name}.mp4"))
+        depth_key = hash_params(video=video_hash, fps=fps, grid_size=grid_size, vo_points=vo_points, mode=processing_mode,
+                                mask=hash_file(mask_path) if os.path.exists(mask_path) else None)
+        if stage_cache.load('depth', depth_key, temp_dir) is not None:
+            set_stage_key(temp_dir, 'depth', depth_key)
+            return depth_video_path_new
+
+        result_path = gpu_run_tracker(None, None, temp_dir, video_name, grid_size, vo_points, fps, mode=processing_mode)
+        os.makedirs(depth_dir, exist_ok=True)
+        depth_video_path = os.path.join(depth_dir, 'depth.mp4')   
+        with ResultStore(result_path) as store:
+            min_val, max_val = depth_range(store.frames('depths'))
+            convert_depths_to_video(store.frames('depths'), depth_video_path, min_val, max_val, fps=VIDEO_FPS)
         convert_video_to_mp4(depth_video_path, depth_video_path_new)
         os.remove(depth_video_path)
 
+        stage_cache.save('depth', depth_key, temp_dir, ['depth', 'results'])
+        set_stage_key(temp_dir, 'depth', depth_key)
         return depth_video_path_new
     
     except Exception as e:
         print(f"❌ Error in estimate_depth_intrinsic: {e}")
         return None
 
-def convert_depth_images_to_video(file_paths, output_video_path, fps=30):
-    """
-    将给定路径列表中的单通道深度图归一化到 0~255 并转为三通道，组成视频保存
-    
-    :param file_paths: 包含所有深度图文件路径的列表
-    :param output_video_path: 输出视频文件的路径
-    :param fps: 输出视频的帧率
+def depth_range(depths):
     """
+    逐帧扫描一遍深度图，返回全局最小最大值
 
-    # 检查文件是否存在
-    if not file_paths:
-        raise ValueError("file_paths 为空，请检查输入路径")
-
-    # 假设所有图像大小相同，读取第一张图像获取尺寸
-    first_image = cv2.imread(file_paths[0], cv2.IMREAD_UNCHANGED)
-    if first_image is None:
-        raise ValueError("Error loading the first image.")
-
-    height, width = first_image.shape
-
-    # 定义视频写入器
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')  # 使用 mp4 编码
-    video_writer = cv2.VideoWriter(output_video_path, fourcc, fps, (width, height), isColor=True)
+    :param depths: 单通道深度图序列 (数组或逐帧读取的迭代器)
+    """
+    min_val, max_val = np.inf, -np.inf
+    for depth_image in depths:
+        min_val = min(min_val, float(np.min(depth_image)))
+        max_val = max(max_val, float(np.max(depth_image)))
+    return min_val, max_val
 
-    # 获取全局最小最大值（可选），或逐帧归一化
-    # 如果你希望每帧独立归一化，就注释掉下面两行并放在循环内
-    all_depths = []
-    for file in file_paths:
-        img = cv2.imread(file, cv2.IMREAD_UNCHANGED)
-        if img is not None:
-            all_depths.append(img)
-    min_val = min(np.min(d) for d in all_depths)
-    max_val = max(np.max(d) for d in all_depths)
+def convert_depths_to_video(depths, output_video_path, min_val, max_val, fps=30):
+    """
+    用全局最小最大值把深度图归一化到 0~255 并转为三通道，组成视频保存，各帧之间亮度可比、不闪烁
 
+    :param depths: 单通道深度图序列 (数组或逐帧读取的迭代器)
+    :param output_video_path: 输出视频文件的路径
+    :param min_val: 全局最小深度，见 depth_range
+    :param max_val: 全局最大深度
+    :param fps: 输出视频的帧率
+    """
     print(f"Global min/max depth values: {min_val}, {max_val}")
+    scale = 255.0 / max(max_val - min_val, 1e-6)
+    video_writer = None
+    for depth_image in depths:
+        if video_writer is None:
+            height, width = depth_image.shape
+            fourcc = cv2.VideoWriter_fourcc(*'mp4v')  # 使用 mp4 编码
+            video_writer = cv2.VideoWriter(output_video_path, fourcc, fps, (width, height), isColor=True)
 
-    # 遍历所有图像文件路径
-    for depth_image in all_depths:  # 可以避免重复加载
-        # 归一化到 0~255
-        depth_normalized = cv2.normalize(depth_image, None, 0, 255, cv2.NORM_MINMAX, dtype=cv2.CV_8U)
+        # 用全局范围归一化到 0~255
+        depth_normalized = ((np.asarray(depth_image, dtype=np.float32) - min_val) * scale).clip(0, 255).astype(np.uint8)
 
         # 转换为三通道图像
         depth_image_3ch = cv2.cvtColor(depth_normalized, cv2.COLOR_GRAY2BGR)
@@ -910,6 +905,8 @@ def convert_depth_images_to_video(file_paths, output_video_path, fps=30):
         # 写入视频帧
         video_writer.write(depth_image_3ch)
 
+    if video_writer is None:
+        raise ValueError("没有深度图，请检查输入")
     # 释放视频写入器
     video_writer.release()
 
@@ -927,12 +924,12 @@ def launch_viz(original_image_state):
         os.makedirs(out_dir, exist_ok=True)
 
         # Process results
-        npz_path = os.path.join(out_dir, "result.npz")
+        result_path = result_store_path(temp_dir)
         track2d_video = os.path.join(out_dir, "test_pred_track.mp4")
         
-        if os.path.exists(npz_path):
+        if os.path.exists(result_path):
             print("📊 Processing 6D visualization...")
-            html_path = process_point_cloud_data(npz_path)
+            html_path = process_point_cloud_data(result_path)
             
             # Create iframe HTML
             iframe_html = f"""
@@ -965,30 +962,44 @@ def generate_model_and_rescale_model(original_image_state, seed, randomize_seed,
     rgb_names = [os.path.join(rgb_dir, f) for f in os.listdir(rgb_dir) if f.endswith(".jpg")]
     rgb_names.sort(key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
 
-    depth_dir = os.path.join(temp_dir, 'depth')
-    depth_names = [os.path.join(depth_dir, f) for f in os.listdir(depth_dir) if f.endswith(".png")]
-    depth_names.sort(key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-
-    mask_dir = os.path.join(temp_dir, 'masks')
-    mask_names = [os.path.join(mask_dir, f) for f in os.listdir(mask_dir) if f.endswith(".png")]
-    mask_names.sort(key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-
-    with open(os.path.join(temp_dir, 'intrinsics.json'), 'r') as f:
-        intrinsics = json.load(f)
-        intrinsic = intrinsics['0']
-
     model_dir = os.path.join(temp_dir, 'model')
     os.makedirs(model_dir, exist_ok=True)
 
-    rgb_image = mask_image(rgb_names[0], mask_names[0])
+    # recover_scale 与 mask_image 读取图片文件，只导出第一帧的深度 (mm, uint16) 与 mask
+    anchor_dir = os.path.join(model_dir, 'anchor_file')
+    os.makedirs(anchor_dir, exist_ok=True)
+    anchor_depth_name = os.path.join(anchor_dir, 'depth.png')
+    anchor_mask_name = os.path.join(anchor_dir, 'mask.png')
+    with ResultStore(result_store_path(temp_dir)) as store:
+        intrinsic = store.frame('intrinsics', 0).tolist()
+        cv2.imwrite(anchor_depth_name, (store.frame('depths', 0) * 1000).astype('uint16'))
+    with ResultStore(mask_store_path(temp_dir)) as store:
+        cv2.imwrite(anchor_mask_name, np.asarray(store.frame('masks', 0)))
+
+    rgb_image = mask_image(rgb_names[0], anchor_mask_name)
     # rgb_image = upscale_image_if_needed(rgb_image)
     rgb_image.save(f'{model_dir}/masked_img.png')
 
     seed = get_seed(randomize_seed=randomize_seed, seed=seed)
+    stage_keys = get_stage_keys(temp_dir)
+    model_key = hash_params(rgb=stage_keys.get('rgb'), masks=stage_keys.get('masks'), depth=stage_keys.get('depth'),
+                            seed=seed, ss_guidance_strength=ss_guidance_strength, ss_sampling_steps=ss_sampling_steps,
+                            slat_guidance_strength=slat_guidance_strength, slat_sampling_steps=slat_sampling_steps,
+                            export_preset=TRELLIS_EXPORT_PRESET, preview=(PREVIEW_RESOLUTION, PREVIEW_FRAMES))
+    meta = stage_cache.load('model', model_key, temp_dir)
+    if meta is not None:
+        set_stage_key(temp_dir, 'model', model_key)
+        video_path = meta['video_path'] and os.path.join(temp_dir, meta['video_path'])
+        return video_path, os.path.join(temp_dir, meta['scaled_model_path'])
+
     video_path, mesh_path = generate_3d(rgb_image, temp_dir, 'obj', seed, ss_guidance_strength=ss_guidance_strength, ss_sampling_steps=ss_sampling_steps, slat_guidance_strength=slat_guidance_strength, slat_sampling_steps=slat_sampling_steps)
 
-    scaled_model_path, scale, anchor_pose = recover_true_scale(mesh_path, depth_names[0], intrinsic, rgb_names[0], mask_names[0], model_dir)
+    scaled_model_path, scale, anchor_pose = recover_true_scale(mesh_path, anchor_depth_name, intrinsic, rgb_names[0], anchor_mask_name, model_dir)
 
+    stage_cache.save('model', model_key, temp_dir, ['model'],
+                     video_path=video_path and os.path.relpath(video_path, temp_dir),
+                     scaled_model_path=os.path.relpath(scaled_model_path, temp_dir))
+    set_stage_key(temp_dir, 'model', model_key)
     return video_path, scaled_model_path
 
 def mask_image(rgb_path, mask_path) -> Image.Image:
@@ -1049,8 +1060,10 @@ def mask_image(rgb_path, mask_path) -> Image.Image:
 def generate_3d(image: Image.Image, temp_dir,
                 export_format: str, seed: int = -1,
                 ss_guidance_strength: float = 7.5, ss_sampling_steps: int = 12, 
-                slat_guidance_strength: float = 15, slat_sampling_steps: int = 25):
-    """Generate 3D model and preview video from input image."""
+                slat_guidance_strength: float = 15, slat_sampling_steps: int = 25,
+                export_preset: str = TRELLIS_EXPORT_PRESET,
+                preview_resolution: int = PREVIEW_RESOLUTION, preview_frames: int = PREVIEW_FRAMES):
+    """Generate 3D model and preview video from input image. No preview is rendered if preview_frames is 0."""
     if seed == -1:
         seed = np.random.randint(0, MAX_SEED)
         
@@ -1084,10 +1097,17 @@ def generate_3d(image: Image.Image, temp_dir,
     
     save_slat(generated_slat, slat_path)
     # Save video
-    video_geo = render_utils.render_video(generated_mesh, resolution=1024, num_frames=120)['color']
-    imageio.mimsave(video_path, video_geo, fps=15)
-    trimesh_mesh = postprocessing_utils.to_trimesh(generated_gs, generated_mesh, verbose=False)
+    begin = time.time()
+    if preview_frames > 0:
+        video_geo = render_utils.render_video(generated_mesh, resolution=preview_resolution, num_frames=preview_frames)['color']
+        imageio.mimsave(video_path, video_geo, fps=15)
+    else:
+        video_path = None
+    timings = {'preview': time.time() - begin}
+    trimesh_mesh = postprocessing_utils.to_trimesh(generated_gs, generated_mesh, verbose=False,
+                                                   preset=export_preset, timings=timings)
     trimesh_mesh.export(mesh_path, file_type='obj')
+    print("TRELLIS export timings: " + ", ".join(f"{name} {t:.2f}s" for name, t in timings.items()))
 
     generated_gs = generated_gs.save_ply(gs_path)
     
@@ -1096,7 +1116,7 @@ def generate_3d(image: Image.Image, temp_dir,
     
     return video_path, mesh_path
 
-def recover_true_scale(normal_model_path: str, anchor_depth_name: list, anchor_intrinsic: list, anchor_image_name: str, anchor_mask_name: str, output_dir: str):
+def recover_true_scale(normal_model_path: str, anchor_depth_name: str, anchor_intrinsic: list, anchor_image_name: str, anchor_mask_name: str, output_dir: str):
 
     intrinsic_path = os.path.join(output_dir, 'anchor_file')
     os.makedirs(intrinsic_path, exist_ok=True)
@@ -1136,6 +1156,14 @@ def estimate_query_poses(original_image_state, scaled_model_path):
     temp_dir = frame_data.get('temp_dir', 'temp_local')
     user_dir = os.path.join(temp_dir, 'pose_debug')
 
+    stage_keys = get_stage_keys(temp_dir)
+    pose_key = hash_params(rgb=stage_keys.get('rgb'), masks=stage_keys.get('masks'), depth=stage_keys.get('depth'),
+                           model=hash_file(scaled_model_path))
+    normal_video_rel_path = os.path.join('pose_result', 'noraml_video_new.mp4')
+    if stage_cache.load('poses', pose_key, temp_dir) is not None:
+        set_stage_key(temp_dir, 'poses', pose_key)
+        return os.path.join(temp_dir, normal_video_rel_path)
+
     pose_dir = os.path.join(temp_dir, 'pose_result')
     os.makedirs(pose_dir, exist_ok=True)
     os.makedirs(user_dir, exist_ok=True)
@@ -1144,25 +1172,12 @@ def estimate_query_poses(original_image_state, scaled_model_path):
     rgb_names = [os.path.join(rgb_dir, f) for f in os.listdir(rgb_dir) if f.endswith(".jpg")]
     rgb_names.sort(key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
 
-    depth_dir = os.path.join(temp_dir, 'depth')
-    depth_names = [os.path.join(depth_dir, f) for f in os.listdir(depth_dir) if f.endswith(".png")]
-    depth_names.sort(key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
+    # depth, intrinsics 与 mask 由 estimate_poses 逐帧从 result.bin / masks.bin 读取
+    result_path = result_store_path(temp_dir)
+    with ResultStore(result_path) as store:
+        intrinsics = store['intrinsics'][:len(rgb_names)].tolist()
 
-    mask_dir = os.path.join(temp_dir, 'masks')
-    mask_names = [os.path.join(mask_dir, f) for f in os.listdir(mask_dir) if f.endswith(".png")]
-    mask_names.sort(key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-
-    with open(os.path.join(temp_dir, 'intrinsics.json'), 'r') as f:
-        intrinsics_dict = json.load(f)
-
-    intrinsics = [intrinsics_dict[str(id)] for id in range(len(rgb_names))]
-
-    out_dir = os.path.join(temp_dir, "results")
-    os.makedirs(out_dir, exist_ok=True)
-
-    # Process results
-    npz_path = os.path.join(out_dir, "result.npz")
-    poses = estimate_poses(npz_path, rgb_names, depth_names, mask_names, intrinsics, scaled_model_path, user_dir, debug=0, est_refine_iter=5)
+    poses = estimate_poses(result_path, rgb_names, mask_store_path(temp_dir), scaled_model_path, user_dir, debug=0, est_refine_iter=5, track=True)
 
     poses_file_path = os.path.join(pose_dir, 'poses.json')
 
@@ -1179,6 +1194,10 @@ def estimate_query_poses(original_image_state, scaled_model_path):
     render_normals_to_video(poses, rgb_names, intrinsics, scaled_model_path, normal_video_path, fps=VIDEO_FPS, device='cuda')
     convert_video_to_mp4(normal_video_path, normal_video_path_new)
     os.remove(normal_video_path)
+
+    # results/result.bin now holds the pose overlays shown by the 6D visualization
+    stage_cache.save('poses', pose_key, temp_dir, ['pose_result', 'results'])
+    set_stage_key(temp_dir, 'poses', pose_key)
     return normal_video_path_new
 
 def clear_all():
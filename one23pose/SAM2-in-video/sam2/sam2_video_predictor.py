@@ -11,7 +11,12 @@ import torch
 from tqdm import tqdm
 
 from sam2.modeling.sam2_base import NO_OBJ_SCORE, SAM2Base
-from sam2.utils.misc import concat_points, fill_holes_in_mask_scores, load_video_frames
+from sam2.utils.misc import (
+    concat_points,
+    fill_holes_in_mask_scores,
+    load_video_frames,
+    MemmapMaskStore,
+)
 
 
 class SAM2VideoPredictor(SAM2Base):
@@ -27,6 +32,12 @@ class SAM2VideoPredictor(SAM2Base):
         clear_non_cond_mem_around_input=False,
         # whether to also clear non-conditioning memory of the surrounding frames (only effective when `clear_non_cond_mem_around_input` is True).
         clear_non_cond_mem_for_multi_obj=False,
+        # number of frames encoded together by the image encoder during propagation; the upcoming
+        # frames are encoded ahead of the memory attention loop (1 disables prefetching)
+        image_feature_batch_size=4,
+        # maximum number of frames whose image features are kept in the LRU feature cache
+        # (raised to at least `image_feature_batch_size` so prefetched frames are not evicted)
+        image_feature_cache_size=4,
         **kwargs,
     ):
         super().__init__(**kwargs)
@@ -34,6 +45,10 @@ class SAM2VideoPredictor(SAM2Base):
         self.non_overlap_masks = non_overlap_masks
         self.clear_non_cond_mem_around_input = clear_non_cond_mem_around_input
         self.clear_non_cond_mem_for_multi_obj = clear_non_cond_mem_for_multi_obj
+        self.image_feature_batch_size = max(1, image_feature_batch_size)
+        self.image_feature_cache_size = max(
+            self.image_feature_batch_size, image_feature_cache_size
+        )
 
     @torch.inference_mode()
     def init_state(
@@ -42,13 +57,20 @@ class SAM2VideoPredictor(SAM2Base):
         offload_video_to_cpu=False,
         offload_state_to_cpu=False,
         async_loading_frames=False,
+        lazy_loading_frames=False,
     ):
-        """Initialize a inference state."""
+        """
+        Initialize a inference state.
+
+        With `lazy_loading_frames=True` frames are loaded on demand, and streaming propagation
+        drops each frame's image together with its evicted outputs.
+        """
         images, video_height, video_width = load_video_frames(
             video_path=video_path,
             image_size=self.image_size,
             offload_video_to_cpu=offload_video_to_cpu,
             async_loading_frames=async_loading_frames,
+            lazy_loading_frames=lazy_loading_frames,
         )
         inference_state = {}
         inference_state["images"] = images
@@ -72,8 +94,9 @@ class SAM2VideoPredictor(SAM2Base):
         # inputs on each frame
         inference_state["point_inputs_per_obj"] = {}
         inference_state["mask_inputs_per_obj"] = {}
-        # visual features on a small number of recently visited frames for quick interactions
-        inference_state["cached_features"] = {}
+        # visual features on a small number of recently visited or prefetched frames (LRU order)
+        inference_state["cached_features"] = OrderedDict()
+        inference_state["feature_cache_stats"] = {"hits": 0, "misses": 0, "prefetched": 0}
         # values that don't change across frames (so we only need to hold one copy of them)
         inference_state["constants"] = {}
         # mapping between client-side object id and model-side object index
@@ -99,6 +122,8 @@ class SAM2VideoPredictor(SAM2Base):
         # metadata for each tracking frame (e.g. which direction it's tracked)
         inference_state["tracking_has_started"] = False
         inference_state["frames_already_tracked"] = {}
+        # low-res masks of the frames evicted in streaming propagation (if spilled to disk)
+        inference_state["spilled_masks"] = None
         # Warm up the visual backbone and cache the image feature on frame 0
         self._get_image_feature(inference_state, frame_idx=0, batch_size=1)
         return inference_state
@@ -588,9 +613,24 @@ class SAM2VideoPredictor(SAM2Base):
         start_frame_idx=None,
         max_frame_num_to_track=None,
         reverse=False,
+        streaming=False,
+        spill_path=None,
     ):
-        """Propagate the input points across frames to track in the entire video."""
+        """
+        Propagate the input points across frames to track in the entire video.
+
+        With `streaming=True`, non-conditioning outputs are evicted from the inference state
+        as soon as they fall outside the window read by memory attention and object pointers.
+        Their low-res masks are written to a memory-mapped file at `spill_path` if given (see
+        `get_spilled_mask`), otherwise dropped. The frame images are only evicted with them if the
+        state was created with `lazy_loading_frames=True`; only then does the state size stay
+        constant over the video, otherwise every frame stays loaded.
+        """
         self.propagate_in_video_preflight(inference_state)
+        if streaming and spill_path is not None:
+            inference_state["spilled_masks"] = MemmapMaskStore(
+                spill_path, inference_state["num_frames"]
+            )
 
         output_dict = inference_state["output_dict"]
         consolidated_frame_inds = inference_state["consolidated_frame_inds"]
@@ -622,7 +662,22 @@ class SAM2VideoPredictor(SAM2Base):
             )
             processing_order = range(start_frame_idx, end_frame_idx + 1)
 
+        # frames that will run the image encoder, in processing order, for prefetching
+        frames_to_encode = [
+            t
+            for t in processing_order
+            if t not in consolidated_frame_inds["cond_frame_outputs"]
+            and t not in consolidated_frame_inds["non_cond_frame_outputs"]
+        ]
+        encode_pos = {t: i for i, t in enumerate(frames_to_encode)}
+
         for frame_idx in tqdm(processing_order, desc="propagate in video"):
+            if frame_idx in encode_pos:
+                i = encode_pos[frame_idx]
+                self._prefetch_image_features(
+                    inference_state,
+                    frames_to_encode[i : i + self.image_feature_batch_size],
+                )
             # We skip those frames already in consolidated outputs (these are frames
             # that received input clicks or mask). Note that we cannot directly run
             # batched forward on them via `_run_single_frame_inference` because the
@@ -666,6 +721,9 @@ class SAM2VideoPredictor(SAM2Base):
             )
             yield frame_idx, obj_ids, video_res_masks
 
+            if streaming:
+                self._evict_non_cond_outputs(inference_state, frame_idx, reverse)
+
     def _add_output_per_object(
         self, inference_state, frame_idx, current_out, storage_key
     ):
@@ -725,20 +783,128 @@ class SAM2VideoPredictor(SAM2Base):
         inference_state["consolidated_frame_inds"]["non_cond_frame_outputs"].clear()
         inference_state["tracking_has_started"] = False
         inference_state["frames_already_tracked"].clear()
+        inference_state["spilled_masks"] = None
+
+    def _streaming_window(self):
+        """
+        Number of past frames whose non-conditioning outputs are still read when tracking
+        the next frame: the memory frames (every r-th frame) and the object pointers.
+        """
+        r = self.memory_temporal_stride_for_eval
+        window = max(self.num_maskmem - 2, 0) * r + 2
+        if self.use_obj_ptrs_in_encoder:
+            window = max(window, self.max_obj_ptrs_in_encoder)
+        return window
+
+    def _evict_non_cond_outputs(self, inference_state, frame_idx, reverse):
+        """Evict (and optionally spill) the non-conditioning output that left the window."""
+        window = self._streaming_window()
+        t = frame_idx + window if reverse else frame_idx - window
+        out = inference_state["output_dict"]["non_cond_frame_outputs"].pop(t, None)
+        if out is None:
+            return
+        spilled_masks = inference_state["spilled_masks"]
+        if spilled_masks is not None:
+            spilled_masks.put(t, out["pred_masks"])
+        for obj_output_dict in inference_state["output_dict_per_obj"].values():
+            obj_output_dict["non_cond_frame_outputs"].pop(t, None)
+        inference_state["consolidated_frame_inds"]["non_cond_frame_outputs"].discard(t)
+        # lazily loaded frames are released too (reloaded if the frame is visited again)
+        if hasattr(inference_state["images"], "drop"):
+            inference_state["images"].drop(t)
+
+    def get_spilled_mask(self, inference_state, frame_idx):
+        """Low-res mask scores (num_objects, 1, H, W) of a frame evicted in streaming mode."""
+        spilled_masks = inference_state["spilled_masks"]
+        if spilled_masks is None:
+            return None
+        return spilled_masks.get(frame_idx)
+
+    def get_state_size(self, inference_state):
+        """
+        Bytes held by the inference state per component (shared storages counted once),
+        plus the number of non-conditioning frames currently kept.
+        """
+        seen = set()
+
+        def _nbytes(obj):
+            if isinstance(obj, torch.Tensor):
+                storage = obj.untyped_storage()
+                if storage.data_ptr() in seen:
+                    return 0
+                seen.add(storage.data_ptr())
+                return storage.nbytes()
+            if isinstance(obj, dict):
+                return sum(_nbytes(v) for v in obj.values())
+            if isinstance(obj, (list, tuple)):
+                return sum(_nbytes(v) for v in obj)
+            return 0
+
+        output_dict = inference_state["output_dict"]
+        sizes = {
+            "images": _nbytes(inference_state["images"])
+            if isinstance(inference_state["images"], torch.Tensor)
+            else _nbytes(inference_state["images"].images),
+            "cached_features": _nbytes(inference_state["cached_features"]),
+            "cond_frame_outputs": _nbytes(output_dict["cond_frame_outputs"]),
+            "non_cond_frame_outputs": _nbytes(output_dict["non_cond_frame_outputs"]),
+            "output_dict_per_obj": _nbytes(inference_state["output_dict_per_obj"]),
+            "num_non_cond_frames": len(output_dict["non_cond_frame_outputs"]),
+            "spilled_masks": inference_state["spilled_masks"].nbytes()
+            if inference_state["spilled_masks"] is not None
+            else 0,
+        }
+        return sizes
+
+    def _encode_frames(self, inference_state, frame_inds):
+        """Run the image encoder on a batch of frames and put their features in the LRU cache."""
+        images = torch.stack(
+            [inference_state["images"][t] for t in frame_inds]
+        ).cuda().float()
+        backbone_out = self.forward_image(images)
+        cached_features = inference_state["cached_features"]
+        for i, t in enumerate(frame_inds):
+            frame_out = {
+                "vision_features": backbone_out["vision_features"][i : i + 1],
+                "vision_pos_enc": [x[i : i + 1] for x in backbone_out["vision_pos_enc"]],
+                "backbone_fpn": [x[i : i + 1] for x in backbone_out["backbone_fpn"]],
+            }
+            cached_features[t] = (images[i : i + 1], frame_out)
+            cached_features.move_to_end(t)
+        while len(cached_features) > self.image_feature_cache_size:
+            cached_features.popitem(last=False)
+
+    def _prefetch_image_features(self, inference_state, frame_inds):
+        """
+        Encode the frames among `frame_inds` that are not cached yet, if the first one is not.
+        The image encoder does not depend on the memory, so upcoming frames can be encoded in one
+        batch ahead of the per-frame memory attention and mask decoding.
+        """
+        cached_features = inference_state["cached_features"]
+        if len(frame_inds) == 0 or frame_inds[0] in cached_features:
+            return
+        frame_inds = [t for t in frame_inds if t not in cached_features]
+        self._encode_frames(inference_state, frame_inds)
+        inference_state["feature_cache_stats"]["prefetched"] += len(frame_inds)
+
+    def get_feature_cache_stats(self, inference_state):
+        """Hit/miss/prefetch counters and current size of the image feature cache."""
+        stats = dict(inference_state["feature_cache_stats"])
+        stats["size"] = len(inference_state["cached_features"])
+        return stats
 
     def _get_image_feature(self, inference_state, frame_idx, batch_size):
         """Compute the image features on a given frame."""
         # Look up in the cache first
-        image, backbone_out = inference_state["cached_features"].get(
-            frame_idx, (None, None)
-        )
-        if backbone_out is None:
+        cached_features = inference_state["cached_features"]
+        if frame_idx in cached_features:
+            cached_features.move_to_end(frame_idx)
+            inference_state["feature_cache_stats"]["hits"] += 1
+        else:
             # Cache miss -- we will run inference on a single image
-            image = inference_state["images"][frame_idx].cuda().float().unsqueeze(0)
-            backbone_out = self.forward_image(image)
-            # Cache the most recent frame's feature (for repeated interactions with
-            # a frame; we can use an LRU cache for more frames in the future).
-            inference_state["cached_features"] = {frame_idx: (image, backbone_out)}
+            inference_state["feature_cache_stats"]["misses"] += 1
+            self._encode_frames(inference_state, [frame_idx])
+        image, backbone_out = cached_features[frame_idx]
 
         # expand the features to have the same dimension as the number of objects
         expanded_image = image.expand(batch_size, -1, -1, -1)
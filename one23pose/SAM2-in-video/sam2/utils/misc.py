@@ -5,11 +5,14 @@
 # LICENSE file in the root directory of this source tree.
 
 import os
+import tempfile
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from threading import Thread
 
 import numpy as np
 import torch
+import torch.nn.functional as F
 from PIL import Image
 from tqdm import tqdm
 
@@ -101,12 +104,74 @@ def _load_img_as_tensor(img_path, image_size):
     return img, video_height, video_width
 
 
+def _frames_to_tensor(frames, image_size):
+    """Resize a uint8 (B, H, W, 3) RGB batch to (B, 3, image_size, image_size) in [0, 1]."""
+    img = torch.from_numpy(np.ascontiguousarray(frames)).permute(0, 3, 1, 2).float()
+    img = F.interpolate(
+        img,
+        size=(image_size, image_size),
+        mode="bicubic",
+        align_corners=False,
+        antialias=True,
+    )
+    return (img / 255.0).clamp_(0, 1)
+
+
+def _read_video_batches(video_path, batch_size):
+    """Decode a video file into uint8 (B, H, W, 3) RGB batches."""
+    import cv2
+
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise RuntimeError(f"cannot open video {video_path}")
+    batch = []
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        batch.append(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        if len(batch) == batch_size:
+            yield np.stack(batch)
+            batch = []
+    cap.release()
+    if len(batch) > 0:
+        yield np.stack(batch)
+
+
+def _read_video_file(video_path):
+    """
+    Decode a whole video file into a read-only uint8 (T, H, W, 3) RGB memmap.
+
+    The frames are written batch by batch to an anonymous temporary file, so only one
+    batch is held in memory while decoding and frames are paged in when accessed.
+    """
+    num_frames = 0
+    frame_shape = None
+    with tempfile.TemporaryFile() as f:
+        for batch in _read_video_batches(video_path, batch_size=64):
+            f.write(batch.tobytes())
+            num_frames += len(batch)
+            frame_shape = batch.shape[1:]
+        if num_frames == 0:
+            raise RuntimeError(f"no frames decoded from {video_path}")
+        f.flush()
+        # the mapping keeps its own handle, the file is removed once it is released
+        return np.memmap(f, dtype=np.uint8, mode="r", shape=(num_frames,) + frame_shape)
+
+
 class AsyncVideoFrameLoader:
     """
     A list of video frames to be load asynchronously without blocking session start.
+    `img_paths` is a list of JPEG paths or a uint8 (T, H, W, 3) RGB array.
+
+    With `preload=False` there is no background thread: frames are only loaded when accessed
+    and can be released with `drop` (they are reloaded if accessed again), so the number of
+    frames held stays bounded in streaming propagation.
     """
 
-    def __init__(self, img_paths, image_size, offload_video_to_cpu, img_mean, img_std):
+    def __init__(
+        self, img_paths, image_size, offload_video_to_cpu, img_mean, img_std, preload=True
+    ):
         self.img_paths = img_paths
         self.image_size = image_size
         self.offload_video_to_cpu = offload_video_to_cpu
@@ -123,6 +188,9 @@ class AsyncVideoFrameLoader:
         # load the first frame to fill video_height and video_width and also
         # to cache it (since it's most likely where the user will click)
         self.__getitem__(0)
+        if not preload:
+            self.thread = None
+            return
 
         # load the rest of frames asynchronously without blocking the session start
         def _load_frames():
@@ -143,9 +211,13 @@ class AsyncVideoFrameLoader:
         if img is not None:
             return img
 
-        img, video_height, video_width = _load_img_as_tensor(
-            self.img_paths[index], self.image_size
-        )
+        if isinstance(self.img_paths, np.ndarray):
+            img = _frames_to_tensor(self.img_paths[index : index + 1], self.image_size)[0]
+            video_height, video_width = self.img_paths.shape[1:3]
+        else:
+            img, video_height, video_width = _load_img_as_tensor(
+                self.img_paths[index], self.image_size
+            )
         self.video_height = video_height
         self.video_width = video_width
         # normalize by mean and std
@@ -159,6 +231,11 @@ class AsyncVideoFrameLoader:
     def __len__(self):
         return len(self.images)
 
+    def drop(self, index):
+        """Release a loaded frame (only with `preload=False`, it would race the loading thread)."""
+        if self.thread is None:
+            self.images[index] = None
+
 
 def load_video_frames(
     video_path,
@@ -167,19 +244,61 @@ def load_video_frames(
     img_mean=(0.485, 0.456, 0.406),
     img_std=(0.229, 0.224, 0.225),
     async_loading_frames=False,
+    num_threads=4,
+    batch_size=16,
+    lazy_loading_frames=False,
 ):
     """
-    Load the video frames from a directory of JPEG files ("<frame_index>.jpg" format).
+    Load the video frames from a directory of JPEG files ("<frame_index>.jpg" format),
+    a uint8 (T, H, W, 3) RGB array (e.g. a memory-mapped array of decoded frames)
+    or a video file.
 
     The frames are resized to image_size x image_size and are loaded to GPU if
     `offload_video_to_cpu` is `False` and to CPU if `offload_video_to_cpu` is `True`.
+    Arrays and video files are resized in batches of `batch_size` frames on a pool of
+    `num_threads` threads (for video files, while the next frames are being decoded).
 
     You can load a frame asynchronously by setting `async_loading_frames` to `True`.
+    With `lazy_loading_frames=True` frames are only loaded when accessed and can be dropped
+    again (see `AsyncVideoFrameLoader`), for streaming propagation. In both modes a video
+    file is first decoded to a temporary memory-mapped file rather than into memory.
     """
+    img_mean = torch.tensor(img_mean, dtype=torch.float32)[:, None, None]
+    img_std = torch.tensor(img_std, dtype=torch.float32)[:, None, None]
+    if isinstance(video_path, np.ndarray) or (
+        isinstance(video_path, str) and os.path.isfile(video_path)
+    ):
+        if async_loading_frames or lazy_loading_frames:
+            frames = (
+                video_path
+                if isinstance(video_path, np.ndarray)
+                else _read_video_file(video_path)
+            )
+            _check_frames_array(frames)
+            lazy_images = AsyncVideoFrameLoader(
+                frames,
+                image_size,
+                offload_video_to_cpu,
+                img_mean,
+                img_std,
+                preload=not lazy_loading_frames,
+            )
+            return lazy_images, lazy_images.video_height, lazy_images.video_width
+        return _load_video_frames_in_batches(
+            video_path,
+            image_size,
+            offload_video_to_cpu,
+            img_mean,
+            img_std,
+            num_threads,
+            batch_size,
+        )
     if isinstance(video_path, str) and os.path.isdir(video_path):
         jpg_folder = video_path
     else:
-        raise NotImplementedError("Only JPEG frames are supported at this moment")
+        raise NotImplementedError(
+            "Only JPEG folders, uint8 frame arrays and video files are supported"
+        )
 
     frame_names = [
         p
@@ -191,12 +310,15 @@ def load_video_frames(
     if num_frames == 0:
         raise RuntimeError(f"no images found in {jpg_folder}")
     img_paths = [os.path.join(jpg_folder, frame_name) for frame_name in frame_names]
-    img_mean = torch.tensor(img_mean, dtype=torch.float32)[:, None, None]
-    img_std = torch.tensor(img_std, dtype=torch.float32)[:, None, None]
 
-    if async_loading_frames:
+    if async_loading_frames or lazy_loading_frames:
         lazy_images = AsyncVideoFrameLoader(
-            img_paths, image_size, offload_video_to_cpu, img_mean, img_std
+            img_paths,
+            image_size,
+            offload_video_to_cpu,
+            img_mean,
+            img_std,
+            preload=not lazy_loading_frames,
         )
         return lazy_images, lazy_images.video_height, lazy_images.video_width
 
@@ -213,6 +335,83 @@ def load_video_frames(
     return images, video_height, video_width
 
 
+def _check_frames_array(frames):
+    if frames.ndim != 4 or frames.shape[-1] != 3 or frames.dtype != np.uint8:
+        raise RuntimeError(
+            f"expected a uint8 (T, H, W, 3) array, got {frames.dtype} {frames.shape}"
+        )
+    if len(frames) == 0:
+        raise RuntimeError("no frames in the video array")
+
+
+def _load_video_frames_in_batches(
+    video, image_size, offload_video_to_cpu, img_mean, img_std, num_threads, batch_size
+):
+    """Load the video frames from a uint8 (T, H, W, 3) RGB array or a video file."""
+    if isinstance(video, np.ndarray):
+        _check_frames_array(video)
+        batches = (video[i : i + batch_size] for i in range(0, len(video), batch_size))
+        desc = "frame loading (array)"
+    else:
+        batches = _read_video_batches(video, batch_size)
+        desc = "frame loading (video)"
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        futures = []
+        video_height = video_width = None
+        for frames in batches:
+            video_height, video_width = frames.shape[1:3]
+            futures.append(executor.submit(_frames_to_tensor, frames, image_size))
+        if len(futures) == 0:
+            raise RuntimeError(f"no frames decoded from {video}")
+        images = torch.cat([f.result() for f in tqdm(futures, desc=desc)])
+    if not offload_video_to_cpu:
+        images = images.cuda()
+        img_mean = img_mean.cuda()
+        img_std = img_std.cuda()
+    # normalize by mean and std
+    images -= img_mean
+    images /= img_std
+    return images, video_height, video_width
+
+
+class MemmapMaskStore:
+    """
+    A memory-mapped store of per-frame low-resolution mask scores, used to spill the
+    outputs evicted from the inference state in streaming propagation.
+    """
+
+    def __init__(self, path, num_frames):
+        self.path = path
+        self.num_frames = num_frames
+        self.masks = None
+        self.frame_inds = set()
+
+    def put(self, frame_idx, pred_masks):
+        masks_np = pred_masks.float().cpu().numpy().astype(np.float16)
+        if self.masks is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self.masks = np.lib.format.open_memmap(
+                self.path,
+                mode="w+",
+                dtype=np.float16,
+                shape=(self.num_frames,) + masks_np.shape,
+            )
+        self.masks[frame_idx] = masks_np
+        self.frame_inds.add(frame_idx)
+
+    def get(self, frame_idx):
+        if frame_idx not in self.frame_inds:
+            return None
+        return torch.from_numpy(np.array(self.masks[frame_idx])).float()
+
+    def __contains__(self, frame_idx):
+        return frame_idx in self.frame_inds
+
+    def nbytes(self):
+        return 0 if self.masks is None else self.masks.nbytes
+
+
 def fill_holes_in_mask_scores(mask, max_area):
     """
     A post processor to fill small holes in mask scores with area under `max_area`.
@@ -10,12 +10,11 @@
 import os, sys, time,torch,pickle,trimesh,itertools,pdb,zipfile,datetime,imageio,gzip,logging,joblib,importlib,uuid,signal,multiprocessing,psutil,subprocess,tarfile,scipy,argparse
 from pytorch3d.transforms import so3_log_map,so3_exp_map,se3_exp_map,se3_log_map,matrix_to_axis_angle,matrix_to_euler_angles,euler_angles_to_matrix, rotation_6d_to_matrix
 from pytorch3d.renderer import FoVPerspectiveCameras, PerspectiveCameras, look_at_view_transform, look_at_rotation, RasterizationSettings, MeshRenderer, MeshRasterizer, BlendParams, SoftSilhouetteShader, HardPhongShader, PointLights, TexturesVertex
-from pytorch3d.renderer.mesh.rasterize_meshes import barycentric_coordinates
+from pytorch3d.renderer.mesh.rasterize_meshes import barycentric_coordinates, rasterize_meshes
 from pytorch3d.renderer.mesh.shader import SoftDepthShader, HardFlatShader
 from pytorch3d.renderer.mesh.textures import Textures
 from pytorch3d.structures import Meshes
 from scipy.interpolate import griddata
-import nvdiffrast.torch as dr
 import torch.nn.functional as F
 import torchvision
 import torch.nn as nn
@@ -55,6 +54,10 @@ try:
   wp.init()
 except:
   wp = None
+try:
+  import nvdiffrast.torch as dr
+except:
+  dr = None
 enable_timer = 0
 
 def NestDict():
@@ -130,6 +133,91 @@ def make_mesh_tensors(mesh, device='cuda', max_tex_size=None):
   return mesh_tensors
 
 
+class NvdiffrastRasterizer:
+  '''Rasterizer backend of nvdiffrast_render. Any object with the same rasterize/interpolate/texture methods can be passed as glctx
+  '''
+  def __init__(self, glctx=None, device='cuda'):
+    self.device = torch.device(device)
+    self.glctx = glctx if glctx is not None else dr.RasterizeCudaContext(device=self.device)
+
+  def rasterize(self, pos_clip, tri, resolution):
+    '''
+    @pos_clip: (N,V,4) clip space positions
+    @return: (N,H,W,4) tensor, (barycentrics, z/w, triangle id+1), triangle id 0 is background. Row 0 is the bottom of the image
+    '''
+    return dr.rasterize(self.glctx, pos_clip, tri, resolution=resolution)[0]
+
+  def interpolate(self, attr, rast, tri):
+    return dr.interpolate(attr, rast, tri)[0]
+
+  def texture(self, tex, uv, filter_mode='linear'):
+    return dr.texture(tex, uv, filter_mode=filter_mode)
+
+
+class TorchRasterizer(NvdiffrastRasterizer):
+  '''Rasterizer backend for any torch device (e.g. cpu) built on pytorch3d, same conventions as NvdiffrastRasterizer
+  '''
+  def __init__(self, device='cpu'):
+    self.device = torch.device(device)
+
+  def rasterize(self, pos_clip, tri, resolution):
+    H,W = int(resolution[0]), int(resolution[1])
+    w = pos_clip[...,3]
+    ndc = pos_clip[...,:2]/w[...,None]
+    # pytorch3d NDC has x pointing left and the shorter image side spanning [-1,1]
+    verts = torch.stack([-ndc[...,0]*max(W/H, 1), ndc[...,1]*max(H/W, 1), w], dim=-1)
+    faces = tri.long()[None].expand(len(verts),-1,-1)
+    pix_to_face, _, bary, _ = rasterize_meshes(Meshes(verts=verts, faces=faces), image_size=(H,W), blur_radius=0, faces_per_pixel=1, perspective_correct=False, cull_backfaces=False)
+    pix_to_face = pix_to_face[...,0]
+    valid = pix_to_face>=0
+    tri_id = torch.where(valid, pix_to_face%len(tri)+1, torch.zeros_like(pix_to_face))
+
+    # Perspective correct barycentrics from the screen space ones
+    vids = tri.long()[(tri_id-1).clamp(min=0)]  #(N,H,W,3)
+    batch_ids = torch.arange(len(w), device=w.device)[:,None,None,None]
+    vert_w = w[batch_ids, vids]
+    bary = bary[...,0,:]
+    z = (bary*pos_clip[...,2][batch_ids, vids]/vert_w).sum(dim=-1)   # z/w is linear in screen space
+    bary = bary/vert_w
+    bary = bary/bary.sum(dim=-1, keepdim=True)
+    rast = torch.stack([bary[...,0], bary[...,1], z, tri_id.float()], dim=-1)
+    rast = torch.where(valid[...,None], rast, torch.zeros_like(rast))
+    return torch.flip(rast, dims=[1])   # pytorch3d row 0 is the top of the image
+
+  def interpolate(self, attr, rast, tri):
+    tri_id = rast[...,3].long()
+    vids = tri.long()[(tri_id-1).clamp(min=0)]  #(N,H,W,3)
+    if attr.dim()==2:
+      vals = attr[vids]
+    else:
+      vals = attr[torch.arange(len(rast), device=attr.device)[:,None,None,None], vids]
+    bary = torch.stack([rast[...,0], rast[...,1], 1-rast[...,0]-rast[...,1]], dim=-1)
+    return (vals*bary[...,None]).sum(dim=-2)*(tri_id>0)[...,None]
+
+  def texture(self, tex, uv, filter_mode='linear'):
+    grid = uv*2-1
+    tex = tex.permute(0,3,1,2).expand(len(uv),-1,-1,-1)
+    out = F.grid_sample(tex, grid, mode='bilinear' if filter_mode=='linear' else 'nearest', align_corners=False)
+    return out.permute(0,2,3,1)
+
+
+def make_rasterizer(device='cuda'):
+  '''nvdiffrast on cuda devices when it is installed, TorchRasterizer otherwise
+  '''
+  device = torch.device(device)
+  if device.type=='cuda' and dr is not None:
+    return NvdiffrastRasterizer(device=device)
+  return TorchRasterizer(device=device)
+
+
+def as_rasterizer(glctx):
+  '''Wrap a raw nvdiffrast context, rasterizer objects are returned as is
+  '''
+  if callable(getattr(glctx, 'rasterize', None)):
+    return glctx
+  return NvdiffrastRasterizer(glctx)
+
+
 def nvdiffrast_render(K=None, H=None, W=None, ob_in_cams=None, glctx=None, context='cuda', get_normal=False, mesh_tensors=None, mesh=None, projection_mat=None, bbox2d=None, output_size=None, use_light=False, light_color=None, light_dir=np.array([0,0,1]), light_pos=np.array([0,0,0]), w_ambient=0.8, w_diffuse=0.5, extra={}):
   '''Just plain rendering, not support any gradient
   @K: (3,3) np array
@@ -139,27 +227,30 @@ def nvdiffrast_render(K=None, H=None, W=None, ob_in_cams=None, glctx=None, conte
   @bbox2d: (N,4) (umin,vmin,umax,vmax) if only roi need to render.
   @light_dir: in cam space
   @light_pos: in cam space
+  @glctx: nvdiffrast context or rasterizer (NvdiffrastRasterizer, TorchRasterizer)
   '''
+  device = ob_in_cams.device
   if glctx is None:
     if context == 'gl':
       glctx = dr.RasterizeGLContext()
-    elif context=='cuda':
-      glctx = dr.RasterizeCudaContext()
+    elif context in ['cuda', 'cpu']:
+      glctx = make_rasterizer(device)
     else:
       raise NotImplementedError
     logging.info("created context")
+  rasterizer = as_rasterizer(glctx)
 
   if mesh_tensors is None:
-    mesh_tensors = make_mesh_tensors(mesh)
+    mesh_tensors = make_mesh_tensors(mesh, device=device)
   pos = mesh_tensors['pos']
   vnormals = mesh_tensors['vnormals']
   pos_idx = mesh_tensors['faces']
   has_tex = 'tex' in mesh_tensors
 
-  ob_in_glcams = torch.tensor(glcam_in_cvcam, device='cuda', dtype=torch.float)[None]@ob_in_cams
+  ob_in_glcams = torch.tensor(glcam_in_cvcam, device=device, dtype=torch.float)[None]@ob_in_cams
   if projection_mat is None:
     projection_mat = projection_matrix_from_intrinsics(K, height=H, width=W, znear=0.001, zfar=100)
-  projection_mat = torch.as_tensor(projection_mat.reshape(-1,4,4), device='cuda', dtype=torch.float)
+  projection_mat = torch.as_tensor(projection_mat.reshape(-1,4,4), device=device, dtype=torch.float)
   mtx = projection_mat@ob_in_glcams
 
   if output_size is None:
@@ -173,26 +264,26 @@ def nvdiffrast_render(K=None, H=None, W=None, ob_in_cams=None, glctx=None, conte
     t = H-bbox2d[:,1]
     r = bbox2d[:,2]
     b = H-bbox2d[:,3]
-    tf = torch.eye(4, dtype=torch.float, device='cuda').reshape(1,4,4).expand(len(ob_in_cams),4,4).contiguous()
+    tf = torch.eye(4, dtype=torch.float, device=device).reshape(1,4,4).expand(len(ob_in_cams),4,4).contiguous()
     tf[:,0,0] = W/(r-l)
     tf[:,1,1] = H/(t-b)
     tf[:,3,0] = (W-r-l)/(r-l)
     tf[:,3,1] = (H-t-b)/(t-b)
     pos_clip = pos_clip@tf
-  rast_out, _ = dr.rasterize(glctx, pos_clip, pos_idx, resolution=np.asarray(output_size))
-  xyz_map, _ = dr.interpolate(pts_cam, rast_out, pos_idx)
+  rast_out = rasterizer.rasterize(pos_clip, pos_idx, resolution=np.asarray(output_size))
+  xyz_map = rasterizer.interpolate(pts_cam, rast_out, pos_idx)
   depth = xyz_map[...,2]
   if has_tex:
-    texc, _ = dr.interpolate(mesh_tensors['uv'], rast_out, mesh_tensors['uv_idx'])
-    color = dr.texture(mesh_tensors['tex'], texc, filter_mode='linear')
+    texc = rasterizer.interpolate(mesh_tensors['uv'], rast_out, mesh_tensors['uv_idx'])
+    color = rasterizer.texture(mesh_tensors['tex'], texc, filter_mode='linear')
   else:
-    color, _ = dr.interpolate(mesh_tensors['vertex_color'], rast_out, pos_idx)
+    color = rasterizer.interpolate(mesh_tensors['vertex_color'], rast_out, pos_idx)
 
   if use_light:
     get_normal = True
   if get_normal:
     vnormals_cam = transform_dirs(vnormals, ob_in_cams)
-    normal_map, _ = dr.interpolate(vnormals_cam, rast_out, pos_idx)
+    normal_map = rasterizer.interpolate(vnormals_cam, rast_out, pos_idx)
     normal_map = F.normalize(normal_map, dim=-1)
     normal_map = torch.flip(normal_map, dims=[1])
   else:
@@ -200,15 +291,15 @@ def nvdiffrast_render(K=None, H=None, W=None, ob_in_cams=None, glctx=None, conte
 
   if use_light:
     if light_dir is not None:
-      light_dir_neg = -torch.as_tensor(light_dir, dtype=torch.float, device='cuda')
+      light_dir_neg = -torch.as_tensor(light_dir, dtype=torch.float, device=device)
     else:
-      light_dir_neg = torch.as_tensor(light_pos, dtype=torch.float, device='cuda').reshape(1,1,3) - pts_cam
+      light_dir_neg = torch.as_tensor(light_pos, dtype=torch.float, device=device).reshape(1,1,3) - pts_cam
     diffuse_intensity = (F.normalize(vnormals_cam, dim=-1) * F.normalize(light_dir_neg, dim=-1)).sum(dim=-1).clip(0, 1)[...,None]
-    diffuse_intensity_map, _ = dr.interpolate(diffuse_intensity, rast_out, pos_idx)  # (N_pose, H, W, 1)
+    diffuse_intensity_map = rasterizer.interpolate(diffuse_intensity, rast_out, pos_idx)  # (N_pose, H, W, 1)
     if light_color is None:
       light_color = color
     else:
-      light_color = torch.as_tensor(light_color, device='cuda', dtype=torch.float)
+      light_color = torch.as_tensor(light_color, device=device, dtype=torch.float)
     color = color*w_ambient + diffuse_intensity_map*light_color*w_diffuse
 
   color = color.clip(0,1)
@@ -219,6 +310,245 @@ def nvdiffrast_render(K=None, H=None, W=None, ob_in_cams=None, glctx=None, conte
   return color, depth, normal_map
 
 
+class RenderedCropCache:
+  '''LRU cache of the rendered crops of one mesh, for make_crop_data_batch.
+  Crops are keyed by the quantised rotation, viewing ray and depth (normalised by the mesh diameter) of the pose plus the
+  crop settings. A hit reuses the cached crop through a 2D warp to the crop window of the new pose and moves its
+  xyz/depth/normal values to the new pose, so the render cost follows the number of distinct views.
+  Poses with a non finite entry or z<=0 have no key and are always rendered.
+  '''
+  def __init__(self, max_bytes=512*1024**2, rot_step=2, ray_step=0.02, depth_step=0.01):
+    '''
+    @max_bytes: memory cap of the cached crops, least recently used ones are evicted first
+    @rot_step: rotation bin in degrees
+    @ray_step: bin of the viewing ray x/z, y/z
+    @depth_step: relative depth bin
+    '''
+    self.max_bytes = max_bytes
+    self.rot_step = np.deg2rad(rot_step)
+    self.ray_step = ray_step
+    self.depth_step = np.log1p(depth_step)
+    self.entries = OrderedDict()
+    self.nbytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+
+  def clear(self):
+    self.entries.clear()
+    self.nbytes = 0
+
+
+  @property
+  def hit_rate(self):
+    total = self.hits+self.misses
+    return self.hits/total if total>0 else 0
+
+
+  def stats(self):
+    return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hit_rate, 'evictions': self.evictions, 'entries': len(self.entries), 'nbytes': self.nbytes}
+
+
+  def make_keys(self, poses, K, mesh_diameter, crop_ratio, out_size, flags=()):
+    '''
+    @poses: (B,4,4) tensor
+    @return: list of B hashable keys, None for poses that can't be keyed (non finite, or not in front of the camera)
+    '''
+    t = poses[:,:3,3]
+    valid = torch.isfinite(poses.reshape(-1,16)).all(dim=1) & (t[:,2]>0)
+    z = torch.where(valid, t[:,2], torch.ones_like(t[:,2])).reshape(-1,1)
+    rot = torch.round(poses[:,:3,:2].reshape(-1,6)/self.rot_step)
+    ray = torch.round(t[:,:2]/z/self.ray_step)
+    depth = torch.round(torch.log(z/mesh_diameter)/self.depth_step)
+    codes = torch.cat([rot, ray, depth], dim=1)
+    valid &= torch.isfinite(codes).all(dim=1)
+    codes = torch.where(valid.reshape(-1,1), codes, torch.zeros_like(codes)).to(torch.int64).data.cpu().numpy()
+    valid = valid.data.cpu().numpy()
+    setting = (tuple(np.round(np.asarray(K, dtype=np.float64).reshape(-1), 3)), float(mesh_diameter), float(crop_ratio), tuple(out_size), tuple(flags))
+    return [(setting, code.tobytes()) if ok else None for code,ok in zip(codes, valid)]
+
+
+  def _put(self, key, entry):
+    nbytes = sum(v.numel()*v.element_size() for v in entry['crops'].values())
+    if nbytes>self.max_bytes:
+      return
+    if key in self.entries:
+      self.nbytes -= self.entries.pop(key)['nbytes']
+    entry['nbytes'] = nbytes
+    self.entries[key] = entry
+    self.nbytes += nbytes
+    while self.nbytes>self.max_bytes:
+      _, old = self.entries.popitem(last=False)
+      self.nbytes -= old['nbytes']
+      self.evictions += 1
+
+
+  def render(self, render_fn, poses, tf_to_crops, K, mesh_diameter, crop_ratio, out_size, flags=()):
+    '''
+    @render_fn: renders the crops of a subset of the poses, (M) index tensor -> dict of (M,C,h,w) tensors.
+                'rgb' is warped bilinearly, the others with nearest; 'xyz_map', 'depth' and 'normal' are moved to the new pose
+    @poses: (B,4,4) tensor
+    @tf_to_crops: (B,3,3) tensor, crop window of each pose
+    @return: dict of (B,C,h,w) tensors
+    '''
+    device = poses.device
+    B = len(poses)
+    keys = self.make_keys(poses, K, mesh_diameter, crop_ratio, out_size, flags)
+    found = {}
+    render_ids = []
+    for i,key in enumerate(keys):
+      if key is None:
+        render_ids.append(i)   # Always rendered, never cached
+        continue
+      if key in found:
+        continue
+      entry = self.entries.get(key)
+      if entry is not None:
+        self.entries.move_to_end(key)
+        found[key] = entry
+      else:
+        found[key] = None
+        render_ids.append(i)
+
+    out = {}
+    if len(render_ids)>0:
+      render_ids_t = torch.as_tensor(render_ids, device=device, dtype=torch.long)
+      rendered = render_fn(render_ids_t)
+      for name,crops in rendered.items():
+        out[name] = torch.empty((B,)+crops.shape[1:], dtype=crops.dtype, device=device)
+        out[name][render_ids_t] = crops
+      for j,i in enumerate(render_ids):
+        if keys[i] is None:
+          continue
+        found[keys[i]] = {'crops': {name: crops[j].clone() for name,crops in rendered.items()}, 'pose': poses[i].clone(), 'tf_to_crop': tf_to_crops[i].clone()}
+        self._put(keys[i], found[keys[i]])
+    self.misses += len(render_ids)
+
+    rendered_set = set(render_ids)
+    hit_ids = [i for i in range(B) if i not in rendered_set]
+    self.hits += len(hit_ids)
+    if len(hit_ids)==0:
+      return out
+
+    entries = [found[keys[i]] for i in hit_ids]
+    hit_ids_t = torch.as_tensor(hit_ids, device=device, dtype=torch.long)
+    new_poses = poses[hit_ids_t]
+    cached_poses = torch.stack([entry['pose'] for entry in entries])
+    cached_tfs = torch.stack([entry['tf_to_crop'] for entry in entries])
+
+    # Image plane motion of the object center: translation of its projection and scaling by the depth ratio
+    K_t = torch.as_tensor(K, device=device, dtype=torch.float).reshape(3,3)
+    def project_center(ob_in_cams):
+      uv = ob_in_cams[:,:3,3]@K_t.T
+      return uv[:,:2]/uv[:,2:3], ob_in_cams[:,2,3]
+    uv_new, z_new = project_center(new_poses)
+    uv_cached, z_cached = project_center(cached_poses)
+    scale = z_cached/z_new
+    S = torch.eye(3, device=device, dtype=torch.float)[None].repeat(len(hit_ids),1,1)
+    S[:,0,0] = scale
+    S[:,1,1] = scale
+    S[:,:2,2] = uv_new-scale[:,None]*uv_cached
+    warps = tf_to_crops[hit_ids_t]@S@cached_tfs.inverse()
+    R_delta = new_poses[:,:3,:3]@cached_poses[:,:3,:3].permute(0,2,1)
+
+    for name in entries[0]['crops'].keys():
+      crops = torch.stack([entry['crops'][name] for entry in entries])
+      if name=='xyz_map':
+        valid = crops[:,2:3]>=0.001
+        crops = torch.einsum('bij,bjhw->bihw', R_delta, crops-cached_poses[:,:3,3,None,None])+new_poses[:,:3,3,None,None]
+        crops = torch.where(valid, crops, torch.zeros_like(crops))
+      elif name=='depth':
+        valid = crops>=0.001
+        crops = torch.where(valid, crops-z_cached[:,None,None,None]+z_new[:,None,None,None], torch.zeros_like(crops))
+      elif name=='normal':
+        crops = torch.einsum('bij,bjhw->bihw', R_delta, crops)
+      mode = 'bilinear' if name=='rgb' else 'nearest'
+      crops = kornia.geometry.transform.warp_perspective(crops, warps, dsize=crops.shape[-2:], mode=mode, align_corners=False)
+      if name not in out:
+        out[name] = torch.empty((B,)+crops.shape[1:], dtype=crops.dtype, device=device)
+      out[name][hit_ids_t] = crops
+    return out
+
+
+class StagedArrays:
+  '''Device tensors of a PinnedStager.stage call whose copies may still be running on the side stream
+  '''
+  def __init__(self, tensors, event=None, device=None):
+    self.tensors = tensors
+    self.event = event
+    self.device = device
+
+
+  def get(self):
+    '''Make the current stream wait for the copies, to be called on the stream that uses the tensors
+    @return: dict of device tensors
+    '''
+    if self.event is not None:
+      stream = torch.cuda.current_stream(self.device)
+      stream.wait_event(self.event)
+      for tensor in self.tensors.values():
+        tensor.record_stream(stream)   # Allocated on the side stream, keep the memory until the current stream is done with it
+      self.event = None
+    return self.tensors
+
+
+class PinnedStager:
+  '''Host to device copies of per-frame inputs through a pool of reusable pinned buffers on a side stream, so the copy of
+  the next frame overlaps the compute of the current one. float64 arrays are staged as float32, tensors are moved as is.
+  On non-cuda devices the arrays are only converted.
+  '''
+  def __init__(self, device='cuda', n_buffers=2):
+    '''
+    @n_buffers: pinned buffers per (name, shape, dtype), a buffer is only rewritten once its previous copy is done
+    '''
+    self.device = torch.device(device)
+    self.n_buffers = n_buffers
+    self.buffers = {}
+    self.next_buffer = defaultdict(int)
+    self.stream = torch.cuda.Stream(device=self.device) if self.device.type=='cuda' else None
+
+
+  def stage(self, **arrays):
+    '''Start copying the arrays to the device
+    @return: StagedArrays, call get() before using them
+    '''
+    tensors = {}
+    if self.stream is None:
+      for name,array in arrays.items():
+        if isinstance(array, np.ndarray) and array.dtype==np.float64:
+          array = array.astype(np.float32)
+        tensors[name] = torch.as_tensor(array, device=self.device)
+      return StagedArrays(tensors)
+
+    used = []
+    event = torch.cuda.Event()
+    with torch.cuda.stream(self.stream):
+      for name,array in arrays.items():
+        if torch.is_tensor(array):
+          tensors[name] = array.to(self.device, non_blocking=True)
+          continue
+        array = np.asarray(array)
+        if array.dtype==np.float64:
+          array = array.astype(np.float32)
+        key = (name, array.shape, array.dtype.str)
+        pool = self.buffers.setdefault(key, [])
+        i = self.next_buffer[key]
+        self.next_buffer[key] = (i+1)%self.n_buffers
+        if i==len(pool):
+          pool.append([torch.empty(array.shape, dtype=torch.from_numpy(array).dtype, pin_memory=True), None])
+        buffer, last_event = pool[i]
+        if last_event is not None:
+          last_event.synchronize()
+        buffer.numpy()[...] = array
+        tensors[name] = buffer.to(self.device, non_blocking=True)
+        used.append(pool[i])
+    event.record(self.stream)
+    for slot in used:
+      slot[1] = event
+    return StagedArrays(tensors, event, self.device)
+
+
 def set_seed(random_seed):
   import torch,random
   np.random.seed(random_seed)
@@ -342,7 +672,7 @@ if wp is not None:
     if sum_weight>0 and num_valid>0:
       out[h,w] = sum/sum_weight
 
-  def bilateral_filter_depth(depth, radius=2, zfar=100, sigmaD=2, sigmaR=100000, device='cuda'):
+  def bilateral_filter_depth_warp(depth, radius=2, zfar=100, sigmaD=2, sigmaR=100000, device='cuda'):
     if isinstance(depth, np.ndarray):
       depth_wp = wp.array(depth, dtype=float, device=device)
     else:
@@ -384,7 +714,7 @@ if wp is not None:
       out[h,w] = d_ori
 
 
-  def erode_depth(depth, radius=2, depth_diff_thres=0.001, ratio_thres=0.8, zfar=100, device='cuda'):
+  def erode_depth_warp(depth, radius=2, depth_diff_thres=0.001, ratio_thres=0.8, zfar=100, device='cuda'):
     depth_wp = wp.from_torch(torch.as_tensor(depth, dtype=torch.float, device=device))
     out_wp = wp.zeros(depth.shape, dtype=float, device=device)
     wp.launch(kernel=erode_depth_kernel, device=device, dim=[depth.shape[0], depth.shape[1]], inputs=[depth_wp, out_wp, radius, depth_diff_thres, ratio_thres, zfar],)
@@ -396,6 +726,69 @@ if wp is not None:
 
 
 
+def _depth_neighbors(depth, radius):
+  '''
+  @depth: (H,W) tensor
+  @return: ((2r+1)^2,H,W) neighbors of every pixel, nan outside the image; (2r+1)^2 squared pixel offsets
+  '''
+  H,W = depth.shape
+  k = 2*radius+1
+  padded = F.pad(depth[None,None], (radius,radius,radius,radius), value=float('nan'))
+  neighbors = F.unfold(padded, kernel_size=k).reshape(k*k,H,W)
+  offsets = torch.arange(-radius, radius+1, device=depth.device, dtype=depth.dtype)
+  dist_sq = (offsets[:,None]**2+offsets[None,:]**2).reshape(k*k,1,1)
+  return neighbors, dist_sq
+
+
+def erode_depth_torch(depth, radius=2, depth_diff_thres=0.001, ratio_thres=0.8, zfar=100, device='cuda'):
+  '''Same as the warp erode_depth kernel, vectorised over the (2r+1)^2 window on any torch device
+  '''
+  depth_t = torch.as_tensor(depth, dtype=torch.float, device=device)
+  neighbors, _ = _depth_neighbors(depth_t, radius)
+  inside = ~torch.isnan(neighbors)
+  bad = inside & ((neighbors<0.001) | (neighbors>=zfar) | (torch.abs(neighbors-depth_t[None])>depth_diff_thres))
+  ratio = bad.sum(dim=0).float()/inside.sum(dim=0).float()
+  depth_out = torch.where(ratio>ratio_thres, torch.zeros_like(depth_t), depth_t)
+  if isinstance(depth, np.ndarray):
+    depth_out = depth_out.data.cpu().numpy()
+  return depth_out
+
+
+def bilateral_filter_depth_torch(depth, radius=2, zfar=100, sigmaD=2, sigmaR=100000, device='cuda'):
+  '''Same as the warp bilateral_filter_depth kernel, vectorised over the (2r+1)^2 window on any torch device
+  '''
+  depth_t = torch.as_tensor(depth, dtype=torch.float, device=device)
+  neighbors, dist_sq = _depth_neighbors(depth_t, radius)
+  valid = ~torch.isnan(neighbors) & (neighbors>=0.001) & (neighbors<zfar)
+  neighbors = torch.where(valid, neighbors, torch.zeros_like(neighbors))
+  num_valid = valid.sum(dim=0)
+  mean_depth = neighbors.sum(dim=0)/num_valid.clamp(min=1)
+  valid = valid & (torch.abs(neighbors-mean_depth[None])<0.01)
+  weight = torch.exp(-dist_sq/(2.0*sigmaD*sigmaD) - (depth_t[None]-neighbors)**2/(2.0*sigmaR*sigmaR))*valid
+  sum_weight = weight.sum(dim=0)
+  depth_out = torch.where((sum_weight>0) & (num_valid>0), (weight*neighbors).sum(dim=0)/sum_weight.clamp(min=1e-12), torch.zeros_like(depth_t))
+  if isinstance(depth, np.ndarray):
+    depth_out = depth_out.data.cpu().numpy()
+  return depth_out
+
+
+def erode_depth(depth, radius=2, depth_diff_thres=0.001, ratio_thres=0.8, zfar=100, device='cuda'):
+  '''warp kernel on cuda devices, vectorised torch fallback otherwise
+  '''
+  if wp is not None and torch.device(device).type=='cuda':
+    return erode_depth_warp(depth, radius=radius, depth_diff_thres=depth_diff_thres, ratio_thres=ratio_thres, zfar=zfar, device=str(device))
+  return erode_depth_torch(depth, radius=radius, depth_diff_thres=depth_diff_thres, ratio_thres=ratio_thres, zfar=zfar, device=device)
+
+
+def bilateral_filter_depth(depth, radius=2, zfar=100, sigmaD=2, sigmaR=100000, device='cuda'):
+  '''warp kernel on cuda devices, vectorised torch fallback otherwise
+  '''
+  if wp is not None and torch.device(device).type=='cuda':
+    return bilateral_filter_depth_warp(depth, radius=radius, zfar=zfar, sigmaD=sigmaD, sigmaR=sigmaR, device=str(device))
+  return bilateral_filter_depth_torch(depth, radius=radius, zfar=zfar, sigmaD=sigmaD, sigmaR=sigmaR, device=device)
+
+
+
 def depth2xyzmap(depth, K, uvs=None):
   invalid_mask = (depth<0.001)
   H,W = depth.shape[:2]
@@ -425,9 +818,9 @@ def depth2xyzmap_batch(depths, Ks, zfar):
   bs = depths.shape[0]
   invalid_mask = (depths<0.001) | (depths>zfar)
   H,W = depths.shape[-2:]
-  vs,us = torch.meshgrid(torch.arange(0,H),torch.arange(0,W), indexing='ij')
-  vs = vs.reshape(-1).float().cuda()[None].expand(bs,-1)
-  us = us.reshape(-1).float().cuda()[None].expand(bs,-1)
+  vs,us = torch.meshgrid(torch.arange(0,H,device=depths.device),torch.arange(0,W,device=depths.device), indexing='ij')
+  vs = vs.reshape(-1).float()[None].expand(bs,-1)
+  us = us.reshape(-1).float()[None].expand(bs,-1)
   zs = depths.reshape(bs,-1)
   Ks = Ks[:,None].expand(bs,zs.shape[-1],3,3)
   xs = (us-Ks[...,0,2])*zs/Ks[...,0,0]  #(B,N)
@@ -556,8 +949,32 @@ def random_direction():
 
 
 
-def compute_mesh_diameter(model_pts=None, mesh=None, n_sample=1000):
-  from sklearn.decomposition import TruncatedSVD
+def max_pairwise_distance(pts, block_size=2048):
+  '''Exact largest distance between two points, searched in blocks of block_size rows so memory stays at block_size*N floats
+  '''
+  pts = np.asarray(pts, dtype=np.float64)
+  if len(pts)<2:
+    return 0.0
+  sq_norms = (pts**2).sum(axis=1)
+  best = -1.0
+  best_pair = (0, 0)
+  for start in range(0, len(pts), block_size):
+    end = min(start+block_size, len(pts))
+    # Only pairs (i,j) with j>=start, the rest were covered by earlier blocks
+    dists = sq_norms[start:end,None] + sq_norms[None,start:] - 2*pts[start:end]@pts[start:].T
+    i, j = np.unravel_index(np.argmax(dists), dists.shape)
+    if dists[i,j]>best:
+      best = dists[i,j]
+      best_pair = (start+i, start+j)
+  # Recompute the winning pair directly, the expansion above loses precision to cancellation
+  return float(np.linalg.norm(pts[best_pair[0]]-pts[best_pair[1]]))
+
+
+def compute_mesh_diameter(model_pts=None, mesh=None, n_sample=1000, block_size=2048):
+  '''
+  @n_sample: random subset of model_pts to search, None for the exact diameter.
+             The exact diameter is the largest distance between convex hull vertices.
+  '''
   if mesh is not None:
     u, s, vh = scipy.linalg.svd(mesh.vertices, full_matrices=False)
     pts = u@s
@@ -565,13 +982,23 @@ def compute_mesh_diameter(model_pts=None, mesh=None, n_sample=1000):
     return float(diameter)
 
   if n_sample is None:
-    pts = model_pts
+    pts = np.unique(np.asarray(model_pts, dtype=np.float64), axis=0)
+    if len(pts)>=4:
+      try:
+        pts = pts[scipy.spatial.ConvexHull(pts).vertices]
+      except scipy.spatial.QhullError:
+        # Flat point set, its hull lies in the plane of the two principal axes
+        centered = pts-pts.mean(axis=0)
+        axes = np.linalg.svd(centered, full_matrices=False)[2]
+        try:
+          pts = pts[scipy.spatial.ConvexHull(centered@axes[:2].T).vertices]
+        except scipy.spatial.QhullError:
+          proj = centered@axes[0]
+          pts = pts[[proj.argmin(), proj.argmax()]]
   else:
     ids = np.random.choice(len(model_pts), size=min(n_sample, len(model_pts)), replace=False)
     pts = model_pts[ids]
-  dists = np.linalg.norm(pts[None]-pts[:,None], axis=-1)
-  diameter = dists.max()
-  return diameter
+  return max_pairwise_distance(pts, block_size=block_size)
 
 
 def compute_crop_window_tf_batch(pts=None, H=None, W=None, poses=None, K=None, crop_ratio=1.2, out_size=None, rgb=None, uvs=None, method='min_box', mesh_diameter=None):
@@ -588,26 +1015,26 @@ def compute_crop_window_tf_batch(pts=None, H=None, W=None, poses=None, K=None, c
     top = top.round()
     bottom = bottom.round()
 
-    tf = torch.eye(3)[None].expand(B,-1,-1).contiguous()
+    tf = torch.eye(3, device=device)[None].expand(B,-1,-1).contiguous()
     tf[:,0,2] = -left
     tf[:,1,2] = -top
-    new_tf = torch.eye(3)[None].expand(B,-1,-1).contiguous()
+    new_tf = torch.eye(3, device=device)[None].expand(B,-1,-1).contiguous()
     new_tf[:,0,0] = out_size[0]/(right-left)
     new_tf[:,1,1] = out_size[1]/(bottom-top)
     tf = new_tf@tf
     return tf
 
   B = len(poses)
-  torch.set_default_tensor_type('torch.cuda.FloatTensor')
+  device = poses.device
   if method=='box_3d':
     radius = mesh_diameter*crop_ratio/2
     offsets = torch.tensor([0,0,0,
                         radius,0,0,
                         -radius,0,0,
                         0,radius,0,
-                        0,-radius,0]).reshape(-1,3)
+                        0,-radius,0], device=device, dtype=torch.float).reshape(-1,3)
     pts = poses[:,:3,3].reshape(-1,1,3)+offsets.reshape(1,-1,3)
-    K = torch.as_tensor(K)
+    K = torch.as_tensor(K, device=device, dtype=torch.float)
     projected = (K@pts.reshape(-1,3).T).T
     uvs = projected[:,:2]/projected[:,2:3]
     uvs = uvs.reshape(B, -1, 2)
@@ -627,6 +1054,55 @@ def compute_crop_window_tf_batch(pts=None, H=None, W=None, poses=None, K=None, c
 
 
 
+def compute_crop_window_tf_multi(pts=None, H=None, W=None, poses=None, frame_ids=None, Ks=None, crop_ratio=1.2, out_size=None, method='box_3d', mesh_diameter=None):
+  '''compute_crop_window_tf_batch for hypotheses coming from several frames
+  @poses: (B,4,4) tensor
+  @frame_ids: (B) np array, index of the frame of each hypothesis
+  @Ks: (N_frame,3,3) np array
+  '''
+  tfs = torch.zeros((len(poses),3,3), dtype=torch.float, device=poses.device)
+  for f in np.unique(frame_ids):
+    ids = torch.as_tensor(np.where(frame_ids==f)[0], device=poses.device)
+    tfs[ids] = compute_crop_window_tf_batch(pts=pts, H=H, W=W, poses=poses[ids], K=Ks[f], crop_ratio=crop_ratio, out_size=out_size, method=method, mesh_diameter=mesh_diameter)
+  return tfs
+
+
+def warp_frames_to_crops(images, frame_ids, tfs, dsize, mode='bilinear'):
+  '''Crop the frame of every hypothesis, warping an expanded view of each frame instead of gathering a full resolution copy per hypothesis
+  @images: (N_frame,C,H,W) tensor
+  @frame_ids: (B) np array, index of the frame of each hypothesis
+  @tfs: (B,3,3) tensor
+  @return: (B,C,dsize[0],dsize[1]) tensor
+  '''
+  out = torch.empty((len(tfs), images.shape[1], dsize[0], dsize[1]), dtype=images.dtype, device=images.device)
+  for f in np.unique(frame_ids):
+    ids = torch.as_tensor(np.where(frame_ids==f)[0], device=images.device)
+    out[ids] = kornia.geometry.transform.warp_perspective(images[f:f+1].expand(len(ids),-1,-1,-1), tfs[ids], dsize=dsize, mode=mode, align_corners=False)
+  return out
+
+
+def split_frames_by_budget(n_hypos, bytes_per_hypo, mem_budget):
+  '''Greedily group consecutive frames so that the hypotheses of each group fit in mem_budget
+  @n_hypos: list of num of hypotheses per frame
+  @return: list of lists of frame indices, a frame is never split
+  '''
+  groups = []
+  cur = []
+  cur_bytes = 0
+  for i,n in enumerate(n_hypos):
+    need = n*bytes_per_hypo
+    if len(cur)>0 and cur_bytes+need>mem_budget:
+      groups.append(cur)
+      cur = []
+      cur_bytes = 0
+    cur.append(i)
+    cur_bytes += need
+  if len(cur)>0:
+    groups.append(cur)
+  return groups
+
+
+
 def cv_draw_text(img,text,uv_top_left,color=(255, 255, 255),fontScale=0.5,thickness=1,fontFace=cv2.FONT_HERSHEY_SIMPLEX,outline_color=None,line_spacing=1.5):
   H,W = img.shape[:2]
   uv_top_left = np.array(uv_top_left, dtype=float)
@@ -0,0 +1,75 @@
+from fpose.Utils import *
+import argparse
+import resource
+
+
+def compute_mesh_diameter_dense(model_pts, n_sample=10000):
+  '''The previous reset_object diameter: dense pairwise distances of a random subset
+  '''
+  ids = np.random.choice(len(model_pts), size=min(n_sample, len(model_pts)), replace=False)
+  pts = model_pts[ids]
+  dists = np.linalg.norm(pts[None]-pts[:,None], axis=-1)
+  return dists.max()
+
+
+def make_points(num_vertices, seed=0):
+  '''Vertices of a noisy, anisotropic icosphere with at least num_vertices vertices
+  '''
+  subdivisions = 0
+  while 10*4**subdivisions+2<num_vertices:
+    subdivisions += 1
+  pts = trimesh.creation.icosphere(subdivisions=subdivisions).vertices*np.array([0.2, 0.1, 0.05])
+  rng = np.random.RandomState(seed)
+  return pts+rng.normal(scale=1e-3, size=pts.shape)
+
+
+def run_method(method, pts, queue):
+  begin = time.time()
+  if method=='dense':
+    diameter = compute_mesh_diameter_dense(pts)
+  else:
+    diameter = compute_mesh_diameter(model_pts=pts, n_sample=None)
+  elapsed = time.time()-begin
+  queue.put((float(diameter), elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024))
+
+
+def measure(method, pts):
+  '''Run in a fresh process so the peak RSS belongs to this method only
+  '''
+  ctx = mp.get_context('fork')
+  queue = ctx.Queue()
+  proc = ctx.Process(target=run_method, args=(method, pts, queue))
+  proc.start()
+  result = queue.get()
+  proc.join()
+  return result
+
+
+if __name__=='__main__':
+  '''Compare time, peak RSS and value of the dense sampled diameter against the exact convex hull diameter
+  '''
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--num_vertices', type=int, nargs='+', default=[10000, 40000, 160000, 650000, 1000000])
+  parser.add_argument('--mesh_file', type=str, default=None)
+  args = parser.parse_args()
+
+  set_seed(0)
+
+  # Exactness check against brute force on a small set
+  pts = make_points(2000)
+  brute = np.linalg.norm(pts[None]-pts[:,None], axis=-1).max()
+  exact = compute_mesh_diameter(model_pts=pts, n_sample=None)
+  assert np.isclose(brute, exact, rtol=0, atol=1e-12), f'{brute} != {exact}'
+
+  point_sets = []
+  if args.mesh_file is not None:
+    point_sets.append((os.path.basename(args.mesh_file), trimesh.load(args.mesh_file, force='mesh').vertices.copy()))
+  for num_vertices in args.num_vertices:
+    pts = make_points(num_vertices)
+    point_sets.append((f'icosphere {len(pts)}', pts))
+
+  print(f"{'points':>22} {'method':>8} {'diameter':>12} {'time(s)':>10} {'peak RSS(MB)':>13}")
+  for name, pts in point_sets:
+    for method in ['dense', 'exact']:
+      diameter, elapsed, peak_rss = measure(method, pts)
+      print(f"{name:>22} {method:>8} {diameter:>12.6f} {elapsed:>10.3f} {peak_rss:>13.1f}")
@@ -0,0 +1,75 @@
+from fpose.estimater import *
+from fpose.datareader import *
+import argparse
+
+
+def run_register(est, reader, frame_ids, keep_ratio, iteration):
+  poses = []
+  times = []
+  for i in frame_ids:
+    color = reader.get_color(i)
+    depth = reader.get_depth(i)
+    mask = reader.get_mask(i).astype(bool)
+    torch.cuda.synchronize()
+    begin = time.time()
+    pose = est.register(K=reader.K, rgb=color, depth=depth, ob_mask=mask, iteration=iteration, keep_ratio=keep_ratio)
+    torch.cuda.synchronize()
+    times.append(time.time()-begin)
+    poses.append(pose.reshape(4,4))
+  return poses, times
+
+
+if __name__=='__main__':
+  '''Compare ADD/ADD-S and wall time of exhaustive registration against successive-halving pruning
+  '''
+  parser = argparse.ArgumentParser()
+  code_dir = os.path.dirname(os.path.realpath(__file__))
+  parser.add_argument('--mesh_file', type=str, default=f'{code_dir}/demo_data/mustard/mesh/textured_simple.obj')
+  parser.add_argument('--test_scene_dir', type=str, default=f'{code_dir}/demo_data/mustard')
+  parser.add_argument('--est_refine_iter', type=int, default=5)
+  parser.add_argument('--keep_ratios', type=float, nargs='+', default=[0.5, 0.25])
+  parser.add_argument('--max_frames', type=int, default=20)
+  args = parser.parse_args()
+
+  set_logging_format()
+  set_seed(0)
+
+  mesh = trimesh.load(args.mesh_file)
+  model_pts = mesh.vertices.copy()
+
+  scorer = ScorePredictor()
+  refiner = PoseRefinePredictor()
+  glctx = dr.RasterizeCudaContext()
+  est = FoundationPose(model_pts=mesh.vertices, model_normals=mesh.vertex_normals, mesh=mesh, scorer=scorer, refiner=refiner, debug=0, glctx=glctx)
+
+  reader = YcbineoatReader(video_dir=args.test_scene_dir, shorter_side=None, zfar=np.inf)
+  frame_ids = []
+  for i in range(len(reader.color_files)):
+    if not os.path.exists(reader.color_files[i].replace('rgb','masks')):
+      continue
+    if reader.get_gt_pose(i) is None:
+      continue
+    frame_ids.append(i)
+  frame_ids = frame_ids[:args.max_frames]
+  if len(frame_ids)==0:
+    raise RuntimeError(f'no frame in {args.test_scene_dir} has both a mask and a gt pose')
+  logging.info(f'benchmarking on {len(frame_ids)} frames')
+
+  # Warm up kernels and caches so the first timed run is not penalised
+  run_register(est, reader, frame_ids[:1], keep_ratio=1, iteration=args.est_refine_iter)
+
+  results = {}
+  for keep_ratio in [1.0]+list(args.keep_ratios):
+    poses, times = run_register(est, reader, frame_ids, keep_ratio=keep_ratio, iteration=args.est_refine_iter)
+    adds = []
+    add_ss = []
+    for i,pose in zip(frame_ids, poses):
+      gt = reader.get_gt_pose(i)
+      adds.append(add_err(pose, gt, model_pts))
+      add_ss.append(adds_err(pose, gt, model_pts))
+    results[keep_ratio] = (np.array(adds), np.array(add_ss), np.array(times))
+
+  print(f"{'keep_ratio':>10} {'ADD(mm)':>10} {'ADD-S(mm)':>10} {'time(s)':>10} {'speedup':>8}")
+  base_time = results[1.0][2].mean()
+  for keep_ratio,(adds,add_ss,times) in results.items():
+    print(f"{keep_ratio:>10.3f} {adds.mean()*1000:>10.2f} {add_ss.mean()*1000:>10.2f} {times.mean():>10.3f} {base_time/times.mean():>8.2f}")
@@ -0,0 +1,110 @@
+from fpose.estimater import *
+import argparse
+
+
+def erode_depth_reference(depth, radius=2, depth_diff_thres=0.001, ratio_thres=0.8, zfar=100):
+  '''Pixel loop port of the warp erode_depth kernel
+  '''
+  H,W = depth.shape
+  out = np.zeros_like(depth)
+  for h in range(H):
+    for w in range(W):
+      window = depth[max(h-radius,0):h+radius+1, max(w-radius,0):w+radius+1]
+      bad = (window<0.001) | (window>=zfar) | (np.abs(window-depth[h,w])>depth_diff_thres)
+      out[h,w] = 0 if bad.sum()/bad.size>ratio_thres else depth[h,w]
+  return out
+
+
+def bilateral_filter_depth_reference(depth, radius=2, zfar=100, sigmaD=2, sigmaR=100000):
+  '''Pixel loop port of the warp bilateral_filter_depth kernel
+  '''
+  H,W = depth.shape
+  out = np.zeros_like(depth)
+  for h in range(H):
+    for w in range(W):
+      vs, us = np.meshgrid(np.arange(max(h-radius,0), min(h+radius+1,H)), np.arange(max(w-radius,0), min(w+radius+1,W)), indexing='ij')
+      window = depth[vs,us]
+      valid = (window>=0.001) & (window<zfar)
+      if valid.sum()==0:
+        continue
+      valid &= np.abs(window-window[valid].mean())<0.01
+      weight = np.exp(-((us-w)**2+(vs-h)**2)/(2.0*sigmaD*sigmaD) - (depth[h,w]-window)**2/(2.0*sigmaR*sigmaR))*valid
+      if weight.sum()>0:
+        out[h,w] = (weight*window).sum()/weight.sum()
+  return out
+
+
+def make_synthetic_depth(H, W, rng):
+  '''Two planes with a step edge, sensor noise, holes and far outliers
+  '''
+  vs, us = np.meshgrid(np.arange(H), np.arange(W), indexing='ij')
+  depth = 0.5+0.001*us
+  depth[:, W//2:] += 0.05
+  depth += rng.normal(0, 0.0005, size=depth.shape)
+  depth[rng.random(depth.shape)<0.05] = 0
+  depth[rng.random(depth.shape)<0.01] = 200
+  return depth.astype(np.float32)
+
+
+def make_scene(K, H, W, pose, device='cpu'):
+  '''Vertex colored box rendered with the torch rasterizer
+  @return: mesh, rgb (H,W,3) uint8, depth (H,W), mask (H,W)
+  '''
+  mesh = trimesh.creation.box(extents=(0.08,0.05,0.12)).subdivide().subdivide()
+  colors = (mesh.vertices-mesh.vertices.min(axis=0))/mesh.extents
+  mesh.visual.vertex_colors = (np.concatenate([colors, np.ones((len(colors),1))], axis=-1)*255).astype(np.uint8)
+  color, depth, _ = nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=torch.as_tensor(pose, dtype=torch.float, device=device)[None], glctx=make_rasterizer(device), mesh=mesh)
+  rgb = (color[0].data.cpu().numpy()*255).astype(np.uint8)
+  depth = depth[0].data.cpu().numpy()
+  return mesh, rgb, depth, depth>=0.001
+
+
+if __name__=='__main__':
+  '''Check the cpu backend without a GPU: the torch depth filters against a reference port of the warp kernels,
+  then register and track a synthetic scene end to end on device='cpu'
+  '''
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--est_refine_iter', type=int, default=5)
+  parser.add_argument('--track_refine_iter', type=int, default=2)
+  parser.add_argument('--n_track', type=int, default=3)
+  parser.add_argument('--max_adds', type=float, default=0.1, help='max ADD-S, as a fraction of the mesh diameter')
+  args = parser.parse_args()
+
+  set_logging_format()
+  set_seed(0)
+  rng = np.random.default_rng(0)
+  depth = make_synthetic_depth(48, 64, rng)
+  for radius in [1, 2]:
+    eroded = erode_depth(depth, radius=radius, device='cpu')
+    ref_eroded = erode_depth_reference(depth, radius=radius)
+    filtered = bilateral_filter_depth(eroded, radius=radius, device='cpu')
+    ref_filtered = bilateral_filter_depth_reference(ref_eroded, radius=radius)
+    erode_diff = np.abs(eroded-ref_eroded).max()
+    filter_diff = np.abs(filtered-ref_filtered).max()
+    print(f"radius {radius}: erode_depth max diff {erode_diff:.2e}, bilateral_filter_depth max diff {filter_diff:.2e}")
+    assert erode_diff<1e-6 and filter_diff<1e-5, 'torch depth filters disagree with the reference'
+
+  H, W = 240, 320
+  K = np.array([[500,0,W/2], [0,500,H/2], [0,0,1]], dtype=np.float32)
+  gt_poses = []
+  for i in range(args.n_track+1):
+    pose = euler_matrix(0.3+0.02*i, -0.5+0.03*i, 0.2)
+    pose[:3,3] = [0.02+0.002*i, -0.01, 0.5+0.005*i]
+    gt_poses.append(pose)
+
+  mesh, rgb, depth, mask = make_scene(K, H, W, gt_poses[0])
+  est = FoundationPose(model_pts=mesh.vertices, model_normals=mesh.vertex_normals, mesh=mesh, scorer=ScorePredictor(device='cpu'), refiner=PoseRefinePredictor(device='cpu'), glctx=make_rasterizer('cpu'), debug=0, device='cpu')
+  diameter = est.diameter
+  print(f"{'frame':>6} {'time(s)':>8} {'ADD-S(mm)':>10}")
+  for i,gt_pose in enumerate(gt_poses):
+    if i>0:
+      _, rgb, depth, mask = make_scene(K, H, W, gt_pose)
+    begin = time.time()
+    if i==0:
+      pose = est.register(K=K, rgb=rgb, depth=depth, ob_mask=mask, iteration=args.est_refine_iter)
+    else:
+      pose = est.track_one(rgb=rgb, depth=depth, K=K, iteration=args.track_refine_iter)
+    err = adds_err(pose.reshape(4,4), gt_pose, mesh.vertices)
+    print(f"{i:>6} {time.time()-begin:>8.3f} {err*1000:>10.2f}")
+    assert err<args.max_adds*diameter, f'frame {i}: ADD-S {err:.4f} above {args.max_adds} of the diameter {diameter:.4f}'
+  print('cpu backend ok')
@@ -0,0 +1,64 @@
+from fpose.estimater import *
+from fpose.datareader import *
+import argparse
+
+
+def run_sequence(device, mesh, reader, frame_ids, est_refine_iter, track_refine_iter):
+  '''Register on the first frame and track the others, the same path as run_demo.py
+  '''
+  est = FoundationPose(model_pts=mesh.vertices, model_normals=mesh.vertex_normals, mesh=mesh, scorer=ScorePredictor(device=device), refiner=PoseRefinePredictor(device=device), glctx=make_rasterizer(device), debug=0, device=device)
+  poses = []
+  times = []
+  for i in frame_ids:
+    color = reader.get_color(i)
+    depth = reader.get_depth(i)
+    begin = time.time()
+    if len(poses)==0:
+      pose = est.register(K=reader.K, rgb=color, depth=depth, ob_mask=reader.get_mask(i).astype(bool), iteration=est_refine_iter)
+    else:
+      pose = est.track_one(rgb=color, depth=depth, K=reader.K, iteration=track_refine_iter)
+    times.append(time.time()-begin)
+    poses.append(pose.reshape(4,4))
+  return poses, times
+
+
+if __name__=='__main__':
+  '''Check the cpu backend (torch depth filters, TorchRasterizer) against cuda (warp, nvdiffrast) on the demo sequence
+  '''
+  parser = argparse.ArgumentParser()
+  code_dir = os.path.dirname(os.path.realpath(__file__))
+  parser.add_argument('--mesh_file', type=str, default=f'{code_dir}/demo_data/mustard/mesh/textured_simple.obj')
+  parser.add_argument('--test_scene_dir', type=str, default=f'{code_dir}/demo_data/mustard')
+  parser.add_argument('--est_refine_iter', type=int, default=5)
+  parser.add_argument('--track_refine_iter', type=int, default=2)
+  parser.add_argument('--max_frames', type=int, default=5)
+  parser.add_argument('--devices', type=str, nargs='+', default=['cuda', 'cpu'])
+  args = parser.parse_args()
+
+  set_logging_format()
+  mesh = trimesh.load(args.mesh_file)
+  model_pts = mesh.vertices.copy()
+  reader = YcbineoatReader(video_dir=args.test_scene_dir, shorter_side=None, zfar=np.inf)
+  frame_ids = list(range(min(args.max_frames, len(reader.color_files))))
+
+  depth = reader.get_depth(0)
+  ref_device = args.devices[0]
+  ref_eroded = erode_depth(depth, radius=2, device=ref_device)
+  ref_filtered = bilateral_filter_depth(ref_eroded, radius=2, device=ref_device)
+  for device in args.devices[1:]:
+    eroded = erode_depth(depth, radius=2, device=device)
+    filtered = bilateral_filter_depth(eroded, radius=2, device=device)
+    print(f"{device} vs {ref_device}: erode_depth max diff {np.abs(eroded-ref_eroded).max():.2e}, bilateral_filter_depth max diff {np.abs(filtered-ref_filtered).max():.2e}")
+
+  results = {}
+  for device in args.devices:
+    set_seed(0)
+    results[device] = run_sequence(device, mesh, reader, frame_ids, args.est_refine_iter, args.track_refine_iter)
+
+  print(f"{'device':>8} {'register(s)':>12} {'track(s)':>10} {'ADD vs ref(mm)':>15} {'ADD-S vs ref(mm)':>17}")
+  ref_poses = results[ref_device][0]
+  for device,(poses,times) in results.items():
+    adds = [add_err(pose, ref, model_pts) for pose,ref in zip(poses, ref_poses)]
+    add_ss = [adds_err(pose, ref, model_pts) for pose,ref in zip(poses, ref_poses)]
+    track_time = np.mean(times[1:]) if len(times)>1 else 0
+    print(f"{device:>8} {times[0]:>12.3f} {track_time:>10.3f} {np.mean(adds)*1000:>15.2f} {np.mean(add_ss)*1000:>17.2f}")
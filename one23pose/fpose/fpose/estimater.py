@@ -13,15 +13,26 @@ import itertools
 from fpose.learning.training.predict_score import *
 from fpose.learning.training.predict_pose_refine import *
 import yaml
+from fpose.object_cache import ObjectCache, get_object_cache, hash_arrays, hash_mesh
 
 
 class FoundationPose:
-  def __init__(self, model_pts, model_normals, symmetry_tfs=None, mesh=None, scorer:ScorePredictor=None, refiner:PoseRefinePredictor=None, glctx=None, debug=0, debug_dir='/home/bowen/debug/novel_pose_debug/'):
+  def __init__(self, model_pts, model_normals, symmetry_tfs=None, mesh=None, scorer:ScorePredictor=None, refiner:PoseRefinePredictor=None, glctx=None, debug=0, debug_dir='/home/bowen/debug/novel_pose_debug/', object_cache:ObjectCache=None, hypo_keep_ratio=1.0, min_n_hypo=8, device='cuda', render_cache_bytes=0):
+    '''
+    @device: torch device everything runs on, scorer/refiner/glctx passed in must live on the same device
+    @render_cache_bytes: >0 enables a RenderedCropCache of this size for the refiner and scorer crops
+    '''
     self.gt_pose = None
+    self.device = torch.device(device)
     self.ignore_normal_flip = True
     self.debug = debug
     self.debug_dir = debug_dir
     os.makedirs(debug_dir, exist_ok=True)
+    self.object_cache = object_cache if object_cache is not None else get_object_cache()
+    self.hypo_keep_ratio = hypo_keep_ratio   # <1 enables successive halving of hypotheses in register
+    self.min_n_hypo = min_n_hypo
+    self.render_cache = RenderedCropCache(max_bytes=render_cache_bytes) if render_cache_bytes>0 else None
+    self.stager = PinnedStager(self.device)
 
     self.reset_object(model_pts, model_normals, symmetry_tfs=symmetry_tfs, mesh=mesh)
     self.make_rotation_grid(min_n_views=40, inplane_step=60)
@@ -31,12 +42,12 @@ class FoundationPose:
     if scorer is not None:
       self.scorer = scorer
     else:
-      self.scorer = ScorePredictor()
+      self.scorer = ScorePredictor(device=self.device)
 
     if refiner is not None:
       self.refiner = refiner
     else:
-      self.refiner = PoseRefinePredictor()
+      self.refiner = PoseRefinePredictor(device=self.device)
 
     self.pose_last = None   # Used for tracking; per the centered mesh
 
@@ -51,55 +62,69 @@ class FoundationPose:
       mesh.vertices = mesh.vertices - self.model_center.reshape(1,3)
 
     model_pts = mesh.vertices
-    self.diameter = compute_mesh_diameter(model_pts=mesh.vertices, n_sample=10000)
-    self.vox_size = max(self.diameter/20.0, 0.003)
+    mesh_key = hash_mesh(mesh, normals=model_normals)
+
+    def compute_geometry():
+      diameter = compute_mesh_diameter(model_pts=model_pts, n_sample=None)
+      vox_size = max(diameter/20.0, 0.003)
+      pcd = toOpen3dCloud(model_pts, normals=model_normals)
+      pcd = pcd.voxel_down_sample(vox_size)
+      return {'diameter': np.asarray(diameter), 'vox_size': np.asarray(vox_size), 'points': np.asarray(pcd.points), 'normals': np.asarray(pcd.normals)}
+
+    geometry = self.object_cache.get(f'geometry_v2_{mesh_key}', compute_geometry)
+    self.diameter = float(geometry['diameter'])
+    self.vox_size = float(geometry['vox_size'])
     logging.info(f'self.diameter:{self.diameter}, vox_size:{self.vox_size}')
     self.dist_bin = self.vox_size/2
     self.angle_bin = 20  # Deg
-    pcd = toOpen3dCloud(model_pts, normals=model_normals)
-    pcd = pcd.voxel_down_sample(self.vox_size)
-    self.max_xyz = np.asarray(pcd.points).max(axis=0)
-    self.min_xyz = np.asarray(pcd.points).min(axis=0)
-    self.pts = torch.tensor(np.asarray(pcd.points), dtype=torch.float32, device='cuda')
-    self.normals = F.normalize(torch.tensor(np.asarray(pcd.normals), dtype=torch.float32, device='cuda'), dim=-1)
+    self.max_xyz = geometry['points'].max(axis=0)
+    self.min_xyz = geometry['points'].min(axis=0)
+    self.pts = torch.tensor(geometry['points'], dtype=torch.float32, device=self.device)
+    self.normals = F.normalize(torch.tensor(geometry['normals'], dtype=torch.float32, device=self.device), dim=-1)
     logging.info(f'self.pts:{self.pts.shape}')
-    self.mesh_path = None
     self.mesh = mesh
-    if self.mesh is not None:
-      self.mesh_path = f'/tmp/{uuid.uuid4()}.obj'
-      self.mesh.export(self.mesh_path)
-    self.mesh_tensors = make_mesh_tensors(self.mesh)
+    if self.render_cache is not None:
+      self.render_cache.clear()   # Cached crops belong to the previous mesh
+    self.mesh_tensors = self.object_cache.get(f'mesh_tensors_{mesh_key}_{self.device}', lambda: make_mesh_tensors(self.mesh, device=self.device), persist=False)
 
     if symmetry_tfs is None:
-      self.symmetry_tfs = torch.eye(4).float().cuda()[None]
+      self.symmetry_tfs = torch.eye(4, dtype=torch.float, device=self.device)[None]
     else:
-      self.symmetry_tfs = torch.as_tensor(symmetry_tfs, device='cuda', dtype=torch.float)
+      self.symmetry_tfs = torch.as_tensor(symmetry_tfs, device=self.device, dtype=torch.float)
 
     logging.info("reset done")
 
 
 
   def get_tf_to_centered_mesh(self):
-    tf_to_center = torch.eye(4, dtype=torch.float, device='cuda')
-    tf_to_center[:3,3] = -torch.as_tensor(self.model_center, device='cuda', dtype=torch.float)
+    tf_to_center = torch.eye(4, dtype=torch.float, device=self.device)
+    tf_to_center[:3,3] = -torch.as_tensor(self.model_center, device=self.device, dtype=torch.float)
     return tf_to_center
 
 
   def to_device(self, s='cuda:0'):
+    self.device = torch.device(s)
     for k in self.__dict__:
       self.__dict__[k] = self.__dict__[k]
       if torch.is_tensor(self.__dict__[k]) or isinstance(self.__dict__[k], nn.Module):
         logging.info(f"Moving {k} to device {s}")
         self.__dict__[k] = self.__dict__[k].to(s)
+    mesh_tensors = {}
     for k in self.mesh_tensors:
       logging.info(f"Moving {k} to device {s}")
-      self.mesh_tensors[k] = self.mesh_tensors[k].to(s)
+      mesh_tensors[k] = self.mesh_tensors[k].to(s)
+    self.mesh_tensors = mesh_tensors   # The original dict may be shared through the object cache
     if self.refiner is not None:
       self.refiner.model.to(s)
+      self.refiner.device = self.device
     if self.scorer is not None:
       self.scorer.model.to(s)
+      self.scorer.device = self.device
     if self.glctx is not None:
-      self.glctx = dr.RasterizeCudaContext(s)
+      self.glctx = make_rasterizer(self.device)
+    if self.render_cache is not None:
+      self.render_cache.clear()
+    self.stager = PinnedStager(self.device)
 
 
 
@@ -117,10 +142,11 @@ class FoundationPose:
 
     rot_grid = np.asarray(rot_grid)
     logging.info(f"rot_grid:{rot_grid.shape}")
-    rot_grid = mycpp.cluster_poses(30, 99999, rot_grid, self.symmetry_tfs.data.cpu().numpy())
-    rot_grid = np.asarray(rot_grid)
+    symmetry_tfs = self.symmetry_tfs.data.cpu().numpy()
+    key = hash_arrays(symmetry_tfs, min_n_views, inplane_step)
+    rot_grid = self.object_cache.get(f'rot_grid_{key}', lambda: {'rot_grid': np.asarray(mycpp.cluster_poses(30, 99999, rot_grid, symmetry_tfs))})['rot_grid']
     logging.info(f"after cluster, rot_grid:{rot_grid.shape}")
-    self.rot_grid = torch.as_tensor(rot_grid, device='cuda', dtype=torch.float)
+    self.rot_grid = torch.as_tensor(rot_grid, device=self.device, dtype=torch.float)
     logging.info(f"self.rot_grid: {self.rot_grid.shape}")
 
 
@@ -130,7 +156,24 @@ class FoundationPose:
     '''
     ob_in_cams = self.rot_grid.clone()
     center = self.guess_translation(depth=depth, mask=mask, K=K)
-    ob_in_cams[:,:3,3] = torch.tensor(center, device='cuda', dtype=torch.float).reshape(1,3)
+    ob_in_cams[:,:3,3] = torch.tensor(center, device=self.device, dtype=torch.float).reshape(1,3)
+    return ob_in_cams
+
+
+  def generate_local_pose_hypo(self, pose, max_angle=20, n_angles=2):
+    '''Hypotheses in a small rotation neighbourhood of a pose instead of the global rot_grid
+    @pose: (4,4) tensor wrt. the centered mesh
+    @max_angle: deg, the pose is rotated about its center by n_angles steps up to max_angle around each of 12 icosahedron axes
+    @return: (1+12*n_angles,4,4) tensor, the pose itself first
+    '''
+    axes = trimesh.creation.icosahedron().vertices
+    axes = axes/np.linalg.norm(axes, axis=-1, keepdims=True)
+    angles = np.deg2rad(np.linspace(max_angle/n_angles, max_angle, n_angles))
+    rotvecs = (axes[None]*angles[:,None,None]).reshape(-1,3)
+    rot_deltas = so3_exp_map(torch.as_tensor(rotvecs, device=self.device, dtype=torch.float))
+    pose = torch.as_tensor(pose, device=self.device, dtype=torch.float).reshape(4,4)
+    ob_in_cams = pose[None].repeat(1+len(rotvecs),1,1)
+    ob_in_cams[1:,:3,:3] = rot_deltas@pose[:3,:3]
     return ob_in_cams
 
 
@@ -156,22 +199,22 @@ class FoundationPose:
     return center.reshape(3)
 
 
-  def register(self, K, rgb, depth, ob_mask, ob_id=None, glctx=None, iteration=5):
+  def register(self, K, rgb, depth, ob_mask, ob_id=None, glctx=None, iteration=5, keep_ratio=None):
     '''Copmute pose from given pts to self.pcd
     @pts: (N,3) np array, downsampled scene points
+    @keep_ratio: fraction of hypotheses kept after each refine iteration, default to self.hypo_keep_ratio. 1 refines all hypotheses for all iterations
     '''
     set_seed(0)
     logging.info('Welcome')
 
     if self.glctx is None:
       if glctx is None:
-        self.glctx = dr.RasterizeCudaContext()
-        # self.glctx = dr.RasterizeGLContext()
+        self.glctx = make_rasterizer(self.device)
       else:
         self.glctx = glctx
 
-    depth = erode_depth(depth, radius=2, device='cuda')
-    depth = bilateral_filter_depth(depth, radius=2, device='cuda')
+    depth = erode_depth(depth, radius=2, device=self.device)
+    depth = bilateral_filter_depth(depth, radius=2, device=self.device)
 
     if self.debug>=2:
       xyz_map = depth2xyzmap(depth, K)
@@ -201,24 +244,36 @@ class FoundationPose:
     self.ob_mask = ob_mask
 
     poses = self.generate_random_pose_hypo(K=K, rgb=rgb, depth=depth, mask=ob_mask, scene_pts=None)
-    poses = poses.data.cpu().numpy()
     logging.info(f'poses:{poses.shape}')
     center = self.guess_translation(depth=depth, mask=ob_mask, K=K)
 
-    poses = torch.as_tensor(poses, device='cuda', dtype=torch.float)
-    poses[:,:3,3] = torch.as_tensor(center.reshape(1,3), device='cuda')
+    poses[:,:3,3] = torch.as_tensor(center.reshape(1,3), device=self.device)
 
     add_errs = self.compute_add_err_to_gt_pose(poses)
     logging.info(f"after viewpoint, add_errs min:{add_errs.min()}")
 
     xyz_map = depth2xyzmap(depth, K)
-    poses, vis = self.refiner.predict(mesh=self.mesh, mesh_tensors=self.mesh_tensors, rgb=rgb, depth=depth, K=K, ob_in_cams=poses.data.cpu().numpy(), normal_map=normal_map, xyz_map=xyz_map, glctx=self.glctx, mesh_diameter=self.diameter, iteration=iteration, get_vis=self.debug>=2)
-    if vis is not None:
-      imageio.imwrite(f'{self.debug_dir}/vis_refiner.png', vis)
-
-    scores, vis = self.scorer.predict(mesh=self.mesh, rgb=rgb, depth=depth, K=K, ob_in_cams=poses.data.cpu().numpy(), normal_map=normal_map, mesh_tensors=self.mesh_tensors, glctx=self.glctx, mesh_diameter=self.diameter, get_vis=self.debug>=2)
-    if vis is not None:
-      imageio.imwrite(f'{self.debug_dir}/vis_score.png', vis)
+    if keep_ratio is None:
+      keep_ratio = self.hypo_keep_ratio
+    if keep_ratio>=1:
+      poses, vis = self.refiner.predict(mesh=self.mesh, mesh_tensors=self.mesh_tensors, rgb=rgb, depth=depth, K=K, ob_in_cams=poses, normal_map=normal_map, xyz_map=xyz_map, glctx=self.glctx, mesh_diameter=self.diameter, iteration=iteration, get_vis=self.debug>=2, render_cache=self.render_cache)
+      if vis is not None:
+        imageio.imwrite(f'{self.debug_dir}/vis_refiner.png', vis)
+
+      scores, vis = self.scorer.predict(mesh=self.mesh, rgb=rgb, depth=depth, K=K, ob_in_cams=poses, normal_map=normal_map, mesh_tensors=self.mesh_tensors, glctx=self.glctx, mesh_diameter=self.diameter, get_vis=self.debug>=2, render_cache=self.render_cache)
+      if vis is not None:
+        imageio.imwrite(f'{self.debug_dir}/vis_score.png', vis)
+    else:
+      ########## Successive halving: score after every refine iteration and only keep the best keep_ratio of the hypotheses
+      for i in range(iteration):
+        poses, _ = self.refiner.predict(mesh=self.mesh, mesh_tensors=self.mesh_tensors, rgb=rgb, depth=depth, K=K, ob_in_cams=poses, normal_map=normal_map, xyz_map=xyz_map, glctx=self.glctx, mesh_diameter=self.diameter, iteration=1, render_cache=self.render_cache)
+        scores, _ = self.scorer.predict(mesh=self.mesh, rgb=rgb, depth=depth, K=K, ob_in_cams=poses, normal_map=normal_map, mesh_tensors=self.mesh_tensors, glctx=self.glctx, mesh_diameter=self.diameter, render_cache=self.render_cache)
+        if i<iteration-1:
+          n_keep = min(len(poses), max(self.min_n_hypo, int(np.ceil(len(poses)*keep_ratio))))
+          ids = scores.argsort(descending=True)[:n_keep]
+          poses = poses[ids]
+          scores = scores[ids]
+          logging.info(f'iter {i}, kept {n_keep} hypotheses')
 
     add_errs = self.compute_add_err_to_gt_pose(poses)
     logging.info(f"final, add_errs min:{add_errs.min()}")
@@ -240,27 +295,191 @@ class FoundationPose:
     return best_pose.data.cpu().numpy()
 
 
+  def register_local(self, K, rgb, depth, ob_mask, pose_init, iteration=5, max_angle=20, n_angles=2, min_score=None, min_iou=0.5):
+    '''register() seeded with a pose estimate, e.g. the previous pose moved by the camera motion.
+    Only a local rotation neighbourhood of pose_init is refined (tens of hypotheses instead of the whole rot_grid), each at the
+    translation of pose_init and at guess_translation. Falls back to register() when the best local hypothesis scores below
+    min_score (if set) or its mask IoU is below min_iou
+    @pose_init: (4,4) np array, same frame as the poses returned by register
+    '''
+    set_seed(0)
+    if self.glctx is None:
+      self.glctx = make_rasterizer(self.device)
+
+    depth_ori = depth
+    depth = erode_depth(depth, radius=2, device=self.device)
+    depth = bilateral_filter_depth(depth, radius=2, device=self.device)
+    valid = (depth>=0.001) & (ob_mask>0)
+    if valid.sum()<4:
+      logging.info(f'valid too small, return')
+      pose = np.eye(4)
+      pose[:3,3] = self.guess_translation(depth=depth, mask=ob_mask, K=K)
+      return pose
+
+    self.H, self.W = depth.shape[:2]
+    self.K = K
+    self.ob_mask = ob_mask
+
+    tf_to_center = self.get_tf_to_centered_mesh()
+    pose_init = torch.as_tensor(pose_init, device=self.device, dtype=torch.float).reshape(4,4)@tf_to_center.inverse()
+    poses = self.generate_local_pose_hypo(pose_init, max_angle=max_angle, n_angles=n_angles)
+    center = self.guess_translation(depth=depth, mask=ob_mask, K=K)
+    poses_centered = poses.clone()
+    poses_centered[:,:3,3] = torch.as_tensor(center.reshape(1,3), device=self.device, dtype=torch.float)
+    poses = torch.cat([poses, poses_centered], dim=0)
+    logging.info(f'local poses:{poses.shape}')
+
+    xyz_map = depth2xyzmap(depth, K)
+    poses, _ = self.refiner.predict(mesh=self.mesh, mesh_tensors=self.mesh_tensors, rgb=rgb, depth=depth, K=K, ob_in_cams=poses, normal_map=None, xyz_map=xyz_map, glctx=self.glctx, mesh_diameter=self.diameter, iteration=iteration, render_cache=self.render_cache)
+    scores, _ = self.scorer.predict(mesh=self.mesh, rgb=rgb, depth=depth, K=K, ob_in_cams=poses, normal_map=None, mesh_tensors=self.mesh_tensors, glctx=self.glctx, mesh_diameter=self.diameter, render_cache=self.render_cache)
+    ids = scores.argsort(descending=True)
+    poses = poses[ids]
+    scores = scores[ids]
+
+    iou = self.compute_mask_iou(K=K, ob_mask=ob_mask, pose=poses[0])
+    if iou<min_iou or (min_score is not None and scores[0]<min_score):
+      logging.info(f'local hypotheses failed (score:{float(scores[0]):.3f}, mask iou:{iou:.3f}), falling back to the global grid')
+      return self.register(K=K, rgb=rgb, depth=depth_ori, ob_mask=ob_mask, iteration=iteration)
+
+    self.pose_last = poses[0]
+    self.best_id = ids[0]
+    self.poses = poses
+    self.scores = scores
+    return (poses[0]@tf_to_center).data.cpu().numpy()
+
+
+  def register_multi(self, frames, glctx=None, iteration=5, mem_budget=4*1024**3, keep_ratio=None):
+    '''register() for several frames at once, hypotheses of all frames share render and network batches
+    @frames: list of dict with K, rgb, depth, ob_mask; all frames must have the same size
+    @keep_ratio: as in register(), successive halving is done per frame
+    @return: list of (4,4) np array poses and list of their scores (same scale as self.scores), None for frames with too few valid pixels
+    '''
+    set_seed(0)
+    if self.glctx is None:
+      if glctx is None:
+        self.glctx = make_rasterizer(self.device)
+      else:
+        self.glctx = glctx
+
+    out = [None]*len(frames)
+    out_scores = [None]*len(frames)
+    todo = []
+    todo_frames = []
+    for i,frame in enumerate(frames):
+      depth = erode_depth(frame['depth'], radius=2, device=self.device)
+      depth = bilateral_filter_depth(depth, radius=2, device=self.device)
+      ob_mask = frame['ob_mask']
+      K = frame['K']
+      valid = (depth>=0.001) & (ob_mask>0)
+      if valid.sum()<4:
+        logging.info(f'frame {i} valid too small')
+        pose = np.eye(4)
+        pose[:3,3] = self.guess_translation(depth=depth, mask=ob_mask, K=K)
+        out[i] = pose
+        continue
+      poses = self.generate_random_pose_hypo(K=K, rgb=frame['rgb'], depth=depth, mask=ob_mask, scene_pts=None)
+      todo.append(i)
+      todo_frames.append(dict(frame, depth=depth, xyz_map=depth2xyzmap(depth, K), ob_in_cams=poses))
+
+    if len(todo)==0:
+      return out, out_scores
+
+    if keep_ratio is None:
+      keep_ratio = self.hypo_keep_ratio
+    if keep_ratio>=1:
+      poses = self.refiner.predict_multi(todo_frames, mesh=self.mesh, mesh_tensors=self.mesh_tensors, glctx=self.glctx, mesh_diameter=self.diameter, iteration=iteration, mem_budget=mem_budget)
+      for frame,pose in zip(todo_frames, poses):
+        frame['ob_in_cams'] = pose
+      scores = self.scorer.predict_multi(todo_frames, mesh=self.mesh, mesh_tensors=self.mesh_tensors, glctx=self.glctx, mesh_diameter=self.diameter, mem_budget=mem_budget)
+    else:
+      ########## Successive halving, each frame keeps the best keep_ratio of its own hypotheses after every refine iteration
+      for i in range(iteration):
+        poses = self.refiner.predict_multi(todo_frames, mesh=self.mesh, mesh_tensors=self.mesh_tensors, glctx=self.glctx, mesh_diameter=self.diameter, iteration=1, mem_budget=mem_budget)
+        for frame,pose in zip(todo_frames, poses):
+          frame['ob_in_cams'] = pose
+        scores = self.scorer.predict_multi(todo_frames, mesh=self.mesh, mesh_tensors=self.mesh_tensors, glctx=self.glctx, mesh_diameter=self.diameter, mem_budget=mem_budget)
+        if i<iteration-1:
+          for j,frame in enumerate(todo_frames):
+            n_keep = min(len(poses[j]), max(self.min_n_hypo, int(np.ceil(len(poses[j])*keep_ratio))))
+            ids = scores[j].argsort(descending=True)[:n_keep]
+            poses[j] = poses[j][ids]
+            scores[j] = scores[j][ids]
+            frame['ob_in_cams'] = poses[j]
+          logging.info(f'iter {i}, kept {[len(pose) for pose in poses]} hypotheses')
+
+    tf_to_center = self.get_tf_to_centered_mesh()
+    for i,pose,score in zip(todo, poses, scores):
+      ids = score.argsort(descending=True)
+      out[i] = (pose[ids[0]]@tf_to_center).data.cpu().numpy()
+      out_scores[i] = float(score[ids[0]])
+      self.pose_last = pose[ids[0]]
+      self.poses = pose[ids]
+      self.scores = score[ids]
+    return out, out_scores
+
+
+  def compute_mask_iou(self, K, ob_mask, pose=None):
+    '''IoU between the rendered silhouette of the pose and the observed mask
+    @pose: (4,4) torch tensor wrt. the centered mesh, default to self.pose_last
+    '''
+    if pose is None:
+      pose = self.pose_last
+    H,W = ob_mask.shape[:2]
+    _, depth_r, _ = nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=pose.reshape(1,4,4), glctx=self.glctx, mesh_tensors=self.mesh_tensors)
+    rendered = (depth_r[0]>=0.001).data.cpu().numpy()
+    ob_mask = ob_mask>0
+    union = (rendered | ob_mask).sum()
+    if union==0:
+      return 0.0
+    return float((rendered & ob_mask).sum()/union)
+
+
+  def score_pose(self, rgb, depth, K, pose=None):
+    '''Score of a single pose, on the same scale as self.scores after register. Used to detect tracking failure
+    @pose: (4,4) torch tensor wrt. the centered mesh, default to self.pose_last
+    '''
+    if pose is None:
+      pose = self.pose_last
+    depth = erode_depth(depth, radius=2, device=self.device)
+    depth = bilateral_filter_depth(depth, radius=2, device=self.device)
+    scores, _ = self.scorer.predict(mesh=self.mesh, rgb=rgb, depth=depth, K=K, ob_in_cams=pose.reshape(1,4,4), mesh_tensors=self.mesh_tensors, glctx=self.glctx, mesh_diameter=self.diameter, render_cache=self.render_cache)
+    return float(scores[0])
+
+
   def compute_add_err_to_gt_pose(self, poses):
     '''
     @poses: wrt. the centered mesh
     '''
-    return -torch.ones(len(poses), device='cuda', dtype=torch.float)
+    return -torch.ones(len(poses), device=self.device, dtype=torch.float)
+
+
+  def stage_frame(self, rgb, depth):
+    '''Start the host to device copy of a frame through pinned memory on a side stream. Stage the next frame before
+    tracking the current one to overlap the copy with its compute, then pass StagedArrays.get() tensors to track_one
+    '''
+    return self.stager.stage(rgb=rgb, depth=depth)
 
 
-  def track_one(self, rgb, depth, K, iteration, extra={}):
+  def track_one(self, rgb, depth, K, iteration, extra={}, pose_init=None):
+    '''
+    @rgb, depth: np arrays or device tensors, e.g. from stage_frame
+    @pose_init: (4,4) np array, same frame as the returned poses, e.g. the last pose moved by the camera motion. Default to the last pose
+    '''
+    if pose_init is not None:
+      self.pose_last = torch.as_tensor(pose_init, device=self.device, dtype=torch.float).reshape(4,4)@self.get_tf_to_centered_mesh().inverse()
     if self.pose_last is None:
       logging.info("Please init pose by register first")
       raise RuntimeError
     logging.info("Welcome")
 
-    depth = torch.as_tensor(depth, device='cuda', dtype=torch.float)
-    depth = erode_depth(depth, radius=2, device='cuda')
-    depth = bilateral_filter_depth(depth, radius=2, device='cuda')
+    depth = torch.as_tensor(depth, device=self.device, dtype=torch.float)
+    depth = erode_depth(depth, radius=2, device=self.device)
+    depth = bilateral_filter_depth(depth, radius=2, device=self.device)
     logging.info("depth processing done")
 
-    xyz_map = depth2xyzmap_batch(depth[None], torch.as_tensor(K, dtype=torch.float, device='cuda')[None], zfar=np.inf)[0]
+    xyz_map = depth2xyzmap_batch(depth[None], torch.as_tensor(K, dtype=torch.float, device=self.device)[None], zfar=np.inf)[0]
 
-    pose, vis = self.refiner.predict(mesh=self.mesh, mesh_tensors=self.mesh_tensors, rgb=rgb, depth=depth, K=K, ob_in_cams=self.pose_last.reshape(1,4,4).data.cpu().numpy(), normal_map=None, xyz_map=xyz_map, mesh_diameter=self.diameter, glctx=self.glctx, iteration=iteration, get_vis=self.debug>=2)
+    pose, vis = self.refiner.predict(mesh=self.mesh, mesh_tensors=self.mesh_tensors, rgb=rgb, depth=depth, K=K, ob_in_cams=self.pose_last.reshape(1,4,4), normal_map=None, xyz_map=xyz_map, mesh_diameter=self.diameter, glctx=self.glctx, iteration=iteration, get_vis=self.debug>=2, render_cache=self.render_cache)
     logging.info("pose done")
     if self.debug>=2:
       extra['vis'] = vis
@@ -23,7 +23,10 @@ from datareader import *
 
 
 @torch.inference_mode()
-def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_ratio, xyz_map, normal_map=None, mesh_diameter=None, cfg=None, glctx=None, mesh_tensors=None, dataset:PoseRefinePairH5Dataset=None):
+def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_ratio, xyz_map, normal_map=None, mesh_diameter=None, cfg=None, glctx=None, mesh_tensors=None, dataset:PoseRefinePairH5Dataset=None, device='cuda', render_cache:RenderedCropCache=None):
+  '''
+  @render_cache: optional RenderedCropCache of the mesh, renders only the poses without a cached view
+  '''
   logging.info("Welcome make_crop_data_batch")
   H,W = depth.shape[:2]
   args = []
@@ -33,34 +36,42 @@ def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_rati
   logging.info("make tf_to_crops done")
 
   B = len(ob_in_cams)
-  poseA = torch.as_tensor(ob_in_cams, dtype=torch.float, device='cuda')
+  poseA = torch.as_tensor(ob_in_cams, dtype=torch.float, device=device)
 
   bs = 512
-  rgb_rs = []
-  depth_rs = []
-  normal_rs = []
-  xyz_map_rs = []
-
-  bbox2d_crop = torch.as_tensor(np.array([0, 0, cfg['input_resize'][0]-1, cfg['input_resize'][1]-1]).reshape(2,2), device='cuda', dtype=torch.float)
+  bbox2d_crop = torch.as_tensor(np.array([0, 0, cfg['input_resize'][0]-1, cfg['input_resize'][1]-1]).reshape(2,2), device=device, dtype=torch.float)
   bbox2d_ori = transform_pts(bbox2d_crop, tf_to_crops.inverse()).reshape(-1,4)
 
-  for b in range(0,len(poseA),bs):
-    extra = {}
-    rgb_r, depth_r, normal_r = nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=poseA[b:b+bs], context='cuda', get_normal=cfg['use_normal'], glctx=glctx, mesh_tensors=mesh_tensors, output_size=cfg['input_resize'], bbox2d=bbox2d_ori[b:b+bs], use_light=True, extra=extra)
-    rgb_rs.append(rgb_r)
-    depth_rs.append(depth_r[...,None])
-    normal_rs.append(normal_r)
-    xyz_map_rs.append(extra['xyz_map'])
-  rgb_rs = torch.cat(rgb_rs, dim=0).permute(0,3,1,2) * 255
-  depth_rs = torch.cat(depth_rs, dim=0).permute(0,3,1,2)  #(B,1,H,W)
-  xyz_map_rs = torch.cat(xyz_map_rs, dim=0).permute(0,3,1,2)  #(B,3,H,W)
-  Ks = torch.as_tensor(K, device='cuda', dtype=torch.float).reshape(1,3,3)
-  if cfg['use_normal']:
-    normal_rs = torch.cat(normal_rs, dim=0).permute(0,3,1,2)  #(B,3,H,W)
+  def render(ids):
+    rgb_rs = []
+    normal_rs = []
+    xyz_map_rs = []
+    for b in range(0,len(ids),bs):
+      extra = {}
+      rgb_r, depth_r, normal_r = nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=poseA[ids[b:b+bs]], context=torch.device(device).type, get_normal=cfg['use_normal'], glctx=glctx, mesh_tensors=mesh_tensors, output_size=cfg['input_resize'], bbox2d=bbox2d_ori[ids[b:b+bs]], use_light=True, extra=extra)
+      rgb_rs.append(rgb_r)
+      normal_rs.append(normal_r)
+      xyz_map_rs.append(extra['xyz_map'])
+    crops = {
+      'rgb': torch.cat(rgb_rs, dim=0).permute(0,3,1,2) * 255,
+      'xyz_map': torch.cat(xyz_map_rs, dim=0).permute(0,3,1,2),  #(B,3,H,W)
+    }
+    if cfg['use_normal']:
+      crops['normal'] = torch.cat(normal_rs, dim=0).permute(0,3,1,2)  #(B,3,H,W)
+    return crops
+
+  if render_cache is None:
+    crops = render(torch.arange(B, device=device))
+  else:
+    crops = render_cache.render(render, poseA, tf_to_crops, K=K, mesh_diameter=mesh_diameter, crop_ratio=crop_ratio, out_size=cfg['input_resize'], flags=(cfg['use_normal'],))
+  rgb_rs = crops['rgb']
+  xyz_map_rs = crops['xyz_map']
+  normal_rs = crops.get('normal')
+  Ks = torch.as_tensor(K, device=device, dtype=torch.float).reshape(1,3,3)
 
   logging.info("render done")
 
-  rgbBs = kornia.geometry.transform.warp_perspective(torch.as_tensor(rgb, dtype=torch.float, device='cuda').permute(2,0,1)[None].expand(B,-1,-1,-1), tf_to_crops, dsize=render_size, mode='bilinear', align_corners=False)
+  rgbBs = kornia.geometry.transform.warp_perspective(torch.as_tensor(rgb, dtype=torch.float, device=device).permute(2,0,1)[None].expand(B,-1,-1,-1), tf_to_crops, dsize=render_size, mode='bilinear', align_corners=False)
   if rgb_rs.shape[-2:]!=cfg['input_resize']:
     rgbAs = kornia.geometry.transform.warp_perspective(rgb_rs, tf_to_crops, dsize=render_size, mode='bilinear', align_corners=False)
   else:
@@ -69,20 +80,91 @@ def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_rati
     xyz_mapAs = kornia.geometry.transform.warp_perspective(xyz_map_rs, tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
   else:
     xyz_mapAs = xyz_map_rs
-  xyz_mapBs = kornia.geometry.transform.warp_perspective(torch.as_tensor(xyz_map, device='cuda', dtype=torch.float).permute(2,0,1)[None].expand(B,-1,-1,-1), tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)  #(B,3,H,W)
+  xyz_mapBs = kornia.geometry.transform.warp_perspective(torch.as_tensor(xyz_map, device=device, dtype=torch.float).permute(2,0,1)[None].expand(B,-1,-1,-1), tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)  #(B,3,H,W)
 
   if cfg['use_normal']:
     normalAs = kornia.geometry.transform.warp_perspective(normal_rs, tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
-    normalBs = kornia.geometry.transform.warp_perspective(torch.as_tensor(normal_map, dtype=torch.float, device='cuda').permute(2,0,1)[None].expand(B,-1,-1,-1), tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
+    normalBs = kornia.geometry.transform.warp_perspective(torch.as_tensor(normal_map, dtype=torch.float, device=device).permute(2,0,1)[None].expand(B,-1,-1,-1), tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
   else:
     normalAs = None
     normalBs = None
 
   logging.info("warp done")
 
-  mesh_diameters = torch.ones((len(rgbAs)), dtype=torch.float, device='cuda')*mesh_diameter
+  mesh_diameters = torch.ones((len(rgbAs)), dtype=torch.float, device=device)*mesh_diameter
   pose_data = BatchPoseData(rgbAs=rgbAs, rgbBs=rgbBs, depthAs=None, depthBs=None, normalAs=normalAs, normalBs=normalBs, poseA=poseA, poseB=None, xyz_mapAs=xyz_mapAs, xyz_mapBs=xyz_mapBs, tf_to_crops=tf_to_crops, Ks=Ks, mesh_diameters=mesh_diameters)
-  pose_data = dataset.transform_batch(batch=pose_data, H_ori=H, W_ori=W, bound=1)
+  pose_data = dataset.transform_batch(batch=pose_data, H_ori=H, W_ori=W, bound=1, device=device)
+
+  logging.info("pose batch data done")
+
+  return pose_data
+
+
+
+@torch.inference_mode()
+def make_crop_data_batch_multi(render_size, ob_in_cams, frame_ids, mesh, rgbs, Ks, crop_ratio, xyz_maps, normal_maps=None, mesh_diameter=None, cfg=None, glctx=None, mesh_tensors=None, dataset:PoseRefinePairH5Dataset=None, device='cuda'):
+  '''Same as make_crop_data_batch, but the hypotheses come from several frames of the same size and are rendered together
+  @ob_in_cams: (B,4,4) torch tensor
+  @frame_ids: (B) np array, index of the frame of each hypothesis
+  @rgbs: (N_frame,H,W,3) torch tensor
+  @Ks: (N_frame,3,3) np array
+  @xyz_maps: (N_frame,H,W,3) torch tensor
+  @normal_maps: (N_frame,H,W,3) torch tensor, required when cfg['use_normal']
+  '''
+  logging.info("Welcome make_crop_data_batch_multi")
+  if cfg['use_normal']:
+    assert normal_maps is not None, 'use_normal needs the normal maps of the frames'
+  H,W = rgbs.shape[1:3]
+  tf_to_crops = compute_crop_window_tf_multi(pts=mesh.vertices, H=H, W=W, poses=ob_in_cams, frame_ids=frame_ids, Ks=Ks, crop_ratio=crop_ratio, out_size=(render_size[1], render_size[0]), method='box_3d', mesh_diameter=mesh_diameter)
+
+  B = len(ob_in_cams)
+  poseA = torch.as_tensor(ob_in_cams, dtype=torch.float, device=device)
+  frame_ids_t = torch.as_tensor(frame_ids, device=device, dtype=torch.long)
+  projection_mats = np.stack([projection_matrix_from_intrinsics(K, height=H, width=W, znear=0.001, zfar=100) for K in Ks])
+  projection_mats = torch.as_tensor(projection_mats, device=device, dtype=torch.float)[frame_ids_t]
+
+  bs = 512
+  rgbAs = []
+  xyz_mapAs = []
+  rgbBs = []
+  xyz_mapBs = []
+  normalAs = []
+  normalBs = []
+
+  bbox2d_crop = torch.as_tensor(np.array([0, 0, cfg['input_resize'][0]-1, cfg['input_resize'][1]-1]).reshape(2,2), device=device, dtype=torch.float)
+  bbox2d_ori = transform_pts(bbox2d_crop, tf_to_crops.inverse()).reshape(-1,4)
+  rgbs = rgbs.permute(0,3,1,2)
+  xyz_maps = xyz_maps.permute(0,3,1,2)
+  if cfg['use_normal']:
+    normal_maps = torch.as_tensor(normal_maps, device=device, dtype=torch.float).permute(0,3,1,2)
+
+  for b in range(0,B,bs):
+    extra = {}
+    rgb_r, depth_r, normal_r = nvdiffrast_render(H=H, W=W, ob_in_cams=poseA[b:b+bs], context=torch.device(device).type, get_normal=cfg['use_normal'], glctx=glctx, mesh_tensors=mesh_tensors, projection_mat=projection_mats[b:b+bs], output_size=cfg['input_resize'], bbox2d=bbox2d_ori[b:b+bs], use_light=True, extra=extra)
+    rgb_r = rgb_r.permute(0,3,1,2) * 255
+    xyz_map_r = extra['xyz_map'].permute(0,3,1,2)
+    tfs = tf_to_crops[b:b+bs]
+    if rgb_r.shape[-2:]!=cfg['input_resize']:
+      rgb_r = kornia.geometry.transform.warp_perspective(rgb_r, tfs, dsize=render_size, mode='bilinear', align_corners=False)
+    if xyz_map_r.shape[-2:]!=cfg['input_resize']:
+      xyz_map_r = kornia.geometry.transform.warp_perspective(xyz_map_r, tfs, dsize=render_size, mode='nearest', align_corners=False)
+    rgbAs.append(rgb_r)
+    xyz_mapAs.append(xyz_map_r)
+    ids = frame_ids[b:b+bs]
+    rgbBs.append(warp_frames_to_crops(rgbs, ids, tfs, dsize=render_size, mode='bilinear'))
+    xyz_mapBs.append(warp_frames_to_crops(xyz_maps, ids, tfs, dsize=render_size, mode='nearest'))
+    if cfg['use_normal']:
+      normalAs.append(kornia.geometry.transform.warp_perspective(normal_r.permute(0,3,1,2), tfs, dsize=render_size, mode='nearest', align_corners=False))
+      normalBs.append(warp_frames_to_crops(normal_maps, ids, tfs, dsize=render_size, mode='nearest'))
+
+  logging.info("render and warp done")
+
+  Ks_t = torch.as_tensor(np.asarray(Ks), device=device, dtype=torch.float)[frame_ids_t]
+  mesh_diameters = torch.ones((B), dtype=torch.float, device=device)*mesh_diameter
+  normalAs = torch.cat(normalAs, dim=0) if cfg['use_normal'] else None
+  normalBs = torch.cat(normalBs, dim=0) if cfg['use_normal'] else None
+  pose_data = BatchPoseData(rgbAs=torch.cat(rgbAs, dim=0), rgbBs=torch.cat(rgbBs, dim=0), depthAs=None, depthBs=None, normalAs=normalAs, normalBs=normalBs, poseA=poseA, poseB=None, xyz_mapAs=torch.cat(xyz_mapAs, dim=0), xyz_mapBs=torch.cat(xyz_mapBs, dim=0), tf_to_crops=tf_to_crops, Ks=Ks_t, mesh_diameters=mesh_diameters)
+  pose_data = dataset.transform_batch(batch=pose_data, H_ori=H, W_ori=W, bound=1, device=device)
 
   logging.info("pose batch data done")
 
@@ -91,8 +173,9 @@ def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_rati
 
 
 class PoseRefinePredictor:
-  def __init__(self,):
+  def __init__(self, device='cuda'):
     logging.info("welcome")
+    self.device = torch.device(device)
     self.amp = True
     self.run_name = "2023-10-28-18-33-37"
     model_name = 'model_best.pth'
@@ -132,29 +215,132 @@ class PoseRefinePredictor:
     logging.info(f"self.cfg: \n {OmegaConf.to_yaml(self.cfg)}")
 
     self.dataset = PoseRefinePairH5Dataset(cfg=self.cfg, h5_file='', mode='test')
-    self.model = RefineNet(cfg=self.cfg, c_in=self.cfg['c_in']).cuda()
+    self.model = RefineNet(cfg=self.cfg, c_in=self.cfg['c_in']).to(self.device)
 
     logging.info(f"Using pretrained model from {ckpt_dir}")
-    ckpt = torch.load(ckpt_dir)
+    ckpt = torch.load(ckpt_dir, map_location=self.device)
     if 'model' in ckpt:
       ckpt = ckpt['model']
     self.model.load_state_dict(ckpt)
 
-    self.model.cuda().eval()
+    self.model.to(self.device).eval()
     logging.info("init done")
     self.last_trans_update = None
     self.last_rot_update = None
 
 
+  def refine_batch(self, pose_data:BatchPoseData, trans_normalizer, mesh_diameter, bs=1024):
+    '''One refinement step of all hypotheses in pose_data
+    @return: refined poses (B,4,4), last trans_delta, last rot_mat_delta
+    '''
+    B_in_cams = []
+    for b in range(0, pose_data.rgbAs.shape[0], bs):
+      A = torch.cat([pose_data.rgbAs[b:b+bs].to(self.device), pose_data.xyz_mapAs[b:b+bs].to(self.device)], dim=1).float()
+      B = torch.cat([pose_data.rgbBs[b:b+bs].to(self.device), pose_data.xyz_mapBs[b:b+bs].to(self.device)], dim=1).float()
+      logging.info("forward start")
+      with torch.autocast(device_type=self.device.type, enabled=self.amp and self.device.type=='cuda'):
+        output = self.model(A,B)
+      for k in output:
+        output[k] = output[k].float()
+      logging.info("forward done")
+      if self.cfg['trans_rep']=='tracknet':
+        if not self.cfg['normalize_xyz']:
+          trans_delta = torch.tanh(output["trans"])*trans_normalizer
+        else:
+          trans_delta = output["trans"]
+
+      elif self.cfg['trans_rep']=='deepim':
+        def project_and_transform_to_crop(centers):
+          uvs = (pose_data.Ks[b:b+bs]@centers.reshape(-1,3,1)).reshape(-1,3)
+          uvs = uvs/uvs[:,2:3]
+          uvs = (pose_data.tf_to_crops[b:b+bs]@uvs.reshape(-1,3,1)).reshape(-1,3)
+          return uvs[:,:2]
+
+        rot_delta = output["rot"]
+        z_pred = output['trans'][:,2]*pose_data.poseA[b:b+bs][...,2,3]
+        uvA_crop = project_and_transform_to_crop(pose_data.poseA[b:b+bs][...,:3,3])
+        uv_pred_crop = uvA_crop + output['trans'][:,:2]*self.cfg['input_resize'][0]
+        uv_pred = transform_pts(uv_pred_crop, pose_data.tf_to_crops[b:b+bs].inverse().to(self.device))
+        center_pred = torch.cat([uv_pred, torch.ones((len(rot_delta),1), dtype=torch.float, device=self.device)], dim=-1)
+        center_pred = (pose_data.Ks[b:b+bs].inverse().to(self.device)@center_pred.reshape(len(rot_delta),3,1)).reshape(len(rot_delta),3) * z_pred.reshape(len(rot_delta),1)
+        trans_delta = center_pred-pose_data.poseA[b:b+bs][...,:3,3]
+
+      else:
+        trans_delta = output["trans"]
+
+      if self.cfg['rot_rep']=='axis_angle':
+        rot_mat_delta = torch.tanh(output["rot"])*self.cfg['rot_normalizer']
+        rot_mat_delta = so3_exp_map(rot_mat_delta).permute(0,2,1)
+      elif self.cfg['rot_rep']=='6d':
+        rot_mat_delta = rotation_6d_to_matrix(output['rot']).permute(0,2,1)
+      else:
+        raise RuntimeError
+
+      if self.cfg['normalize_xyz']:
+        trans_delta *= (mesh_diameter/2)
+
+      B_in_cam = egocentric_delta_pose_to_pose(pose_data.poseA[b:b+bs], trans_delta=trans_delta, rot_mat_delta=rot_mat_delta)
+      B_in_cams.append(B_in_cam)
+
+    return torch.cat(B_in_cams, dim=0), trans_delta, rot_mat_delta
+
+
+  def bytes_per_hypo(self, H, W):
+    '''Rough device memory needed per hypothesis by make_crop_data_batch_multi + forward, used to pack frames
+    '''
+    h,w = self.cfg['input_resize']
+    return 4*(6*H*W + 12*h*w) + 4*64*h*w
+
+
   @torch.inference_mode()
-  def predict(self, rgb, depth, K, ob_in_cams, xyz_map, normal_map=None, get_vis=False, mesh=None, mesh_tensors=None, glctx=None, mesh_diameter=None, iteration=5):
+  def predict_multi(self, frames, mesh=None, mesh_tensors=None, glctx=None, mesh_diameter=None, iteration=5, mem_budget=4*1024**3):
+    '''Refine the hypotheses of several frames, packing frames into shared render and network batches up to mem_budget bytes
+    @frames: list of dict with rgb (H,W,3), K (3,3), xyz_map (H,W,3), ob_in_cams (N_i,4,4), normal_map (H,W,3) if cfg.use_normal; all frames must have the same H,W
+    @return: list of (N_i,4,4) torch tensors
     '''
-    @rgb: np array (H,W,3)
-    @ob_in_cams: np array (N,4,4)
+    if mesh_tensors is None:
+      mesh_tensors = make_mesh_tensors(mesh, device=self.device)
+    H,W = frames[0]['rgb'].shape[:2]
+    for frame in frames:
+      assert frame['rgb'].shape[:2]==(H,W), 'all frames must have the same size'
+
+    trans_normalizer = self.cfg['trans_normalizer']
+    if not isinstance(trans_normalizer, float):
+      trans_normalizer = torch.as_tensor(list(trans_normalizer), device=self.device, dtype=torch.float).reshape(1,3)
+    bs = 1024
+
+    n_hypos = [len(frame['ob_in_cams']) for frame in frames]
+    groups = split_frames_by_budget(n_hypos, bytes_per_hypo=self.bytes_per_hypo(H, W), mem_budget=mem_budget)
+    logging.info(f'{len(frames)} frames packed into {len(groups)} batches')
+    out = [None]*len(frames)
+    for group in groups:
+      rgbs = torch.stack([torch.as_tensor(frames[i]['rgb'], device=self.device, dtype=torch.float) for i in group], dim=0)
+      xyz_maps = torch.stack([torch.as_tensor(frames[i]['xyz_map'], device=self.device, dtype=torch.float) for i in group], dim=0)
+      normal_maps = None
+      if self.cfg['use_normal']:
+        normal_maps = torch.stack([torch.as_tensor(frames[i]['normal_map'], device=self.device, dtype=torch.float) for i in group], dim=0)
+      Ks = np.stack([np.asarray(frames[i]['K']) for i in group], axis=0)
+      frame_ids = np.concatenate([np.full(n_hypos[i], j) for j,i in enumerate(group)])
+      B_in_cams = torch.cat([torch.as_tensor(frames[i]['ob_in_cams'], device=self.device, dtype=torch.float).reshape(-1,4,4) for i in group], dim=0)
+      for _ in range(iteration):
+        pose_data = make_crop_data_batch_multi(self.cfg.input_resize, B_in_cams, frame_ids, mesh, rgbs, Ks, crop_ratio=self.cfg['crop_ratio'], xyz_maps=xyz_maps, normal_maps=normal_maps, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, mesh_diameter=mesh_diameter, device=self.device)
+        B_in_cams, _, _ = self.refine_batch(pose_data, trans_normalizer=trans_normalizer, mesh_diameter=mesh_diameter, bs=bs)
+      offset = 0
+      for i in group:
+        out[i] = B_in_cams[offset:offset+n_hypos[i]]
+        offset += n_hypos[i]
+    return out
+
+
+  @torch.inference_mode()
+  def predict(self, rgb, depth, K, ob_in_cams, xyz_map, normal_map=None, get_vis=False, mesh=None, mesh_tensors=None, glctx=None, mesh_diameter=None, iteration=5, render_cache:RenderedCropCache=None):
+    '''
+    @rgb: np array (H,W,3) or device tensor
+    @ob_in_cams: np array or device tensor (N,4,4), kept on the device across iterations
+    @render_cache: optional RenderedCropCache of the mesh, shared by the refine iterations
     '''
-    torch.set_default_tensor_type('torch.cuda.FloatTensor')
     logging.info(f'ob_in_cams:{ob_in_cams.shape}')
-    tf_to_center = np.eye(4)
+    tf_to_center = torch.eye(4, device=self.device, dtype=torch.float)
     ob_centered_in_cams = ob_in_cams
     mesh_centered = mesh
 
@@ -166,75 +352,26 @@ class PoseRefinePredictor:
     logging.info(f"trans_normalizer:{self.cfg['trans_normalizer']}, rot_normalizer:{self.cfg['rot_normalizer']}")
     bs = 1024
 
-    B_in_cams = torch.as_tensor(ob_centered_in_cams, device='cuda', dtype=torch.float)
+    B_in_cams = torch.as_tensor(ob_centered_in_cams, device=self.device, dtype=torch.float)
 
 
     if mesh_tensors is None:
-      mesh_tensors = make_mesh_tensors(mesh_centered)
+      mesh_tensors = make_mesh_tensors(mesh_centered, device=self.device)
 
-    rgb_tensor = torch.as_tensor(rgb, device='cuda', dtype=torch.float)
-    depth_tensor = torch.as_tensor(depth, device='cuda', dtype=torch.float)
-    xyz_map_tensor = torch.as_tensor(xyz_map, device='cuda', dtype=torch.float)
+    rgb_tensor = torch.as_tensor(rgb, device=self.device, dtype=torch.float)
+    depth_tensor = torch.as_tensor(depth, device=self.device, dtype=torch.float)
+    xyz_map_tensor = torch.as_tensor(xyz_map, device=self.device, dtype=torch.float)
     trans_normalizer = self.cfg['trans_normalizer']
     if not isinstance(trans_normalizer, float):
-      trans_normalizer = torch.as_tensor(list(trans_normalizer), device='cuda', dtype=torch.float).reshape(1,3)
+      trans_normalizer = torch.as_tensor(list(trans_normalizer), device=self.device, dtype=torch.float).reshape(1,3)
 
     for _ in range(iteration):
       logging.info("making cropped data")
-      pose_data = make_crop_data_batch(self.cfg.input_resize, B_in_cams, mesh_centered, rgb_tensor, depth_tensor, K, crop_ratio=crop_ratio, normal_map=normal_map, xyz_map=xyz_map_tensor, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, mesh_diameter=mesh_diameter)
-      B_in_cams = []
-      for b in range(0, pose_data.rgbAs.shape[0], bs):
-        A = torch.cat([pose_data.rgbAs[b:b+bs].cuda(), pose_data.xyz_mapAs[b:b+bs].cuda()], dim=1).float()
-        B = torch.cat([pose_data.rgbBs[b:b+bs].cuda(), pose_data.xyz_mapBs[b:b+bs].cuda()], dim=1).float()
-        logging.info("forward start")
-        with torch.cuda.amp.autocast(enabled=self.amp):
-          output = self.model(A,B)
-        for k in output:
-          output[k] = output[k].float()
-        logging.info("forward done")
-        if self.cfg['trans_rep']=='tracknet':
-          if not self.cfg['normalize_xyz']:
-            trans_delta = torch.tanh(output["trans"])*trans_normalizer
-          else:
-            trans_delta = output["trans"]
-
-        elif self.cfg['trans_rep']=='deepim':
-          def project_and_transform_to_crop(centers):
-            uvs = (pose_data.Ks[b:b+bs]@centers.reshape(-1,3,1)).reshape(-1,3)
-            uvs = uvs/uvs[:,2:3]
-            uvs = (pose_data.tf_to_crops[b:b+bs]@uvs.reshape(-1,3,1)).reshape(-1,3)
-            return uvs[:,:2]
-
-          rot_delta = output["rot"]
-          z_pred = output['trans'][:,2]*pose_data.poseA[b:b+bs][...,2,3]
-          uvA_crop = project_and_transform_to_crop(pose_data.poseA[b:b+bs][...,:3,3])
-          uv_pred_crop = uvA_crop + output['trans'][:,:2]*self.cfg['input_resize'][0]
-          uv_pred = transform_pts(uv_pred_crop, pose_data.tf_to_crops[b:b+bs].inverse().cuda())
-          center_pred = torch.cat([uv_pred, torch.ones((len(rot_delta),1), dtype=torch.float, device='cuda')], dim=-1)
-          center_pred = (pose_data.Ks[b:b+bs].inverse().cuda()@center_pred.reshape(len(rot_delta),3,1)).reshape(len(rot_delta),3) * z_pred.reshape(len(rot_delta),1)
-          trans_delta = center_pred-pose_data.poseA[b:b+bs][...,:3,3]
-
-        else:
-          trans_delta = output["trans"]
-
-        if self.cfg['rot_rep']=='axis_angle':
-          rot_mat_delta = torch.tanh(output["rot"])*self.cfg['rot_normalizer']
-          rot_mat_delta = so3_exp_map(rot_mat_delta).permute(0,2,1)
-        elif self.cfg['rot_rep']=='6d':
-          rot_mat_delta = rotation_6d_to_matrix(output['rot']).permute(0,2,1)
-        else:
-          raise RuntimeError
-
-        if self.cfg['normalize_xyz']:
-          trans_delta *= (mesh_diameter/2)
-
-        B_in_cam = egocentric_delta_pose_to_pose(pose_data.poseA[b:b+bs], trans_delta=trans_delta, rot_mat_delta=rot_mat_delta)
-        B_in_cams.append(B_in_cam)
-
-      B_in_cams = torch.cat(B_in_cams, dim=0).reshape(len(ob_in_cams),4,4)
+      pose_data = make_crop_data_batch(self.cfg.input_resize, B_in_cams, mesh_centered, rgb_tensor, depth_tensor, K, crop_ratio=crop_ratio, normal_map=normal_map, xyz_map=xyz_map_tensor, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, mesh_diameter=mesh_diameter, device=self.device, render_cache=render_cache)
+      B_in_cams, trans_delta, rot_mat_delta = self.refine_batch(pose_data, trans_normalizer=trans_normalizer, mesh_diameter=mesh_diameter, bs=bs)
+      B_in_cams = B_in_cams.reshape(len(ob_in_cams),4,4)
 
-    B_in_cams_out = B_in_cams@torch.tensor(tf_to_center[None], device='cuda', dtype=torch.float)
-    torch.cuda.empty_cache()
+    B_in_cams_out = B_in_cams@tf_to_center[None]
     self.last_trans_update = trans_delta
     self.last_rot_update = rot_mat_delta
 
@@ -242,7 +379,7 @@ class PoseRefinePredictor:
       logging.info("get_vis...")
       canvas = []
       padding = 2
-      pose_data = make_crop_data_batch(self.cfg.input_resize, torch.as_tensor(ob_centered_in_cams), mesh_centered, rgb, depth, K, crop_ratio=crop_ratio, normal_map=normal_map, xyz_map=xyz_map_tensor, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, mesh_diameter=mesh_diameter)
+      pose_data = make_crop_data_batch(self.cfg.input_resize, torch.as_tensor(ob_centered_in_cams, device=self.device, dtype=torch.float), mesh_centered, rgb, depth, K, crop_ratio=crop_ratio, normal_map=normal_map, xyz_map=xyz_map_tensor, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, mesh_diameter=mesh_diameter, device=self.device)
       for id in range(0, len(B_in_cams)):
         rgbA_vis = (pose_data.rgbAs[id]*255).permute(1,2,0).data.cpu().numpy()
         rgbB_vis = (pose_data.rgbBs[id]*255).permute(1,2,0).data.cpu().numpy()
@@ -266,7 +403,7 @@ class PoseRefinePredictor:
         canvas.append(row)
       canvas = make_grid_image(canvas, nrow=1, padding=padding, pad_value=255)
 
-      pose_data = make_crop_data_batch(self.cfg.input_resize, B_in_cams, mesh_centered, rgb, depth, K, crop_ratio=crop_ratio, normal_map=normal_map, xyz_map=xyz_map_tensor, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, mesh_diameter=mesh_diameter)
+      pose_data = make_crop_data_batch(self.cfg.input_resize, B_in_cams, mesh_centered, rgb, depth, K, crop_ratio=crop_ratio, normal_map=normal_map, xyz_map=xyz_map_tensor, cfg=self.cfg, glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, mesh_diameter=mesh_diameter, device=self.device)
       canvas_refined = []
       for id in range(0, len(B_in_cams)):
         rgbA_vis = (pose_data.rgbAs[id]*255).permute(1,2,0).data.cpu().numpy()
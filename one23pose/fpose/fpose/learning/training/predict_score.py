@@ -54,7 +54,10 @@ def vis_batch_data_scores(pose_data, ids, scores, pad_margin=5):
 
 
 @torch.no_grad()
-def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_ratio, normal_map=None, mesh_diameter=None, glctx=None, mesh_tensors=None, dataset:TripletH5Dataset=None, cfg=None):
+def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_ratio, normal_map=None, mesh_diameter=None, glctx=None, mesh_tensors=None, dataset:TripletH5Dataset=None, cfg=None, device='cuda', render_cache:RenderedCropCache=None):
+  '''
+  @render_cache: optional RenderedCropCache of the mesh, renders only the poses without a cached view
+  '''
   logging.info("Welcome make_crop_data_batch")
   H,W = depth.shape[:2]
 
@@ -64,30 +67,39 @@ def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_rati
   logging.info("make tf_to_crops done")
 
   B = len(ob_in_cams)
-  poseAs = torch.as_tensor(ob_in_cams, dtype=torch.float, device='cuda')
+  poseAs = torch.as_tensor(ob_in_cams, dtype=torch.float, device=device)
 
   bs = 512
-  rgb_rs = []
-  depth_rs = []
-  xyz_map_rs = []
-
-  bbox2d_crop = torch.as_tensor(np.array([0, 0, cfg['input_resize'][0]-1, cfg['input_resize'][1]-1]).reshape(2,2), device='cuda', dtype=torch.float)
+  bbox2d_crop = torch.as_tensor(np.array([0, 0, cfg['input_resize'][0]-1, cfg['input_resize'][1]-1]).reshape(2,2), device=device, dtype=torch.float)
   bbox2d_ori = transform_pts(bbox2d_crop, tf_to_crops.inverse()[:,None]).reshape(-1,4)
 
-  for b in range(0,len(ob_in_cams),bs):
-    extra = {}
-    rgb_r, depth_r, normal_r = nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=poseAs[b:b+bs], context='cuda', get_normal=cfg['use_normal'], glctx=glctx, mesh_tensors=mesh_tensors, output_size=cfg['input_resize'], bbox2d=bbox2d_ori[b:b+bs], use_light=True, extra=extra)
-    rgb_rs.append(rgb_r)
-    depth_rs.append(depth_r[...,None])
-    xyz_map_rs.append(extra['xyz_map'])
-
-  rgb_rs = torch.cat(rgb_rs, dim=0).permute(0,3,1,2) * 255
-  depth_rs = torch.cat(depth_rs, dim=0).permute(0,3,1,2)
-  xyz_map_rs = torch.cat(xyz_map_rs, dim=0).permute(0,3,1,2)  #(B,3,H,W)
+  def render(ids):
+    rgb_rs = []
+    depth_rs = []
+    xyz_map_rs = []
+    for b in range(0,len(ids),bs):
+      extra = {}
+      rgb_r, depth_r, normal_r = nvdiffrast_render(K=K, H=H, W=W, ob_in_cams=poseAs[ids[b:b+bs]], context=torch.device(device).type, get_normal=cfg['use_normal'], glctx=glctx, mesh_tensors=mesh_tensors, output_size=cfg['input_resize'], bbox2d=bbox2d_ori[ids[b:b+bs]], use_light=True, extra=extra)
+      rgb_rs.append(rgb_r)
+      depth_rs.append(depth_r[...,None])
+      xyz_map_rs.append(extra['xyz_map'])
+    return {
+      'rgb': torch.cat(rgb_rs, dim=0).permute(0,3,1,2) * 255,
+      'depth': torch.cat(depth_rs, dim=0).permute(0,3,1,2),
+      'xyz_map': torch.cat(xyz_map_rs, dim=0).permute(0,3,1,2),  #(B,3,H,W)
+    }
+
+  if render_cache is None:
+    crops = render(torch.arange(B, device=device))
+  else:
+    crops = render_cache.render(render, poseAs, tf_to_crops, K=K, mesh_diameter=mesh_diameter, crop_ratio=crop_ratio, out_size=cfg['input_resize'], flags=(cfg['use_normal'],))
+  rgb_rs = crops['rgb']
+  depth_rs = crops['depth']
+  xyz_map_rs = crops['xyz_map']
   logging.info("render done")
 
-  rgbBs = kornia.geometry.transform.warp_perspective(torch.as_tensor(rgb, dtype=torch.float, device='cuda').permute(2,0,1)[None].expand(B,-1,-1,-1), tf_to_crops, dsize=render_size, mode='bilinear', align_corners=False)
-  depthBs = kornia.geometry.transform.warp_perspective(torch.as_tensor(depth, dtype=torch.float, device='cuda')[None,None].expand(B,-1,-1,-1), tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
+  rgbBs = kornia.geometry.transform.warp_perspective(torch.as_tensor(rgb, dtype=torch.float, device=device).permute(2,0,1)[None].expand(B,-1,-1,-1), tf_to_crops, dsize=render_size, mode='bilinear', align_corners=False)
+  depthBs = kornia.geometry.transform.warp_perspective(torch.as_tensor(depth, dtype=torch.float, device=device)[None,None].expand(B,-1,-1,-1), tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
   if rgb_rs.shape[-2:]!=cfg['input_resize']:
     rgbAs = kornia.geometry.transform.warp_perspective(rgb_rs, tf_to_crops, dsize=render_size, mode='bilinear', align_corners=False)
     depthAs = kornia.geometry.transform.warp_perspective(depth_rs, tf_to_crops, dsize=render_size, mode='nearest', align_corners=False)
@@ -103,20 +115,85 @@ def make_crop_data_batch(render_size, ob_in_cams, mesh, rgb, depth, K, crop_rati
   normalAs = None
   normalBs = None
 
-  Ks = torch.as_tensor(K, dtype=torch.float).reshape(1,3,3).expand(len(rgbAs),3,3)
-  mesh_diameters = torch.ones((len(rgbAs)), dtype=torch.float, device='cuda')*mesh_diameter
+  Ks = torch.as_tensor(K, dtype=torch.float, device=device).reshape(1,3,3).expand(len(rgbAs),3,3)
+  mesh_diameters = torch.ones((len(rgbAs)), dtype=torch.float, device=device)*mesh_diameter
 
   pose_data = BatchPoseData(rgbAs=rgbAs, rgbBs=rgbBs, depthAs=depthAs, depthBs=depthBs, normalAs=normalAs, normalBs=normalBs, poseA=poseAs, xyz_mapAs=xyz_mapAs, tf_to_crops=tf_to_crops, Ks=Ks, mesh_diameters=mesh_diameters)
-  pose_data = dataset.transform_batch(pose_data, H_ori=H, W_ori=W, bound=1)
+  pose_data = dataset.transform_batch(pose_data, H_ori=H, W_ori=W, bound=1, device=device)
 
   logging.info("pose batch data done")
 
   return pose_data
 
 
+@torch.no_grad()
+def make_crop_data_batch_multi(render_size, ob_in_cams, frame_ids, mesh, rgbs, depths, Ks, crop_ratio, mesh_diameter=None, glctx=None, mesh_tensors=None, dataset:TripletH5Dataset=None, cfg=None, device='cuda'):
+  '''Same as make_crop_data_batch, but the hypotheses come from several frames of the same size and are rendered together
+  @ob_in_cams: (B,4,4) torch tensor
+  @frame_ids: (B) np array, index of the frame of each hypothesis
+  @rgbs: (N_frame,H,W,3) torch tensor
+  @depths: (N_frame,H,W) torch tensor
+  @Ks: (N_frame,3,3) np array
+  '''
+  logging.info("Welcome make_crop_data_batch_multi")
+  H,W = depths.shape[1:3]
+  tf_to_crops = compute_crop_window_tf_multi(pts=mesh.vertices, H=H, W=W, poses=ob_in_cams, frame_ids=frame_ids, Ks=Ks, crop_ratio=crop_ratio, out_size=(render_size[1], render_size[0]), method='box_3d', mesh_diameter=mesh_diameter)
+
+  B = len(ob_in_cams)
+  poseAs = torch.as_tensor(ob_in_cams, dtype=torch.float, device=device)
+  frame_ids_t = torch.as_tensor(frame_ids, device=device, dtype=torch.long)
+  projection_mats = np.stack([projection_matrix_from_intrinsics(K, height=H, width=W, znear=0.001, zfar=100) for K in Ks])
+  projection_mats = torch.as_tensor(projection_mats, device=device, dtype=torch.float)[frame_ids_t]
+
+  bs = 512
+  rgbAs = []
+  depthAs = []
+  xyz_mapAs = []
+  rgbBs = []
+  depthBs = []
+
+  bbox2d_crop = torch.as_tensor(np.array([0, 0, cfg['input_resize'][0]-1, cfg['input_resize'][1]-1]).reshape(2,2), device=device, dtype=torch.float)
+  bbox2d_ori = transform_pts(bbox2d_crop, tf_to_crops.inverse()[:,None]).reshape(-1,4)
+  rgbs = rgbs.permute(0,3,1,2)
+  depths = depths[:,None]
+
+  for b in range(0,B,bs):
+    extra = {}
+    rgb_r, depth_r, normal_r = nvdiffrast_render(H=H, W=W, ob_in_cams=poseAs[b:b+bs], context=torch.device(device).type, get_normal=cfg['use_normal'], glctx=glctx, mesh_tensors=mesh_tensors, projection_mat=projection_mats[b:b+bs], output_size=cfg['input_resize'], bbox2d=bbox2d_ori[b:b+bs], use_light=True, extra=extra)
+    rgb_r = rgb_r.permute(0,3,1,2) * 255
+    depth_r = depth_r[:,None]
+    xyz_map_r = extra['xyz_map'].permute(0,3,1,2)
+    tfs = tf_to_crops[b:b+bs]
+    if rgb_r.shape[-2:]!=cfg['input_resize']:
+      rgb_r = kornia.geometry.transform.warp_perspective(rgb_r, tfs, dsize=render_size, mode='bilinear', align_corners=False)
+      depth_r = kornia.geometry.transform.warp_perspective(depth_r, tfs, dsize=render_size, mode='nearest', align_corners=False)
+    if xyz_map_r.shape[-2:]!=cfg['input_resize']:
+      xyz_map_r = kornia.geometry.transform.warp_perspective(xyz_map_r, tfs, dsize=render_size, mode='nearest', align_corners=False)
+    rgbAs.append(rgb_r)
+    depthAs.append(depth_r)
+    xyz_mapAs.append(xyz_map_r)
+    ids = frame_ids[b:b+bs]
+    rgbBs.append(warp_frames_to_crops(rgbs, ids, tfs, dsize=render_size, mode='bilinear'))
+    depthBs.append(warp_frames_to_crops(depths, ids, tfs, dsize=render_size, mode='nearest'))
+
+  logging.info("render and warp done")
+
+  Ks_t = torch.as_tensor(np.asarray(Ks), device=device, dtype=torch.float)[frame_ids_t]
+  mesh_diameters = torch.ones((B), dtype=torch.float, device=device)*mesh_diameter
+
+  pose_data = BatchPoseData(rgbAs=torch.cat(rgbAs, dim=0), rgbBs=torch.cat(rgbBs, dim=0), depthAs=torch.cat(depthAs, dim=0), depthBs=torch.cat(depthBs, dim=0), normalAs=None, normalBs=None, poseA=poseAs, xyz_mapAs=torch.cat(xyz_mapAs, dim=0), tf_to_crops=tf_to_crops, Ks=Ks_t, mesh_diameters=mesh_diameters)
+  pose_data = dataset.transform_batch(pose_data, H_ori=H, W_ori=W, bound=1, device=device)
+
+  logging.info("pose batch data done")
+
+  return pose_data
+
+
+
 class ScorePredictor:
-  def __init__(self, amp=True):
+  def __init__(self, amp=True, device='cuda'):
     self.amp = amp
+    self.device = torch.device(device)
     self.run_name = "2024-01-11-20-02-45"
 
     model_name = 'model_best.pth'
@@ -144,25 +221,75 @@ class ScorePredictor:
     logging.info(f"self.cfg: \n {OmegaConf.to_yaml(self.cfg)}")
 
     self.dataset = ScoreMultiPairH5Dataset(cfg=self.cfg, mode='test', h5_file=None, max_num_key=1)
-    self.model = ScoreNetMultiPair(cfg=self.cfg, c_in=self.cfg['c_in']).cuda()
+    self.model = ScoreNetMultiPair(cfg=self.cfg, c_in=self.cfg['c_in']).to(self.device)
 
     logging.info(f"Using pretrained model from {ckpt_dir}")
-    ckpt = torch.load(ckpt_dir)
+    ckpt = torch.load(ckpt_dir, map_location=self.device)
     if 'model' in ckpt:
       ckpt = ckpt['model']
     self.model.load_state_dict(ckpt)
 
-    self.model.cuda().eval()
+    self.model.to(self.device).eval()
     logging.info("init done")
 
 
+  def bytes_per_hypo(self, H, W):
+    '''Rough device memory needed per hypothesis by make_crop_data_batch_multi + forward, used to pack frames
+    '''
+    h,w = self.cfg['input_resize']
+    return 4*(4*H*W + 14*h*w) + 4*64*h*w
+
+
+  @torch.inference_mode()
+  def predict_multi(self, frames, mesh=None, mesh_tensors=None, glctx=None, mesh_diameter=None, mem_budget=4*1024**3):
+    '''Score the hypotheses of several frames, packing frames into shared render and network batches up to mem_budget bytes.
+    Hypotheses still only compete with the ones of their own frame, scores are on the same scale as predict()
+    @frames: list of dict with rgb (H,W,3), depth (H,W), K (3,3), ob_in_cams (N_i,4,4); all frames must have the same H,W
+    @return: list of (N_i) torch tensors
+    '''
+    if mesh_tensors is None:
+      mesh_tensors = make_mesh_tensors(mesh, device=self.device)
+    H,W = frames[0]['depth'].shape[:2]
+    for frame in frames:
+      assert frame['depth'].shape[:2]==(H,W), 'all frames must have the same size'
+
+    n_hypos = [len(frame['ob_in_cams']) for frame in frames]
+    groups = split_frames_by_budget(n_hypos, bytes_per_hypo=self.bytes_per_hypo(H, W), mem_budget=mem_budget)
+    logging.info(f'{len(frames)} frames packed into {len(groups)} batches')
+    out = [None]*len(frames)
+    for group in groups:
+      rgbs = torch.stack([torch.as_tensor(frames[i]['rgb'], device=self.device, dtype=torch.float) for i in group], dim=0)
+      depths = torch.stack([torch.as_tensor(frames[i]['depth'], device=self.device, dtype=torch.float) for i in group], dim=0)
+      Ks = np.stack([np.asarray(frames[i]['K']) for i in group], axis=0)
+      frame_ids = np.concatenate([np.full(n_hypos[i], j) for j,i in enumerate(group)])
+      ob_in_cams = torch.cat([torch.as_tensor(frames[i]['ob_in_cams'], device=self.device, dtype=torch.float).reshape(-1,4,4) for i in group], dim=0)
+      pose_data = make_crop_data_batch_multi(self.cfg.input_resize, ob_in_cams, frame_ids, mesh, rgbs, depths, Ks, crop_ratio=self.cfg['crop_ratio'], glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, cfg=self.cfg, mesh_diameter=mesh_diameter, device=self.device)
+
+      offsets = np.concatenate([[0], np.cumsum([n_hypos[i] for i in group])])
+      ######### Frames with the same num of hypotheses share one forward, the network attends within each frame
+      by_len = defaultdict(list)
+      for j,i in enumerate(group):
+        by_len[n_hypos[i]].append(j)
+      for L, js in by_len.items():
+        ids = torch.as_tensor(np.concatenate([np.arange(offsets[j], offsets[j+1]) for j in js]), device=self.device, dtype=torch.long)
+        A = torch.cat([pose_data.rgbAs[ids], pose_data.xyz_mapAs[ids]], dim=1).float()
+        B = torch.cat([pose_data.rgbBs[ids], pose_data.xyz_mapBs[ids]], dim=1).float()
+        with torch.autocast(device_type=self.device.type, enabled=self.amp and self.device.type=='cuda'):
+          output = self.model(A, B, L=L)
+        scores = output["score_logit"].float().reshape(len(js), L) + 100
+        for k,j in enumerate(js):
+          out[group[j]] = scores[k]
+    return out
+
+
   @torch.inference_mode()
-  def predict(self, rgb, depth, K, ob_in_cams, normal_map=None, get_vis=False, mesh=None, mesh_tensors=None, glctx=None, mesh_diameter=None):
+  def predict(self, rgb, depth, K, ob_in_cams, normal_map=None, get_vis=False, mesh=None, mesh_tensors=None, glctx=None, mesh_diameter=None, render_cache:RenderedCropCache=None):
     '''
     @rgb: np array (H,W,3)
+    @render_cache: optional RenderedCropCache of the mesh
     '''
     logging.info(f"ob_in_cams:{ob_in_cams.shape}")
-    ob_in_cams = torch.as_tensor(ob_in_cams, dtype=torch.float, device='cuda')
+    ob_in_cams = torch.as_tensor(ob_in_cams, dtype=torch.float, device=self.device)
 
     logging.info(f'self.cfg.use_normal:{self.cfg.use_normal}')
     if not self.cfg.use_normal:
@@ -171,12 +298,12 @@ class ScorePredictor:
     logging.info("making cropped data")
 
     if mesh_tensors is None:
-      mesh_tensors = make_mesh_tensors(mesh)
+      mesh_tensors = make_mesh_tensors(mesh, device=self.device)
 
-    rgb = torch.as_tensor(rgb, device='cuda', dtype=torch.float)
-    depth = torch.as_tensor(depth, device='cuda', dtype=torch.float)
+    rgb = torch.as_tensor(rgb, device=self.device, dtype=torch.float)
+    depth = torch.as_tensor(depth, device=self.device, dtype=torch.float)
 
-    pose_data = make_crop_data_batch(self.cfg.input_resize, ob_in_cams, mesh, rgb, depth, K, crop_ratio=self.cfg['crop_ratio'], glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, cfg=self.cfg, mesh_diameter=mesh_diameter)
+    pose_data = make_crop_data_batch(self.cfg.input_resize, ob_in_cams, mesh, rgb, depth, K, crop_ratio=self.cfg['crop_ratio'], glctx=glctx, mesh_tensors=mesh_tensors, dataset=self.dataset, cfg=self.cfg, mesh_diameter=mesh_diameter, device=self.device, render_cache=render_cache)
 
     def find_best_among_pairs(pose_data:BatchPoseData):
       logging.info(f'pose_data.rgbAs.shape[0]: {pose_data.rgbAs.shape[0]}')
@@ -184,12 +311,12 @@ class ScorePredictor:
       scores = []
       bs = pose_data.rgbAs.shape[0]
       for b in range(0, pose_data.rgbAs.shape[0], bs):
-        A = torch.cat([pose_data.rgbAs[b:b+bs].cuda(), pose_data.xyz_mapAs[b:b+bs].cuda()], dim=1).float()
-        B = torch.cat([pose_data.rgbBs[b:b+bs].cuda(), pose_data.xyz_mapBs[b:b+bs].cuda()], dim=1).float()
+        A = torch.cat([pose_data.rgbAs[b:b+bs].to(self.device), pose_data.xyz_mapAs[b:b+bs].to(self.device)], dim=1).float()
+        B = torch.cat([pose_data.rgbBs[b:b+bs].to(self.device), pose_data.xyz_mapBs[b:b+bs].to(self.device)], dim=1).float()
         if pose_data.normalAs is not None:
-          A = torch.cat([A, pose_data.normalAs.cuda().float()], dim=1)
-          B = torch.cat([B, pose_data.normalBs.cuda().float()], dim=1)
-        with torch.cuda.amp.autocast(enabled=self.amp):
+          A = torch.cat([A, pose_data.normalAs.to(self.device).float()], dim=1)
+          B = torch.cat([B, pose_data.normalBs.to(self.device).float()], dim=1)
+        with torch.autocast(device_type=self.device.type, enabled=self.amp and self.device.type=='cuda'):
           output = self.model(A, B, L=len(A))
         scores_cur = output["score_logit"].float().reshape(-1)
         ids.append(scores_cur.argmax()+b)
@@ -199,8 +326,8 @@ class ScorePredictor:
       return ids, scores
 
     pose_data_iter = pose_data
-    global_ids = torch.arange(len(ob_in_cams), device='cuda', dtype=torch.long)
-    scores_global = torch.zeros((len(ob_in_cams)), dtype=torch.float, device='cuda')
+    global_ids = torch.arange(len(ob_in_cams), device=self.device, dtype=torch.long)
+    scores_global = torch.zeros((len(ob_in_cams)), dtype=torch.float, device=self.device)
 
     while 1:
       ids, scores = find_best_among_pairs(pose_data_iter)
@@ -213,7 +340,6 @@ class ScorePredictor:
     scores = scores_global
 
     logging.info(f'forward done')
-    torch.cuda.empty_cache()
 
     if get_vis:
       logging.info("get_vis...")
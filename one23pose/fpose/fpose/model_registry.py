@@ -0,0 +1,127 @@
+import logging
+import threading
+import time
+import psutil
+import torch
+
+
+def _make_scorer(device):
+  from fpose.learning.training.predict_score import ScorePredictor
+  return ScorePredictor(device=device)
+
+
+def _make_refiner(device):
+  from fpose.learning.training.predict_pose_refine import PoseRefinePredictor
+  return PoseRefinePredictor(device=device)
+
+
+def _make_glctx(device):
+  from fpose.Utils import make_rasterizer
+  return make_rasterizer(device)
+
+
+class ModelRegistry:
+  '''Lazily builds and shares heavy FoundationPose objects (scorer, refiner, rasterizer context) per device.
+  Each instance is built once on first request; concurrent requests for the same (name, device) wait for that build.
+  Instances are shared, callers must not run predict() on the same instance from several threads at once.
+  '''
+  def __init__(self, factories=None):
+    '''
+    @factories: dict name -> callable(device), overrides/extends the default scorer/refiner/glctx factories
+    '''
+    self.factories = {
+      'scorer': _make_scorer,
+      'refiner': _make_refiner,
+      'glctx': _make_glctx,
+    }
+    if factories is not None:
+      self.factories.update(factories)
+    self._instances = {}
+    self._stats = {}
+    self._locks = {}
+    self._lock = threading.Lock()
+
+
+  def register_factory(self, name, factory):
+    with self._lock:
+      self.factories[name] = factory
+
+
+  def _key_lock(self, key):
+    with self._lock:
+      if key not in self._locks:
+        self._locks[key] = threading.Lock()
+      return self._locks[key]
+
+
+  def get(self, name, device='cuda'):
+    device = str(device)
+    key = (name, device)
+    instance = self._instances.get(key)
+    if instance is not None:
+      return instance
+
+    with self._key_lock(key):
+      if key in self._instances:
+        return self._instances[key]
+      if name not in self.factories:
+        raise KeyError(f'no factory registered for {name}')
+      process = psutil.Process()
+      use_cuda = device.startswith('cuda') and torch.cuda.is_available()
+      rss_before = process.memory_info().rss
+      cuda_before = torch.cuda.memory_allocated(device) if use_cuda else 0
+      begin = time.time()
+      instance = self.factories[name](device)
+      if use_cuda:
+        torch.cuda.synchronize(device)
+      load_time = time.time()-begin
+      stats = {
+        'load_time': load_time,
+        'rss_bytes': process.memory_info().rss-rss_before,
+        'cuda_bytes': (torch.cuda.memory_allocated(device)-cuda_before) if use_cuda else 0,
+      }
+      self._stats[key] = stats
+      self._instances[key] = instance
+      logging.info(f"loaded {name} on {device} in {load_time:.2f}s, rss:{stats['rss_bytes']/1e6:.1f}MB, cuda:{stats['cuda_bytes']/1e6:.1f}MB")
+      return instance
+
+
+  def scorer(self, device='cuda'):
+    return self.get('scorer', device)
+
+
+  def refiner(self, device='cuda'):
+    return self.get('refiner', device)
+
+
+  def glctx(self, device='cuda'):
+    return self.get('glctx', device)
+
+
+  def stats(self):
+    '''
+    @return: dict (name, device) -> {'load_time': s, 'rss_bytes': host memory delta, 'cuda_bytes': device memory delta}
+    '''
+    with self._lock:
+      return {k: dict(v) for k,v in self._stats.items()}
+
+
+  def clear(self):
+    with self._lock:
+      self._instances.clear()
+      self._stats.clear()
+      self._locks.clear()
+
+
+_default_registry = None
+_default_registry_lock = threading.Lock()
+
+
+def get_model_registry():
+  '''Process-wide registry shared by recover_scale and estimate_poses
+  '''
+  global _default_registry
+  with _default_registry_lock:
+    if _default_registry is None:
+      _default_registry = ModelRegistry()
+    return _default_registry
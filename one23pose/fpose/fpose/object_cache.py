@@ -0,0 +1,158 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+def hash_arrays(*arrays):
+  '''Content hash of a sequence of arrays/scalars, shape and dtype included
+  '''
+  h = hashlib.sha1()
+  for arr in arrays:
+    if arr is None:
+      h.update(b'none')
+      continue
+    arr = np.ascontiguousarray(np.asarray(arr))
+    h.update(f'{arr.dtype}{arr.shape}'.encode())
+    h.update(arr.tobytes())
+  return h.hexdigest()
+
+
+def hash_mesh(mesh, normals=None):
+  '''Hash of the geometry and appearance of a trimesh, i.e. everything reset_object derives from
+  '''
+  arrays = [mesh.vertices, mesh.faces, normals]
+  visual = mesh.visual
+  if hasattr(visual, 'uv') and getattr(visual, 'material', None) is not None and getattr(visual.material, 'image', None) is not None:
+    arrays += [visual.uv, np.asarray(visual.material.image)]
+  else:
+    arrays.append(visual.vertex_colors)
+  return hash_arrays(*arrays)
+
+
+class ObjectCache:
+  '''Two-level (memory LRU + npz on disk) cache for per-object precomputation
+  '''
+  def __init__(self, cache_dir=None, max_items=32, max_bytes=2*1024**3):
+    '''
+    @cache_dir: where npz files are stored, None for memory only
+    @max_bytes: size budget of cache_dir, least recently used files are deleted once it is exceeded
+    '''
+    self.cache_dir = cache_dir
+    if cache_dir is not None:
+      os.makedirs(cache_dir, exist_ok=True)
+    self.max_items = max_items
+    self.max_bytes = max_bytes
+    self._items = OrderedDict()
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+
+  def path(self, name):
+    if self.cache_dir is None:
+      return None
+    return os.path.join(self.cache_dir, name)
+
+
+  def _put(self, key, value):
+    self._items[key] = value
+    self._items.move_to_end(key)
+    while len(self._items)>self.max_items:
+      self._items.popitem(last=False)
+
+
+  def get(self, key, compute_fn, persist=True):
+    '''
+    @compute_fn: callable returning a dict of np arrays, called on miss
+    @persist: also keep the result on disk, only valid for dicts of np arrays
+    '''
+    with self._lock:
+      if key in self._items:
+        self._items.move_to_end(key)
+        self.hits += 1
+        return self._items[key]
+
+    file = self.path(f'{key}.npz') if persist else None
+    value = None
+    if file is not None and os.path.exists(file):
+      try:
+        with np.load(file) as data:
+          value = {k: data[k] for k in data.files}
+        os.utime(file)   # mtime is the last use for eviction
+      except Exception as e:
+        logging.info(f"failed to load {file}: {e}")
+        value = None
+
+    with self._lock:
+      if value is None:
+        self.misses += 1
+      else:
+        self.hits += 1
+
+    if value is None:
+      value = compute_fn()
+      if file is not None:
+        tmp_file = f'{file}.{os.getpid()}.{threading.get_ident()}.tmp.npz'
+        np.savez(tmp_file, **value)
+        os.replace(tmp_file, file)
+        self.evict(keep=file)
+
+    with self._lock:
+      self._put(key, value)
+    return value
+
+
+  def evict(self, keep=None):
+    '''Delete least recently used files of cache_dir until it fits max_bytes
+    @keep: file that is never deleted, e.g. the one just written
+    '''
+    if self.cache_dir is None:
+      return
+    files = []
+    for name in os.listdir(self.cache_dir):
+      path = os.path.join(self.cache_dir, name)
+      if name.endswith('.tmp.npz') or not os.path.isfile(path):
+        continue
+      try:
+        stat = os.stat(path)
+      except OSError:
+        continue   # Removed by another process
+      files.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+      if total<=self.max_bytes:
+        break
+      if path==keep:
+        continue
+      try:
+        os.remove(path)
+        total -= size
+        logging.info(f"object cache evicted {path} ({size/1e6:.1f}MB)")
+      except OSError:
+        pass
+
+
+  def clear(self):
+    with self._lock:
+      self._items.clear()
+      self.hits = 0
+      self.misses = 0
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_object_cache():
+  '''Process-wide cache, stored under $FPOSE_CACHE_DIR (default ~/.cache/fpose) within $FPOSE_CACHE_MAX_BYTES (default 2GB)
+  '''
+  global _default_cache
+  with _default_cache_lock:
+    if _default_cache is None:
+      cache_dir = os.environ.get('FPOSE_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'fpose'))
+      max_bytes = int(os.environ.get('FPOSE_CACHE_MAX_BYTES', 2*1024**3))
+      _default_cache = ObjectCache(cache_dir=cache_dir, max_bytes=max_bytes)
+    return _default_cache
@@ -0,0 +1,82 @@
+from fpose.estimater import *
+from fpose.datareader import *
+from torch.profiler import profile, ProfilerActivity
+import argparse
+
+
+def track_sequence(est, reader, frame_ids, track_refine_iter, staged):
+  '''Track frame_ids[1:] from the registered first frame, with numpy inputs or through est.stage_frame
+  '''
+  frames = [(reader.get_color(i), reader.get_depth(i)) for i in frame_ids]
+  next_staged = est.stage_frame(*frames[1]) if staged and len(frames)>1 else None
+  for j in range(1, len(frames)):
+    color, depth = frames[j]
+    if staged:
+      inputs = next_staged.get()
+      if j+1<len(frames):
+        next_staged = est.stage_frame(*frames[j+1])
+      color, depth = inputs['rgb'], inputs['depth']
+    est.track_one(rgb=color, depth=depth, K=reader.K, iteration=track_refine_iter)
+
+
+def device_idle_time(prof, min_gap_us=10):
+  '''Total time in ms between consecutive device kernels/copies, and the number of gaps above min_gap_us
+  '''
+  ranges = sorted((evt.time_range.start, evt.time_range.end) for evt in prof.events() if evt.device_type==torch.autograd.DeviceType.CUDA)
+  idle = 0
+  n_gaps = 0
+  end = None
+  for start, stop in ranges:
+    if end is not None and start-end>min_gap_us:
+      idle += start-end
+      n_gaps += 1
+    end = stop if end is None else max(end, stop)
+  return idle/1000, n_gaps
+
+
+def count_calls(prof, names):
+  counts = {name: 0 for name in names}
+  for evt in prof.key_averages():
+    if evt.key in counts:
+      counts[evt.key] += evt.count
+  return counts
+
+
+if __name__=='__main__':
+  '''Profile tracking with numpy inputs against stage_frame (pinned buffers on a side stream) and export chrome traces
+  '''
+  parser = argparse.ArgumentParser()
+  code_dir = os.path.dirname(os.path.realpath(__file__))
+  parser.add_argument('--mesh_file', type=str, default=f'{code_dir}/demo_data/mustard/mesh/textured_simple.obj')
+  parser.add_argument('--test_scene_dir', type=str, default=f'{code_dir}/demo_data/mustard')
+  parser.add_argument('--est_refine_iter', type=int, default=5)
+  parser.add_argument('--track_refine_iter', type=int, default=2)
+  parser.add_argument('--max_frames', type=int, default=30)
+  parser.add_argument('--trace_dir', type=str, default=f'{code_dir}/debug/traces')
+  args = parser.parse_args()
+
+  set_logging_format()
+  os.makedirs(args.trace_dir, exist_ok=True)
+  mesh = trimesh.load(args.mesh_file)
+  reader = YcbineoatReader(video_dir=args.test_scene_dir, shorter_side=None, zfar=np.inf)
+  frame_ids = list(range(min(args.max_frames, len(reader.color_files))))
+  est = FoundationPose(model_pts=mesh.vertices, model_normals=mesh.vertex_normals, mesh=mesh, scorer=ScorePredictor(), refiner=PoseRefinePredictor(), glctx=make_rasterizer('cuda'), debug=0)
+
+  sync_calls = ['cudaStreamSynchronize', 'cudaDeviceSynchronize', 'cudaMemcpyAsync', 'cudaFree']
+  print(f"{'inputs':>8} {'track(ms/frame)':>16} {'device idle(ms)':>16} {'gaps':>6} " + ' '.join(f'{name:>22}' for name in sync_calls))
+  for staged in [False, True]:
+    est.register(K=reader.K, rgb=reader.get_color(0), depth=reader.get_depth(0), ob_mask=reader.get_mask(0).astype(bool), iteration=args.est_refine_iter)
+    track_sequence(est, reader, frame_ids[:3], args.track_refine_iter, staged)   # Warm up
+    est.register(K=reader.K, rgb=reader.get_color(0), depth=reader.get_depth(0), ob_mask=reader.get_mask(0).astype(bool), iteration=args.est_refine_iter)
+    torch.cuda.synchronize()
+    with profile(activities=[ProfilerActivity.CPU, ProfilerActivity.CUDA]) as prof:
+      begin = time.time()
+      track_sequence(est, reader, frame_ids, args.track_refine_iter, staged)
+      torch.cuda.synchronize()
+      elapsed = time.time()-begin
+    name = 'staged' if staged else 'numpy'
+    prof.export_chrome_trace(f'{args.trace_dir}/track_{name}.json')
+    idle, n_gaps = device_idle_time(prof)
+    counts = count_calls(prof, sync_calls)
+    print(f"{name:>8} {elapsed*1000/max(len(frame_ids)-1, 1):>16.2f} {idle:>16.2f} {n_gaps:>6} " + ' '.join(f'{counts[k]:>22}' for k in sync_calls))
+  print(f"traces written to {args.trace_dir}")
@@ -11,6 +11,7 @@ import logging
 from one23pose.locate.fit_object_scale import get_scale
 from fpose.estimater import *
 from fpose.datareader import *
+from fpose.model_registry import get_model_registry
 
 def get_all_pose(test_scene_dir, mesh, topic, debug, track_refine_iter=8, est_refine_iter=5):
   set_logging_format()
@@ -23,9 +24,10 @@ def get_all_pose(test_scene_dir, mesh, topic, debug, track_refine_iter=8, est_re
   to_origin, extents = trimesh.bounds.oriented_bounds(mesh)
   bbox = np.stack([-extents/2, extents/2], axis=0).reshape(2,3)
 
-  scorer = ScorePredictor()
-  refiner = PoseRefinePredictor()
-  glctx = dr.RasterizeCudaContext()
+  registry = get_model_registry()
+  scorer = registry.scorer()
+  refiner = registry.refiner()
+  glctx = registry.glctx()
   est = FoundationPose(model_pts=mesh.vertices, model_normals=mesh.vertex_normals, mesh=mesh, scorer=scorer, refiner=refiner, debug_dir=debug_dir, debug=debug, glctx=glctx)
   logging.info("estimator initialization done")
 
@@ -75,9 +77,10 @@ def get_single_pose(raw_img, depth, mask, intrinsic, mesh, topic, num, debug, es
     to_origin, extents = trimesh.bounds.oriented_bounds(mesh)
     bbox = np.stack([-extents/2, extents/2], axis=0).reshape(2,3)
 
-    scorer = ScorePredictor()
-    refiner = PoseRefinePredictor()
-    glctx = dr.RasterizeCudaContext()
+    registry = get_model_registry()
+    scorer = registry.scorer()
+    refiner = registry.refiner()
+    glctx = registry.glctx()
     est = FoundationPose(model_pts=mesh.vertices, model_normals=mesh.vertex_normals, mesh=mesh, scorer=scorer, refiner=refiner, debug_dir=debug_dir, debug=debug, glctx=glctx)
     logging.info("estimator initialization done")
 
@@ -21,6 +21,8 @@ if __name__=='__main__':
   parser.add_argument('--track_refine_iter', type=int, default=2)
   parser.add_argument('--debug', type=int, default=1)
   parser.add_argument('--debug_dir', type=str, default=f'{code_dir}/debug')
+  parser.add_argument('--device', type=str, default='cuda')
+  parser.add_argument('--render_cache_mb', type=int, default=0, help='>0 caches rendered crops of nearby poses')
   args = parser.parse_args()
 
   set_logging_format()
@@ -35,18 +37,24 @@ if __name__=='__main__':
   to_origin, extents = trimesh.bounds.oriented_bounds(mesh)
   bbox = np.stack([-extents/2, extents/2], axis=0).reshape(2,3)
 
-  scorer = ScorePredictor()
-  refiner = PoseRefinePredictor()
-  glctx = dr.RasterizeCudaContext()
-  est = FoundationPose(model_pts=mesh.vertices, model_normals=mesh.vertex_normals, mesh=mesh, scorer=scorer, refiner=refiner, debug_dir=debug_dir, debug=debug, glctx=glctx)
+  scorer = ScorePredictor(device=args.device)
+  refiner = PoseRefinePredictor(device=args.device)
+  glctx = make_rasterizer(args.device)
+  est = FoundationPose(model_pts=mesh.vertices, model_normals=mesh.vertex_normals, mesh=mesh, scorer=scorer, refiner=refiner, debug_dir=debug_dir, debug=debug, glctx=glctx, device=args.device, render_cache_bytes=args.render_cache_mb*1024**2)
   logging.info("estimator initialization done")
 
   reader = YcbineoatReader(video_dir=args.test_scene_dir, shorter_side=None, zfar=np.inf)
 
+  staged = None
+  next_color, next_depth = reader.get_color(0), reader.get_depth(0)
   for i in range(len(reader.color_files)):
     logging.info(f'i:{i}')
-    color = reader.get_color(i)
-    depth = reader.get_depth(i)
+    color, depth = next_color, next_depth
+    staged_cur = staged
+    # Read and start copying the next frame so the transfer overlaps this frame's compute
+    if i+1<len(reader.color_files):
+      next_color, next_depth = reader.get_color(i+1), reader.get_depth(i+1)
+      staged = est.stage_frame(rgb=next_color, depth=next_depth)
     if i==0:
       mask = reader.get_mask(0).astype(bool)
       pose = est.register(K=reader.K, rgb=color, depth=depth, ob_mask=mask, iteration=args.est_refine_iter)
@@ -60,7 +68,8 @@ if __name__=='__main__':
         pcd = toOpen3dCloud(xyz_map[valid], color[valid])
         o3d.io.write_point_cloud(f'{debug_dir}/scene_complete.ply', pcd)
     else:
-      pose = est.track_one(rgb=color, depth=depth, K=reader.K, iteration=args.track_refine_iter)
+      inputs = staged_cur.get()
+      pose = est.track_one(rgb=inputs['rgb'], depth=inputs['depth'], K=reader.K, iteration=args.track_refine_iter)
 
     os.makedirs(f'{debug_dir}/ob_in_cam', exist_ok=True)
     np.savetxt(f'{debug_dir}/ob_in_cam/{reader.id_strs[i]}.txt', pose.reshape(4,4))
@@ -77,3 +86,6 @@ if __name__=='__main__':
       os.makedirs(f'{debug_dir}/track_vis', exist_ok=True)
       imageio.imwrite(f'{debug_dir}/track_vis/{reader.id_strs[i]}.png', vis)
 
+  if est.render_cache is not None:
+    logging.info(f"render cache: {est.render_cache.stats()}")
+
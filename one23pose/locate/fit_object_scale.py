@@ -7,11 +7,11 @@ import cv2
 import sys
 import json
 import torch
-from scipy.optimize import minimize
 from PIL import Image
 os.environ["PYOPENGL_PLATFORM"] = "egl"
 sys.path.append(os.getcwd())
 from one23pose.locate.match_pairs import image_pair_matching
+from one23pose.locate.scale_solver import backproject_points, closest_points_in_view, estimate_scale, compose_scaled_pose
 from pytorch3d.renderer import (look_at_view_transform, PerspectiveCameras,
                                 PointLights, RasterizationSettings, BlendParams,
                                 MeshRenderer, MeshRasterizer, SoftPhongShader)
@@ -69,32 +69,8 @@ def calculate_bbox_from_mask(binary_mask):
     return [xmin, ymin, xmax, ymax]
 
 def select_point(pcd, match_points_on_raw, img_size):
-    points = np.asarray(pcd.points)
-    projection = points / points[:, 2:3]
-    projection = projection[:, :2]
-    # plt.plot(projection[:, 0], projection[:, 1], 'o')
-    # plt.show()
-
-    # bounding box of projection
-    min_x, max_x = np.min(projection[:, 0]), np.max(projection[:, 0])
-    min_y, max_y = np.min(projection[:, 1]), np.max(projection[:, 1])
-
-    # project to image
-    projection[:, 0] = (projection[:, 0] - min_x) / (max_x - min_x) * img_size[1]
-    projection[:, 1] = (projection[:, 1] - min_y) / (max_y - min_y) * img_size[0]
-
     # select points closest to match points
-    closest_points = []
-    for raw_point in match_points_on_raw:
-        distances = np.linalg.norm(projection - raw_point, axis=1)
-        closest_index = np.argmin(distances)
-        closest_points.append(points[closest_index])
-
-    # show the selected points in 3D
-    selected = o3d.geometry.PointCloud()
-    selected.points = o3d.utility.Vector3dVector(closest_points)
-    # o3d.visualization.draw_geometries([pcd, selected])
-    return closest_points
+    return closest_points_in_view(np.asarray(pcd.points), match_points_on_raw, img_size)
 
 def sample_camera_poses(radius, num_samples, num_up_samples=4, device='cpu'):
     '''
@@ -221,22 +197,7 @@ def project_2d_to_3d(image_points, depth, camera_intrinsics, camera_pose):
     :param camera_pose: 4x4 camera pose matrix
     :return: Nx3 array of 3D points in world coordinates
     """
-    fx, fy = camera_intrinsics[0, 0], camera_intrinsics[1, 1]
-    cx, cy = camera_intrinsics[0, 2], camera_intrinsics[1, 2]
-    # Convert image points to normalized device coordinates (NDC)
-    ndc_points = np.zeros((image_points.shape[0], 3))
-    for i, (u, v) in enumerate(image_points):
-        z = depth[int(v), int(u)]
-        x = - (u - cx) * z / fx
-        y = - (v - cy) * z / fy
-        ndc_points[i] = [x, y, z]
-    valid_mask = ndc_points[:, 2] > 0
-    ndc_points = ndc_points[valid_mask]
-    # ndc_points = np.vstack((ndc_points, np.zeros(3), [[0, 0, 0]])) # modified
-    # Convert from camera coordinates to world coordinates
-    ndc_points_homogeneous = np.hstack((ndc_points, np.ones((ndc_points.shape[0], 1))))
-    world_points_homogeneous = ndc_points_homogeneous @ np.linalg.inv(camera_pose)
-    return world_points_homogeneous[:, :3], valid_mask
+    return backproject_points(image_points, depth, camera_intrinsics, camera_pose)
 
 def plot_mesh_with_points(mesh, points, filename):
     fig = plt.figure()
@@ -290,7 +251,7 @@ def fit_plane(pcd, filter_z=1, distance_threshold=0.002):
     field_of_view = np.array([min_x, min_y, max_x, max_y])
     return plane_model, field_of_view
 
-def estimate_pose(mesh_file, pcd_file, ref_img, raw_img, mask_box, out_dir, num_samples=8, num_ups=1, sample_flag = 0, input_pose = np.eye(4)):
+def estimate_pose(mesh_file, pcd_file, ref_img, raw_img, mask_box, out_dir, num_samples=8, num_ups=1, sample_flag = 0, input_pose = np.eye(4), scale_method='lstsq'):
     # load 
     device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
     mesh = trimesh.load(mesh_file)
@@ -375,28 +336,12 @@ def estimate_pose(mesh_file, pcd_file, ref_img, raw_img, mask_box, out_dir, num_
     mesh_points = mesh_points[:, :3]
     pcd_points = select_point(pcd, match_points_on_raw, raw_img.shape)
 
-    def objective(scale, mesh_points, pcd_points, plane_model):
-        transformed_points = scale * mesh_points
-        loss = np.sum(np.sum((transformed_points - pcd_points) ** 2, axis=1))
-        # loss = np.sum(np.linalg.norm(transformed_points - pcd_points, axis=1))
-        # a, b, c, d = plane_model
-        # distances = (a * transformed_points[:, 0] + b * transformed_points[:, 1] +
-        #                   c * transformed_points[:, 2] + d) / np.sqrt(a**2 + b**2 + c**2)
-        # distances *= np.sign(c)
-        # penalty = np.sum(distances[distances > 0] ** 2) * 5
-        return loss # + penalty
-
-    initial_scale = 0.25
-    result = minimize(objective, initial_scale, args=(mesh_points, pcd_points, plane_model), method='L-BFGS-B')
-    optimal_scale = result.x[0]
+    # closed-form (or robust) least squares of scale * mesh_points ~ pcd_points
+    optimal_scale, _ = estimate_scale(mesh_points, pcd_points, method=scale_method)
     # print('Rescale:', optimal_scale)
 
     # combine pose and transformation
-    S = np.array([[optimal_scale, 0, 0, 0],
-                  [0, optimal_scale, 0, 0],
-                  [0, 0, optimal_scale, 0],
-                  [0, 0, 0, 1]])
-    M = np.dot(S, world_2_cam)
+    M = compose_scaled_pose(optimal_scale, world_2_cam)
     # print('final matrix')
     # print(np.array2string(M, separator=', '))
     # print('plane model')
@@ -455,7 +400,7 @@ def rgbd_to_pointcloud(rgb_file, depth_file, intrinsic, out_dir):
                                                         
     return pcd
 
-def get_scale(mesh, depth_file, raw_img, mask_file, out_dir, intrinsic_file, sample_flag=0, input_pose=np.eye(4)):
+def get_scale(mesh, depth_file, raw_img, mask_file, out_dir, intrinsic_file, sample_flag=0, input_pose=np.eye(4), scale_method='lstsq'):
     intrinsic_tensor, intrinsic_numpy = get_intrinsic(intrinsic_file)
 
     pcd = rgbd_to_pointcloud(raw_img, depth_file, intrinsic_tensor, out_dir)
@@ -471,7 +416,7 @@ def get_scale(mesh, depth_file, raw_img, mask_file, out_dir, intrinsic_file, sam
     ref = crop_object_with_mask(raw_img, mask_file)
     cv2.imwrite(ref_img, ref)
     
-    optimal_scale, M, plane_model, field_of_view = estimate_pose(mesh, pcd_file, ref_img, raw_img, mask_box, out_dir, sample_flag=sample_flag, input_pose=input_pose)
+    optimal_scale, M, plane_model, field_of_view = estimate_pose(mesh, pcd_file, ref_img, raw_img, mask_box, out_dir, sample_flag=sample_flag, input_pose=input_pose, scale_method=scale_method)
     return M, intrinsic_numpy, optimal_scale
 
 if __name__ == "__main__":
@@ -52,20 +52,109 @@ import matplotlib.cm as cm
 import torch
 import sys
 import os
+import json
+import hashlib
+import threading
 
 sys.path.append(os.getcwd())
 from one23pose.locate.models.matching import Matching
 from one23pose.locate.models.utils import (make_matching_plot, AverageTimer, read_image,)
 
+class PairMatcher:
+    """ SuperPoint + SuperGlue matcher reused across calls.
+    The reference features are computed once per reference image and the
+    query images go through SuperPoint in batches of batch_size. SuperGlue
+    is batched over queries with the same number of keypoints, so results
+    are identical to matching the pairs one at a time.
+    The matcher is shared between threads: the reference features are returned
+    to the caller and passed to match, only the last one is cached (under a lock).
+    """
+    def __init__(self, config, device=None):
+        self.device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+        self.config = config
+        self.matching = Matching(config).eval().to(self.device)
+        self._lock = threading.Lock()
+        self._cached_ref = (None, None)
+
+    @torch.no_grad()
+    def reference_features(self, ref_image, resize=[-1], resize_float=False):
+        """ SuperPoint features of the reference image, to pass to match """
+        key = (hashlib.sha1(np.ascontiguousarray(ref_image).tobytes()).hexdigest(),
+               ref_image.shape, tuple(resize), resize_float)
+        with self._lock:
+            cached_key, cached_ref = self._cached_ref
+        if key == cached_key:
+            return cached_ref
+        image, inp, scales = read_image(ref_image, self.device, resize, 0, resize_float)
+        pred = self.matching.superpoint({'image': inp})
+        ref = {'image': image, 'inp': inp,
+               'keypoints': pred['keypoints'][0],
+               'scores': pred['scores'][0],
+               'descriptors': pred['descriptors'][0]}
+        with self._lock:
+            self._cached_ref = (key, ref)
+        return ref
+
+    @torch.no_grad()
+    def match(self, input_images, ref, batch_size=8, resize=[-1], resize_float=False):
+        """ Match every image in input_images against the reference features ref
+        (from reference_features)
+        Returns a list of dicts with keypoints0, keypoints1, matches, match_confidence
+        """
+        results = [None] * len(input_images)
+        for begin in range(0, len(input_images), batch_size):
+            ids = list(range(begin, min(begin + batch_size, len(input_images))))
+            inps = [read_image(input_images[i], self.device, resize, 0, resize_float)[1] for i in ids]
+            inp0 = torch.cat(inps, 0)
+            pred0 = self.matching.superpoint({'image': inp0})
+
+            # SuperGlue needs the same number of keypoints across the batch
+            groups = {}
+            for j in range(len(ids)):
+                groups.setdefault(len(pred0['keypoints'][j]), []).append(j)
+            for js in groups.values():
+                n = len(js)
+                data = {
+                    'image0': inp0[js], 'image1': ref['inp'].expand(n, -1, -1, -1),
+                    'keypoints0': torch.stack([pred0['keypoints'][j] for j in js]),
+                    'scores0': torch.stack([pred0['scores'][j] for j in js]),
+                    'descriptors0': torch.stack([pred0['descriptors'][j] for j in js]),
+                    'keypoints1': ref['keypoints'][None].expand(n, -1, -1),
+                    'scores1': ref['scores'][None].expand(n, -1),
+                    'descriptors1': ref['descriptors'][None].expand(n, -1, -1),
+                }
+                pred = self.matching.superglue(data)
+                matches = pred['matches0'].cpu().numpy()
+                conf = pred['matching_scores0'].cpu().numpy()
+                kpts0 = data['keypoints0'].cpu().numpy()
+                kpts1 = ref['keypoints'].cpu().numpy()
+                for b, j in enumerate(js):
+                    results[ids[j]] = {'keypoints0': kpts0[b], 'keypoints1': kpts1,
+                                       'matches': matches[b], 'match_confidence': conf[b]}
+        return results
+
+
+_pair_matchers = {}
+_pair_matchers_lock = threading.Lock()
+
+
+def get_pair_matcher(config, device=None):
+    """ PairMatcher shared by calls with the same config, so the weights are loaded once per process """
+    key = (json.dumps(config, sort_keys=True), device)
+    with _pair_matchers_lock:
+        if key not in _pair_matchers:
+            _pair_matchers[key] = PairMatcher(config, device)
+        return _pair_matchers[key]
+
+
 @torch.no_grad()
 def image_pair_matching(input_images, ref_image, output_dir, resize=[-1], 
                         resize_float=False, superglue='indoor', max_keypoints=1024, 
                         keypoint_threshold=0.005, nms_radius=4, sinkhorn_iterations=20, 
                         match_threshold=0.2, viz=True, fast_viz=False, cache=True, 
-                        show_keypoints=False, viz_extension='png', save=True):
+                        show_keypoints=False, viz_extension='png', save=True,
+                        batch_size=8):
 
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    print('Running inference on device \"{}\"'.format(device))
     config = {
         'superpoint': {
             'nms_radius': nms_radius,
@@ -78,7 +167,10 @@ def image_pair_matching(input_images, ref_image, output_dir, resize=[-1],
             'match_threshold': match_threshold,
         }
     }
-    matching = Matching(config).eval().to(device)
+    matcher = get_pair_matcher(config)
+    matching = matcher.matching
+    device = matcher.device
+    print('Running inference on device \"{}\"'.format(device))
 
     output_dir = Path(output_dir)
     output_dir.mkdir(exist_ok=True, parents=True)
@@ -86,7 +178,21 @@ def image_pair_matching(input_images, ref_image, output_dir, resize=[-1],
     if viz:
         print('Will write visualization images to directory \"{}\"'.format(output_dir))
 
+    if ref_image is None or any(image is None for image in input_images):
+        i = next((i for i, image in enumerate(input_images) if image is None), 'ref')
+        print('Problem reading image pair: {} and ref'.format(i))
+        exit(1)
+
     timer = AverageTimer(newline=True)
+    todo = [i for i in range(len(input_images))
+            if not (cache and (output_dir / 'matches_{}.npz'.format(i)).exists())]
+    batch_preds = {}
+    if todo:
+        ref = matcher.reference_features(ref_image, resize, resize_float)
+        preds = matcher.match([input_images[i] for i in todo], ref, batch_size, resize, resize_float)
+        batch_preds = dict(zip(todo, preds))
+        timer.update('matcher')
+
     match_nums = []
     match_result = []
     for i, image in enumerate(input_images):
@@ -110,24 +216,10 @@ def image_pair_matching(input_images, ref_image, output_dir, resize=[-1],
             timer.update('load_cache')
 
         rot0, rot1 = 0, 0
-        image0, inp0, scales0 = read_image(
-            image, device, resize, rot0, resize_float)
-        image1, inp1, scales1 = read_image(
-            ref_image, device, resize, rot1, resize_float)
-        if image0 is None or image1 is None:
-            print('Problem reading image pair: {} and ref'.format(i))
-            exit(1)
-        timer.update('load_image')
-
         if do_match:
-            pred = matching({'image0': inp0, 'image1': inp1})
-            pred = {k: v[0].cpu().numpy() for k, v in pred.items()}
-            kpts0, kpts1 = pred['keypoints0'], pred['keypoints1']
-            matches, conf = pred['matches0'], pred['matching_scores0']
-            timer.update('matcher')
-
-            out_matches = {'keypoints0': kpts0, 'keypoints1': kpts1,
-                           'matches': matches, 'match_confidence': conf}
+            out_matches = batch_preds[i]
+            kpts0, kpts1 = out_matches['keypoints0'], out_matches['keypoints1']
+            matches, conf = out_matches['matches'], out_matches['match_confidence']
             match_result.append(out_matches)
             if save:
                 np.savez(str(matches_path), **out_matches)
@@ -141,6 +233,8 @@ def image_pair_matching(input_images, ref_image, output_dir, resize=[-1],
         match_nums.append(len(mkpts0))
 
         if do_viz:
+            image0, _, _ = read_image(image, device, resize, rot0, resize_float)
+            image1, _, _ = read_image(ref_image, device, resize, rot1, resize_float)
             color = cm.jet(mconf)
             text = [
                 'SuperGlue',
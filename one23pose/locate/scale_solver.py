@@ -0,0 +1,137 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+def backproject_points(image_points, depth, camera_intrinsics, camera_pose):
+    """
+    Vectorised back-projection of 2D image points to world space, same conventions as project_2d_to_3d.
+
+    :param image_points: Nx2 array of (u, v) image points
+    :param depth: HxW depth map, values <= 0 are treated as invalid
+    :param camera_intrinsics: 3x3 camera intrinsic matrix
+    :param camera_pose: 4x4 camera pose matrix (row-vector convention, pytorch3d)
+    :return: Mx3 array of world points and the N boolean mask of valid points
+    """
+    image_points = np.asarray(image_points).reshape(-1, 2)
+    fx, fy = camera_intrinsics[0, 0], camera_intrinsics[1, 1]
+    cx, cy = camera_intrinsics[0, 2], camera_intrinsics[1, 2]
+    u = image_points[:, 0]
+    v = image_points[:, 1]
+    z = depth[v.astype(int), u.astype(int)]
+    valid_mask = z > 0
+    u, v, z = u[valid_mask], v[valid_mask], z[valid_mask]
+    cam_points = np.stack([-(u - cx) * z / fx, -(v - cy) * z / fy, z, np.ones_like(z)], axis=1)
+    world_points = cam_points @ np.linalg.inv(camera_pose)
+    return world_points[:, :3], valid_mask
+
+
+def closest_points_in_view(points, query_points, img_size):
+    """
+    For every query pixel, the point of the cloud whose projection (stretched to the image size) is closest.
+
+    :param points: Nx3 array of camera space points
+    :param query_points: Mx2 array of (x, y) pixels
+    :param img_size: (height, width, ...) of the image the query points live in
+    :return: Mx3 array of selected points
+    """
+    points = np.asarray(points)
+    projection = points[:, :2] / points[:, 2:3]
+    min_xy = projection.min(axis=0)
+    max_xy = projection.max(axis=0)
+    projection = (projection - min_xy) / (max_xy - min_xy) * np.array([img_size[1], img_size[0]])
+    _, index = cKDTree(projection).query(np.asarray(query_points).reshape(-1, 2), k=1)
+    return points[index]
+
+
+def solve_scale(src_points, dst_points, weights=None):
+    """
+    Closed-form minimiser of sum_i w_i * ||s * src_i - dst_i||^2 over the scalar s.
+
+    :param src_points: Nx3 array of points to be scaled
+    :param dst_points: Nx3 array of target points
+    :param weights: optional N array of non-negative weights
+    :return: scale
+    """
+    src_points = np.asarray(src_points, dtype=np.float64)
+    dst_points = np.asarray(dst_points, dtype=np.float64)
+    if weights is None:
+        weights = np.ones(len(src_points))
+    num = np.sum(weights * np.sum(src_points * dst_points, axis=1))
+    den = np.sum(weights * np.sum(src_points * src_points, axis=1))
+    if den <= 0:
+        raise ValueError("Cannot solve scale from degenerate correspondences.")
+    return num / den
+
+
+def solve_scale_huber(src_points, dst_points, delta=None, num_iterations=20, tol=1e-8):
+    """
+    Huber-robust scale by iteratively reweighted least squares.
+
+    :param delta: Huber threshold on the point residual, defaults to 1.4826 * MAD of the least-squares residuals
+    :return: scale, N boolean inlier mask (residual <= delta)
+    """
+    src_points = np.asarray(src_points, dtype=np.float64)
+    dst_points = np.asarray(dst_points, dtype=np.float64)
+    scale = solve_scale(src_points, dst_points)
+    residuals = np.linalg.norm(scale * src_points - dst_points, axis=1)
+    if delta is None:
+        delta = 1.4826 * np.median(np.abs(residuals - np.median(residuals))) + 1e-12
+    for _ in range(num_iterations):
+        weights = np.minimum(1.0, delta / np.maximum(residuals, 1e-12))
+        new_scale = solve_scale(src_points, dst_points, weights)
+        residuals = np.linalg.norm(new_scale * src_points - dst_points, axis=1)
+        converged = abs(new_scale - scale) <= tol * max(abs(scale), 1e-12)
+        scale = new_scale
+        if converged:
+            break
+    return scale, residuals <= delta
+
+
+def solve_scale_ransac(src_points, dst_points, threshold=None, num_hypotheses=256, seed=0):
+    """
+    RANSAC scale: every correspondence is a one-point minimal sample, all hypotheses are scored at once.
+    The scale is then refit in closed form on the inliers of the best hypothesis.
+
+    :param threshold: inlier threshold on the point residual, defaults to 10% of the median target point norm
+    :param num_hypotheses: number of sampled correspondences, all of them if there are fewer
+    :return: scale, N boolean inlier mask
+    """
+    src_points = np.asarray(src_points, dtype=np.float64)
+    dst_points = np.asarray(dst_points, dtype=np.float64)
+    src_norm2 = np.sum(src_points * src_points, axis=1)
+    usable = np.where(src_norm2 > 0)[0]
+    if len(usable) == 0:
+        raise ValueError("Cannot solve scale from degenerate correspondences.")
+    if threshold is None:
+        threshold = 0.1 * np.median(np.linalg.norm(dst_points, axis=1))
+    if len(usable) > num_hypotheses:
+        usable = np.random.default_rng(seed).choice(usable, num_hypotheses, replace=False)
+    candidates = np.sum(src_points[usable] * dst_points[usable], axis=1) / src_norm2[usable]
+    residuals = np.linalg.norm(candidates[:, None, None] * src_points[None] - dst_points[None], axis=2)
+    inlier_counts = np.sum(residuals <= threshold, axis=1)
+    inliers = residuals[np.argmax(inlier_counts)] <= threshold
+    scale = solve_scale(src_points[inliers], dst_points[inliers])
+    inliers = np.linalg.norm(scale * src_points - dst_points, axis=1) <= threshold
+    return scale, inliers
+
+
+def estimate_scale(src_points, dst_points, method='lstsq', **kwargs):
+    """
+    :param method: 'lstsq' (closed form), 'huber' or 'ransac'
+    :return: scale, N boolean inlier mask
+    """
+    if method == 'lstsq':
+        return solve_scale(src_points, dst_points), np.ones(len(src_points), dtype=bool)
+    if method == 'huber':
+        return solve_scale_huber(src_points, dst_points, **kwargs)
+    if method == 'ransac':
+        return solve_scale_ransac(src_points, dst_points, **kwargs)
+    raise ValueError(f"Unknown scale method {method}.")
+
+
+def compose_scaled_pose(scale, world_2_cam):
+    """
+    :return: M = diag(scale, scale, scale, 1) @ world_2_cam, the matrix returned by get_scale
+    """
+    S = np.diag([scale, scale, scale, 1.0])
+    return S @ world_2_cam
@@ -0,0 +1,77 @@
+import argparse
+import time
+
+import torch
+import trimesh
+
+from trellis.representations.mesh.cube2mesh import MeshExtractResult
+
+
+def subdivide_loop(vertices, faces):
+    """
+    The per-face Python subdivision MeshExtractResult.subdivide used to run, with the midpoint
+    indices offset by the number of original vertices
+    """
+    new_vertices = []
+    new_faces = []
+    vertex_map = {}
+    num_vertices = vertices.shape[0]
+
+    def get_midpoint(v1, v2):
+        edge = tuple(sorted((v1, v2)))
+        if edge not in vertex_map:
+            vertex_map[edge] = num_vertices + len(new_vertices)
+            new_vertices.append((vertices[v1] + vertices[v2]) / 2)
+        return vertex_map[edge]
+
+    for v0, v1, v2 in faces.tolist():
+        a = get_midpoint(v0, v1)
+        b = get_midpoint(v1, v2)
+        c = get_midpoint(v2, v0)
+        new_faces += [[v0, a, c], [v1, b, a], [v2, c, b], [a, b, c]]
+    return torch.cat([vertices, torch.stack(new_vertices)]), torch.tensor(new_faces, dtype=torch.long)
+
+
+def make_mesh(mesh, device):
+    vertices = torch.tensor(mesh.vertices, dtype=torch.float32, device=device)
+    faces = torch.tensor(mesh.faces, dtype=torch.long, device=device)
+    return MeshExtractResult(vertices, faces)
+
+
+def check(device):
+    """Both subdivisions must give the same triangles (vertex numbering of the midpoints may differ)"""
+    for mesh in [trimesh.creation.box(), trimesh.creation.icosphere(subdivisions=2), trimesh.creation.cylinder(radius=0.5, height=1.0)]:
+        result = make_mesh(mesh, device)
+        ref_vertices, ref_faces = subdivide_loop(result.vertices.cpu(), result.faces.cpu())
+        result.subdivide()
+        assert result.vertices.shape == ref_vertices.shape, (result.vertices.shape, ref_vertices.shape)
+        assert torch.equal(result.vertices[result.faces].cpu(), ref_vertices[ref_faces])
+    print('subdivide matches the per-face loop on small meshes')
+
+
+def benchmark(num_faces, device, with_loop):
+    count = int((num_faces / 2) ** 0.5)
+    mesh = trimesh.creation.uv_sphere(count=[count, count])
+    result = make_mesh(mesh, device)
+    print(f'{len(mesh.faces)} faces on {device}')
+    if with_loop:
+        begin = time.time()
+        subdivide_loop(result.vertices.cpu(), result.faces.cpu())
+        print(f'per-face loop: {time.time() - begin:.2f}s')
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    begin = time.time()
+    result.subdivide()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    print(f'vectorised subdivide: {time.time() - begin:.3f}s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_faces', type=int, default=200000)
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--with_loop', action='store_true', help='also time the per-face loop')
+    args = parser.parse_args()
+    check(args.device)
+    benchmark(args.num_faces, args.device, args.with_loop)
@@ -0,0 +1,119 @@
+import argparse
+import time
+
+import numpy as np
+import torch
+import trimesh
+from PIL import Image
+from scipy.spatial import cKDTree
+
+from trellis.pipelines import TrellisImageTo3DPipeline, samplers
+
+SOLVERS = {
+    'euler': samplers.FlowEulerGuidanceIntervalSampler,
+    'heun': samplers.FlowHeunGuidanceIntervalSampler,
+    'midpoint': samplers.FlowMidpointGuidanceIntervalSampler,
+    'dpm': samplers.FlowDPMSolverGuidanceIntervalSampler,
+}
+
+
+def parse_schedule(spec):
+    """
+    solver:ss_steps:slat_steps[:early_exit_tol], e.g. heun:6:12 or dpm:8:12:1e-3
+    """
+    parts = spec.split(':')
+    tol = float(parts[3]) if len(parts) > 3 else None
+    return dict(solver=parts[0], ss_steps=int(parts[1]), slat_steps=int(parts[2]), tol=tol, name=spec)
+
+
+def count_calls(model):
+    """Count the forward passes of a flow model, i.e. the number of function evaluations"""
+    counter = [0]
+
+    def hook(module, input, output):
+        counter[0] += 1
+    handle = model.register_forward_hook(hook)
+    return counter, handle
+
+
+def surface_points(mesh, num_points, seed=0):
+    mesh = trimesh.Trimesh(vertices=mesh.vertices.cpu().numpy(), faces=mesh.faces.cpu().numpy(), process=False)
+    return trimesh.sample.sample_surface(mesh, num_points, seed=seed)[0]
+
+
+def chamfer_distance(points_a, points_b):
+    """Symmetric mean closest-point distance"""
+    dist_ab = cKDTree(points_b).query(points_a, k=1)[0]
+    dist_ba = cKDTree(points_a).query(points_b, k=1)[0]
+    return 0.5 * (dist_ab.mean() + dist_ba.mean())
+
+
+def run_schedule(pipeline, image, schedule, seed, ss_cfg_strength, slat_cfg_strength):
+    """
+    运行一次 TRELLIS，返回网格、耗时与各阶段的模型调用次数
+    """
+    solver = SOLVERS[schedule['solver']]
+    pipeline.sparse_structure_sampler = solver(sigma_min=pipeline.sparse_structure_sampler.sigma_min)
+    pipeline.slat_sampler = solver(sigma_min=pipeline.slat_sampler.sigma_min)
+    ss_params = {'steps': schedule['ss_steps'], 'cfg_strength': ss_cfg_strength}
+    slat_params = {'steps': schedule['slat_steps'], 'cfg_strength': slat_cfg_strength}
+    if schedule['tol'] is not None:
+        ss_params['early_exit_tol'] = schedule['tol']
+        slat_params['early_exit_tol'] = schedule['tol']
+
+    ss_calls, ss_handle = count_calls(pipeline.models['sparse_structure_flow_model'])
+    slat_calls, slat_handle = count_calls(pipeline.models['slat_flow_model'])
+    try:
+        torch.cuda.synchronize()
+        begin = time.time()
+        outputs = pipeline.run(image, seed=seed, formats=['mesh'], preprocess_image=False,
+                               sparse_structure_sampler_params=ss_params, slat_sampler_params=slat_params)
+        torch.cuda.synchronize()
+        elapsed = time.time() - begin
+    finally:
+        ss_handle.remove()
+        slat_handle.remove()
+    return outputs['mesh'][0], elapsed, ss_calls[0], slat_calls[0]
+
+
+if __name__ == '__main__':
+    '''Compare TRELLIS sampling schedules against the 25-step Euler reference mesh
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image', type=str, required=True)
+    parser.add_argument('--pipeline', type=str, default='checkpoints/Trellis')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--ss_cfg_strength', type=float, default=7.5)
+    parser.add_argument('--slat_cfg_strength', type=float, default=15)
+    parser.add_argument('--reference', type=str, default='euler:25:25')
+    parser.add_argument('--schedules', type=str, nargs='+',
+                        default=['euler:12:25', 'euler:12:12', 'heun:6:12', 'midpoint:6:12', 'dpm:12:12', 'dpm:8:8', 'euler:25:25:1e-3'])
+    parser.add_argument('--num_points', type=int, default=100000)
+    args = parser.parse_args()
+
+    pipeline = TrellisImageTo3DPipeline.from_pretrained(args.pipeline)
+    pipeline.cuda()
+    image = pipeline.preprocess_image(Image.open(args.image))
+    default_samplers = pipeline.sparse_structure_sampler, pipeline.slat_sampler
+
+    # warm up kernels so the reference is not penalised
+    run_schedule(pipeline, image, parse_schedule('euler:2:2'), args.seed, args.ss_cfg_strength, args.slat_cfg_strength)
+
+    reference = parse_schedule(args.reference)
+    ref_mesh, ref_time, ref_ss_calls, ref_slat_calls = run_schedule(pipeline, image, reference, args.seed,
+                                                                    args.ss_cfg_strength, args.slat_cfg_strength)
+    ref_points = surface_points(ref_mesh, args.num_points)
+    diameter = np.linalg.norm(ref_points.max(0) - ref_points.min(0))
+
+    print(f"{'schedule':>20} {'ss nfe':>7} {'slat nfe':>9} {'time(s)':>8} {'speedup':>8} {'chamfer':>10} {'chamfer/diam':>13}")
+    print(f"{reference['name']:>20} {ref_ss_calls:>7} {ref_slat_calls:>9} {ref_time:>8.2f} {1:>8.2f} {0:>10.5f} {0:>13.5f}")
+    for spec in args.schedules:
+        schedule = parse_schedule(spec)
+        mesh, elapsed, ss_calls, slat_calls = run_schedule(pipeline, image, schedule, args.seed,
+                                                           args.ss_cfg_strength, args.slat_cfg_strength)
+        if not mesh.success:
+            print(f"{schedule['name']:>20} {ss_calls:>7} {slat_calls:>9} {elapsed:>8.2f} {ref_time / elapsed:>8.2f} {'empty mesh':>10}")
+            continue
+        chamfer = chamfer_distance(surface_points(mesh, args.num_points), ref_points)
+        print(f"{schedule['name']:>20} {ss_calls:>7} {slat_calls:>9} {elapsed:>8.2f} {ref_time / elapsed:>8.2f} {chamfer:>10.5f} {chamfer / diameter:>13.5f}")
+    pipeline.sparse_structure_sampler, pipeline.slat_sampler = default_samplers
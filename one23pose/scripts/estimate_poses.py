@@ -1,46 +1,137 @@
 from fpose.estimater import *
+from fpose.model_registry import get_model_registry
+from one23pose.scripts.result_store import ResultStore
 
-def estimate_poses(npz_path, query_image_names, query_depth_names, query_mask_names, query_intrinsics, scaled_model_path, output_dir, debug=0, est_refine_iter=5):
+def estimate_object_motion(coords_prev, coords_cur, visible, mask_prev, K_prev, extrinsic_prev, min_tracks=8):
+    #rigid motion (4,4) in world coords of the 3D tracks that fall inside the previous object mask, identity (static object)
+    #when too few tracks are visible in both frames. One refit after dropping tracks with residual above 3x the median
+    #coords_*: (N,3) world coords of the tracks, visible: (N,) bool, extrinsic_prev: (4,4) world to camera
+    pts_cam = coords_prev@extrinsic_prev[:3,:3].T+extrinsic_prev[:3,3]
+    z = pts_cam[:,2]
+    uv = np.round((pts_cam@K_prev.T)[:,:2]/np.maximum(z, 1e-6)[:,None]).astype(int)
+    H, W = mask_prev.shape[:2]
+    inside = visible & (z>0.001) & (uv[:,0]>=0) & (uv[:,0]<W) & (uv[:,1]>=0) & (uv[:,1]<H)
+    inside[inside] = mask_prev[uv[inside,1], uv[inside,0]]
+    src = coords_prev[inside]
+    dst = coords_cur[inside]
+    motion = np.eye(4)
+    for _ in range(2):
+        if len(src)<min_tracks:
+            return np.eye(4)
+        src_mean, dst_mean = src.mean(axis=0), dst.mean(axis=0)
+        U, _, Vt = np.linalg.svd((src-src_mean).T@(dst-dst_mean))
+        D = np.diag([1, 1, np.sign(np.linalg.det(Vt.T@U.T))])
+        R = Vt.T@D@U.T
+        motion[:3,:3] = R
+        motion[:3,3] = dst_mean-R@src_mean
+        residual = np.linalg.norm(src@R.T+motion[:3,3]-dst, axis=-1)
+        keep = residual<=3*np.median(residual)+1e-9
+        src, dst = src[keep], dst[keep]
+    return motion
+
+def propagate_pose(pose_prev, extrinsic_prev, extrinsic_cur, object_motion=np.eye(4)):
+    #object pose in the current camera from the previous one, the camera motion and the object motion in world coords
+    return extrinsic_cur@object_motion@np.linalg.inv(extrinsic_prev)@pose_prev
+
+def estimate_poses(result_path, query_image_names, mask_store_path, scaled_model_path, output_dir, debug=0, est_refine_iter=5, track=False, track_refine_iter=2, min_track_iou=0.5, min_track_score=None, hypo_keep_ratio=1.0, warm_start=True, local_max_angle=20, frames_mem_budget=1024**3):
     #estimate the poses of the query images
+    #depths (meters) and intrinsics are read frame by frame from the result store, masks from the mask store;
+    #the overlays are written back to the result store as pose_video/pose_depths
+    #track=True: register on the first frame, then track with a single hypothesis and
+    #re-register whenever the tracked pose's mask IoU (or score, if min_track_score is set) drops below threshold
+    #warm_start=True: the tracked pose starts from the previous pose moved by the tracker's camera and object motion, and
+    #re-registering first refines a local neighbourhood of that pose (register_local), the global grid only when it fails
+    #frames are read when needed; without tracking they are registered in groups of at most frames_mem_budget bytes
     debug_dir = output_dir
     mesh = trimesh.load(scaled_model_path, force='mesh')
     
     to_origin, extents = trimesh.bounds.oriented_bounds(mesh)
     bbox = np.stack([-extents/2, extents/2], axis=0).reshape(2,3)
 
-    scorer = ScorePredictor()
-    refiner = PoseRefinePredictor()
-    glctx = dr.RasterizeCudaContext()
-    est = FoundationPose(model_pts=mesh.vertices, model_normals=mesh.vertex_normals, mesh=mesh, scorer=scorer, refiner=refiner, debug_dir=debug_dir, debug=debug, glctx=glctx)
-    poses = []
+    registry = get_model_registry()
+    scorer = registry.scorer()
+    refiner = registry.refiner()
+    glctx = registry.glctx()
+    est = FoundationPose(model_pts=mesh.vertices, model_normals=mesh.vertex_normals, mesh=mesh, scorer=scorer, refiner=refiner, debug_dir=debug_dir, debug=debug, glctx=glctx, hypo_keep_ratio=hypo_keep_ratio)
+    result_store = ResultStore(result_path, mode='a')
+    mask_store = ResultStore(mask_store_path)
+    n_frames = len(query_image_names)
+
+    def read_frame(frame_id):
+        color = cv2.imread(query_image_names[frame_id])
+        depth = np.array(result_store.frame('depths', frame_id), dtype=np.float32)
+        mask = np.asarray(mask_store.frame('masks', frame_id))>0
+        K = np.array(result_store.frame('intrinsics', frame_id), dtype=np.float64)
+        return dict(K=K, rgb=color, depth=depth, ob_mask=mask)
+
+    warm_start = warm_start and 'extrinsics' in result_store
+    if warm_start:
+        extrinsics = result_store['extrinsics']
+        has_tracks = 'coords' in result_store and 'visibs' in result_store
+        if has_tracks:
+            coords = result_store['coords']
+            visibs = result_store['visibs'].reshape(coords.shape[:2])>0.5
+
+    if track:
+        poses = []
+        staged = None
+        frame_prev = None
+        frame_next = read_frame(0) if n_frames>0 else None
+        for frame_id in range(n_frames):
+            frame = frame_next
+            frame_next = read_frame(frame_id+1) if frame_id+1<n_frames else None
+            color, depth, mask, K = frame['rgb'], frame['depth'], frame['ob_mask'], frame['K']
+            staged_cur = staged
+            #start copying the next frame to the device so the transfer overlaps this frame's compute
+            staged = est.stage_frame(rgb=frame_next['rgb'], depth=frame_next['depth']) if frame_next is not None else None
+            if est.pose_last is not None:
+                inputs = staged_cur.get()
+                pose_init = None
+                if warm_start:
+                    object_motion = np.eye(4)
+                    if has_tracks:
+                        object_motion = estimate_object_motion(coords[frame_id-1], coords[frame_id], visibs[frame_id-1] & visibs[frame_id], frame_prev['ob_mask'], frame_prev['K'], extrinsics[frame_id-1])
+                    pose_init = propagate_pose(poses[-1], extrinsics[frame_id-1], extrinsics[frame_id], object_motion)
+                pose = est.track_one(rgb=inputs['rgb'], depth=inputs['depth'], K=K, iteration=track_refine_iter, pose_init=pose_init)
+                iou = est.compute_mask_iou(K=K, ob_mask=mask)
+                lost = iou<min_track_iou
+                if not lost and min_track_score is not None:
+                    lost = est.score_pose(rgb=inputs['rgb'], depth=inputs['depth'], K=K)<min_track_score
+                if lost and warm_start:
+                    logging.info(f"frame {frame_id}: tracking lost (mask iou:{iou:.3f}), re-registering around the propagated pose")
+                    pose = est.register_local(K=K, rgb=color, depth=depth, ob_mask=mask, pose_init=pose_init, iteration=est_refine_iter, max_angle=local_max_angle, min_score=min_track_score, min_iou=min_track_iou)
+                elif lost:
+                    logging.info(f"frame {frame_id}: tracking lost (mask iou:{iou:.3f}), re-registering")
+                    pose = est.register(K=K, rgb=color, depth=depth, ob_mask=mask, iteration=est_refine_iter)
+            else:
+                pose = est.register(K=K, rgb=color, depth=depth, ob_mask=mask, iteration=est_refine_iter)
+            poses.append(pose.reshape(4, 4))
+            frame_prev = frame
+    else:
+        #register the frames of each group with shared render/network batches
+        poses = []
+        if n_frames>0:
+            frame_bytes = sum(v.nbytes for v in read_frame(0).values())
+            for frame_ids in split_frames_by_budget([1]*n_frames, frame_bytes, frames_mem_budget):
+                group_poses, scores = est.register_multi([read_frame(frame_id) for frame_id in frame_ids], iteration=est_refine_iter)
+                poses += [pose.reshape(4, 4) for pose in group_poses]
+
     rgbs = []
     depths = []
-    for frame_id,query_image_name in enumerate(query_image_names):
-        color = cv2.imread(query_image_name)
-        # depth = reader.get_depth(i)
-        depth = cv2.imread(query_depth_names[frame_id],-1)/1e3
-        # mask = reader.get_mask(0).astype(bool)
-        mask = cv2.imread(query_mask_names[frame_id],-1)
-        K = np.array(query_intrinsics[frame_id])
-        if len(mask.shape)==3:
-            for c in range(3):
-                if mask[...,c].sum()>0:
-                    mask = mask[...,c]
-                    break
-        mask = mask.astype(bool)
-        pose = est.register(K=K, rgb=color, depth=depth, ob_mask=mask, iteration=est_refine_iter)
-        poses.append(pose.reshape(4, 4))
-
+    for frame_id,pose in enumerate(poses):
+        frame = read_frame(frame_id)
         center_pose = pose@np.linalg.inv(to_origin)
-        rgb_vis, dep_vis = draw_posed_3d_box_with_depth(K, img=color, depth=depth, ob_in_cam=center_pose, bbox=bbox)
-        rgb_new, dep_new = draw_xyz_axis_with_depth(rgb_vis, depth=dep_vis, ob_in_cam=center_pose, scale=0.3, K=K, thickness=3, transparency=0, is_input_rgb=True)
+        rgb_vis, dep_vis = draw_posed_3d_box_with_depth(frame['K'], img=frame['rgb'], depth=frame['depth'], ob_in_cam=center_pose, bbox=bbox)
+        rgb_new, dep_new = draw_xyz_axis_with_depth(rgb_vis, depth=dep_vis, ob_in_cam=center_pose, scale=0.3, K=frame['K'], thickness=3, transparency=0, is_input_rgb=True)
         rgb_new = np.transpose(rgb_new, (2, 0, 1))/255
-        rgbs.append(rgb_new)
-        depths.append(dep_new)
-
-    data = dict(np.load(npz_path))
-    # 替换指定字段
-    data['depths'] = depths
-    data['video'] = rgbs
-    np.savez(npz_path, **data)
+        rgbs.append(rgb_new.astype(np.float32))
+        depths.append(np.asarray(dep_new, dtype=np.float32))
+
+    mask_store.close()
+
+    # 不覆盖 tracker 的 depths/video，叠加结果另存
+    result_store.write('poses', np.stack(poses).astype(np.float64))
+    result_store.write('pose_video', np.stack(rgbs))
+    result_store.write('pose_depths', np.stack(depths))
+    result_store.close()
     return poses  # Return the list of estimated poses for each image
\ No newline at end of file
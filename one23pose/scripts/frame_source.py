@@ -0,0 +1,142 @@
+import glob
+import math
+import os
+import re
+import threading
+
+import cv2
+import numpy as np
+import torch
+
+
+class VideoFrameSource:
+    """
+    Decodes a video once into a uint8 (T, H, W, 3) RGB array.
+    Only every stride-th frame is decoded (the others are grabbed and skipped) and decoding stops
+    at max_frames, so memory holds the kept frames only. With cache_dir the array is a memory-mapped
+    .npy file that later stages and processes reopen instead of decoding again.
+    """
+    def __init__(self, video_path, stride=1, max_frames=None, min_side=336, cache_dir=None):
+        self.video_path = video_path
+        self.stride = stride
+        self.max_frames = max_frames
+        self.min_side = min_side
+        self.cache_dir = cache_dir
+        file = self.cached_file()
+        if file is not None and os.path.exists(file):
+            self.frames = np.load(file, mmap_mode='r')
+        else:
+            self.frames = self._decode(file)
+
+    def cached_file(self):
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, f'frames_s{self.stride}_n{self.max_frames or 0}_m{self.min_side}.npy')
+
+    def _resized_size(self, h, w):
+        scale = self.min_side / min(h, w)
+        if scale < 1:
+            return int(h * scale), int(w * scale)
+        return h, w
+
+    def _decode(self, file):
+        cap = cv2.VideoCapture(self.video_path)
+        if not cap.isOpened():
+            raise ValueError(f"Cannot open video: {self.video_path}")
+        count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        h = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        w = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        num_frames = math.ceil(count / self.stride) if count > 0 else (self.max_frames or 0)
+        if self.max_frames is not None:
+            num_frames = min(num_frames, self.max_frames)
+        new_h, new_w = self._resized_size(h, w)
+
+        if file is not None and num_frames > 0:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_file = f'{file}.{os.getpid()}.{threading.get_ident()}.tmp.npy'
+            frames = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.uint8, shape=(num_frames, new_h, new_w, 3))
+        else:
+            tmp_file = None
+            frames = np.empty((num_frames, new_h, new_w, 3), dtype=np.uint8)
+
+        kept = 0
+        index = 0
+        while kept < num_frames:
+            if index % self.stride == 0:
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                if frame.shape[:2] != (new_h, new_w):
+                    frame = cv2.resize(frame, (new_w, new_h), interpolation=cv2.INTER_AREA)
+                frames[kept] = frame
+                kept += 1
+            elif not cap.grab():
+                break
+            index += 1
+        cap.release()
+
+        if tmp_file is None:
+            return frames[:kept]
+        if kept < num_frames:
+            # the container over-reported its frame count, shrink the file to the frames actually decoded
+            trimmed = np.lib.format.open_memmap(f'{tmp_file}.trim.npy', mode='w+', dtype=np.uint8, shape=(kept, new_h, new_w, 3))
+            trimmed[:] = frames[:kept]
+            trimmed.flush()
+            del frames
+            os.replace(f'{tmp_file}.trim.npy', tmp_file)
+        else:
+            frames.flush()
+            del frames
+        os.replace(tmp_file, file)
+        return np.load(file, mmap_mode='r')
+
+    def __len__(self):
+        return len(self.frames)
+
+    def as_tensor(self, device='cpu'):
+        """
+        (T, C, H, W) float32 tensor in [0, 255] on device, the layout load_video_with_opencv returned.
+        The uint8 frames are moved to the device before the conversion, so no float32 copy is made on the host.
+        """
+        return torch.from_numpy(np.ascontiguousarray(self.frames)).to(device).permute(0, 3, 1, 2).float()
+
+
+_frame_sources = {}
+_frame_sources_lock = threading.Lock()
+
+
+def get_frame_source(video_path, stride=1, max_frames=None, min_side=336, cache_dir=None):
+    """
+    Shared VideoFrameSource. A source already decoded with the same stride and a larger frame cap
+    is reused by slicing, so e.g. the offline tracker reuses the frames decoded for the rgb stage.
+    """
+    with _frame_sources_lock:
+        for key in [key for key in _frame_sources if not os.path.exists(key[0])]:
+            del _frame_sources[key]  # session dir was evicted
+        for (path, s, m, n), source in _frame_sources.items():
+            if path == video_path and s == stride and m == min_side and (n is None or (max_frames is not None and n >= max_frames)):
+                if max_frames is None or len(source) <= max_frames:
+                    return source
+                return _SlicedFrameSource(source, max_frames)
+        if cache_dir is not None and max_frames is not None:
+            for file in glob.glob(os.path.join(cache_dir, f'frames_s{stride}_n*_m{min_side}.npy')):
+                n = int(re.search(r'_n(\d+)_m', os.path.basename(file)).group(1))
+                if n == 0 or n >= max_frames:
+                    source = VideoFrameSource(video_path, stride, n or None, min_side, cache_dir)
+                    _frame_sources[(video_path, stride, min_side, n or None)] = source
+                    return _SlicedFrameSource(source, max_frames) if len(source) > max_frames else source
+        source = VideoFrameSource(video_path, stride, max_frames, min_side, cache_dir)
+        _frame_sources[(video_path, stride, min_side, max_frames)] = source
+        return source
+
+
+class _SlicedFrameSource(VideoFrameSource):
+    """First max_frames frames of another source, sharing its memory"""
+    def __init__(self, source, max_frames):
+        self.video_path = source.video_path
+        self.stride = source.stride
+        self.max_frames = max_frames
+        self.min_side = source.min_side
+        self.cache_dir = source.cache_dir
+        self.frames = source.frames[:max_frames]
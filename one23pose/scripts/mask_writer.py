@@ -0,0 +1,132 @@
+import queue
+import subprocess
+import threading
+
+import numpy as np
+import torch
+
+from one23pose.scripts.result_store import ResultStore
+
+
+class FFmpegVideoWriter:
+    """
+    Pipes raw BGR frames into a single ffmpeg H.264 encode, so the video is written once
+    instead of being written as mp4v and transcoded afterwards.
+    """
+    def __init__(self, path, fps, width, height, ffmpeg='/usr/bin/ffmpeg', crf=23, preset='fast'):
+        self.width = width
+        self.height = height
+        command = [
+            ffmpeg,
+            '-loglevel', 'error',
+            '-f', 'rawvideo',
+            '-pix_fmt', 'bgr24',
+            '-s', f'{width}x{height}',
+            '-r', str(fps),
+            '-i', '-',
+            '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2',  # yuv420p needs even sizes
+            '-c:v', 'libx264',
+            '-preset', preset,
+            '-crf', str(crf),
+            '-pix_fmt', 'yuv420p',
+            '-movflags', '+faststart',
+            '-y',
+            path
+        ]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def write(self, frame):
+        if frame.shape != (self.height, self.width, 3):
+            raise ValueError(f"Expected a {self.height}x{self.width} BGR frame, got {frame.shape}")
+        self.process.stdin.write(np.ascontiguousarray(frame, dtype=np.uint8).data)
+
+    def release(self):
+        self.process.stdin.close()
+        ret = self.process.wait()
+        if ret != 0:
+            raise subprocess.CalledProcessError(ret, self.process.args)
+
+
+class SegmentationWriter:
+    """
+    Writes the SAM2 propagation output: a (T, H, W) uint8 'masks' label array in a ResultStore and
+    the colour overlay video.
+
+    Object i (in the order of colors) is stored as 255 - i in the label map and 0 is background,
+    so the first object keeps the value 255 and readers thresholding the mask still get the union
+    of all objects. Where objects overlap the later one wins.
+    Label maps are appended in chunks of chunk_size frames on a background thread, the overlay video
+    goes through FFmpegVideoWriter.
+    """
+    def __init__(self, mask_store_path, video_path, fps, width, height, colors, alpha=0.5, max_queue=32, chunk_size=16):
+        if len(colors) > 254:
+            raise ValueError("At most 254 objects fit in a uint8 label map")
+        self.store = ResultStore(mask_store_path, mode='w')
+        self.store.set_attrs(num_objects=len(colors))
+        self.chunk_size = chunk_size
+        self.num_frames = 0
+        num_labels = len(colors) + 1
+        # label -> stored value
+        self.value_lut = np.zeros(num_labels, dtype=np.uint8)
+        self.value_lut[1:] = 255 - np.arange(len(colors))
+        # overlay = (frame * weight + colour) >> 8, background keeps the frame as is
+        self.weight_lut = np.full(num_labels, 256, dtype=np.uint16)
+        self.weight_lut[1:] = round(256 * (1 - alpha))
+        self.colour_lut = np.zeros((num_labels, 3), dtype=np.uint16)
+        self.colour_lut[1:] = np.round(np.asarray(colors, dtype=np.float64).reshape(-1, 3) * 255 * 256 * alpha)
+
+        self.video_writer = FFmpegVideoWriter(video_path, fps, width, height)
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._error = None
+        self._thread = threading.Thread(target=self._write_masks, daemon=True)
+        self._thread.start()
+
+    def _write_masks(self):
+        chunk = []
+        while True:
+            item = self._queue.get()
+            if item is not None:
+                chunk.append(item)
+            if len(chunk) > 0 and (item is None or len(chunk) == self.chunk_size):
+                try:
+                    if self._error is None:
+                        self.store.append('masks', np.stack(chunk))
+                except Exception as e:
+                    self._error = e
+                chunk = []
+            if item is None:
+                break
+
+    @staticmethod
+    def labels_from_logits(mask_logits, label_ids):
+        """
+        :param mask_logits: (N, 1, H, W) mask logits of the N objects of a frame, on any device
+        :param label_ids: (N,) label (1-based index in colors) of each object, on the same device
+        :return: (H, W) uint8 numpy label map, moved to the CPU in one transfer
+        """
+        masks = mask_logits[:, 0] > 0.0
+        labels = (masks * label_ids[:, None, None]).amax(dim=0)
+        return labels.to(torch.uint8).cpu().numpy()
+
+    def composite(self, frame, labels):
+        """Blend the object colours over a BGR frame with the precomputed LUTs"""
+        weight = self.weight_lut[labels][..., None]
+        colour = self.colour_lut[labels]
+        return ((frame.astype(np.uint16) * weight + colour) >> 8).astype(np.uint8)
+
+    def write(self, frame_idx, frame, labels):
+        if self._error is not None:
+            raise self._error
+        if frame_idx != self.num_frames:
+            raise ValueError(f"Frames must be written in order, expected frame {self.num_frames}, got {frame_idx}")
+        self.num_frames += 1
+        self._queue.put(self.value_lut[labels])
+        self.video_writer.write(self.composite(frame, labels))
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self.store.close()
+        self.video_writer.release()
+        if self._error is not None:
+            raise self._error
@@ -48,6 +48,81 @@ def compute_fov(K, width, height, degrees=False):
 
     return fovx, fovy
 
+def opencv_pose_to_pytorch3d(model_pose):
+    """
+    OpenCV 位姿 (model->camera, [4,4]) 转为 PyTorch3D 的 (R, T)，支持 [N,4,4] 批量输入
+    """
+    model_pose = np.asarray(model_pose, dtype=np.float32).reshape(-1, 4, 4)
+    world_2_cam_render = np.tile(np.eye(4, dtype=np.float32), (len(model_pose), 1, 1))
+    world_2_cam_render[:, :3, :3] = np.linalg.inv(model_pose[:, :3, :3])
+    world_2_cam_render[:, 3, :3] = model_pose[:, :3, 3]
+    world_2_cam_render[:, :, :2] = -world_2_cam_render[:, :, :2]  # PyTorch3D 坐标系适配
+    return world_2_cam_render[:, :3, :3], world_2_cam_render[:, 3, :3]
+
+
+class NormalMapRenderer:
+    """
+    法线图渲染器：模型只加载一次，按批次光栅化多个位姿
+    """
+    def __init__(self, mesh_path, device='cpu', batch_size=8):
+        self.device = device
+        self.batch_size = batch_size
+        self.mesh = load_objs_as_meshes([mesh_path], device=device)
+        self.faces_normals = self.mesh.faces_normals_packed()  # (F, 3)
+        self._rasterizers = {}
+
+    def _get_rasterizer(self, height, width):
+        key = (height, width)
+        if key not in self._rasterizers:
+            raster_settings = RasterizationSettings(
+                image_size=(height, width),
+                blur_radius=0.0,
+                faces_per_pixel=1,
+                bin_size=0,
+            )
+            self._rasterizers[key] = MeshRasterizer(raster_settings=raster_settings)
+        return self._rasterizers[key]
+
+    @torch.no_grad()
+    def render(self, model_poses, Ks, width, height):
+        """
+        :param model_poses: numpy array [N,4,4], 模型到相机坐标的变换矩阵 (OpenCV 格式)
+        :param Ks: numpy array [N,3,3], 每帧的相机内参
+        :return: normal_maps: numpy array of shape (N, H, W, 3) in [0, 255]
+        """
+        Ks = np.asarray(Ks, dtype=np.float32).reshape(-1, 3, 3)
+        R, T = opencv_pose_to_pytorch3d(model_poses)
+        N = len(R)
+        fovx = 2 * np.arctan(width / (2 * Ks[:, 0, 0]))
+        focal_length = torch.as_tensor(0.5 * width / np.tan(fovx / 2), dtype=torch.float32, device=self.device).reshape(N, 1)
+        principal_point = torch.tensor([[width / 2, height / 2]], device=self.device).repeat(N, 1)
+        image_size = torch.tensor([[height, width]], device=self.device).repeat(N, 1)
+
+        cameras = PerspectiveCameras(
+            R=torch.as_tensor(R, device=self.device),
+            T=torch.as_tensor(T, device=self.device),
+            focal_length=focal_length,
+            principal_point=principal_point,
+            image_size=image_size,
+            in_ndc=False,
+            device=self.device
+        )
+        fragments = self._get_rasterizer(height, width)(self.mesh.extend(N), cameras=cameras)
+        pix_to_face = fragments.pix_to_face  # (N, H, W, K)
+        bary_coords = fragments.bary_coords    # (N, H, W, K, 3)
+
+        # Gather face normals of all pixels at once, background pixels get zero normals.
+        # pix_to_face indexes the packed faces of the extended batch, i.e. offset by i*F for pose i
+        mask = (pix_to_face >= 0)[..., None]
+        normals = self.faces_normals[pix_to_face.clamp(min=0) % len(self.faces_normals)] * mask
+        pixel_normals = (normals * bary_coords).sum(dim=3)  # (N, H, W, 3)
+
+        # Normalize and convert to RGB
+        pixel_normals = torch.nn.functional.normalize(pixel_normals, dim=-1)
+        pixel_normals = (pixel_normals + 1.0) / 2.0  # [-1,1] -> [0,1]
+        return (pixel_normals * 255).to(torch.uint8).cpu().numpy()
+
+
 def render_normal_map(mesh_path, model_pose, width=640, height=480, fov=1, device='cpu'):
     """
     渲染指定位姿下的模型法线图
@@ -59,130 +134,83 @@ def render_normal_map(mesh_path, model_pose, width=640, height=480, fov=1, devic
     :param device: 'cpu' or 'cuda'
     :return: normal_map: numpy array of shape (H, W, 3) in [0, 255]
     """
+    fx = 0.5 * width / np.tan(fov / 2)
+    K = np.array([[fx, 0, width / 2], [0, fx, height / 2], [0, 0, 1]])
+    renderer = NormalMapRenderer(mesh_path, device=device)
+    return renderer.render(np.asarray(model_pose)[None], K[None], width, height)[0]
 
-    # ---------------------------
-    # Step 1: Load Mesh
-    # ---------------------------
-    mesh = load_objs_as_meshes([mesh_path], device=device)
-
-    # ---------------------------
-    # Step 2: Convert OpenCV pose to PyTorch3D camera matrix
-    # ---------------------------
-    rotation_matrix = model_pose[:3, :3]
-    tvec = model_pose[:3, 3]
-
-    world_2_cam_render = np.eye(4, dtype=np.float32)
-    world_2_cam_render[:3, :3] = np.linalg.inv(rotation_matrix)
-    world_2_cam_render[3, :3] = tvec
-    world_2_cam_render[:, :2] = -world_2_cam_render[:, :2]  # PyTorch3D 坐标系适配
-
-    camera_pose = torch.tensor(world_2_cam_render, device=device).unsqueeze(0)  # (1, 4, 4)
-
-    R = camera_pose[:, :3, :3]
-    T = camera_pose[:, 3, :3]
-
-    # ---------------------------
-    # Step 3: Setup Camera
-    # ---------------------------
-    focal_length = torch.ones(1, 1, device=device) * 0.5 * width / np.tan(fov / 2)
-    principal_point = torch.tensor([[width / 2, height / 2]], device=device).repeat(1, 1)
-    image_size = torch.tensor([[height, width]], device=device).repeat(1, 1)
-
-    cameras = PerspectiveCameras(
-        R=R,
-        T=T,
-        focal_length=focal_length,
-        principal_point=principal_point,
-        image_size=image_size,
-        in_ndc=False,
-        device=device
-    )
-
-    # ---------------------------
-    # Step 4: Set up Rasterizer
-    # ---------------------------
-    raster_settings = RasterizationSettings(
-        image_size=(height, width),
-        blur_radius=0.0,
-        faces_per_pixel=1,
-        bin_size=0,
-    )
-
-    rasterizer = MeshRasterizer(
-        cameras=cameras,
-        raster_settings=raster_settings
-    )
-
-    # ---------------------------
-    # Step 5: Rasterize and Interpolate Normals
-    # ---------------------------
-    fragments = rasterizer(mesh)
-    pix_to_face = fragments.pix_to_face  # (N, H, W, K)
-    bary_coords = fragments.bary_coords    # (N, H, W, K, 1)
-    mesh_faces_normals = mesh.faces_normals_packed()  # (F, 3)
-
-    N, H, W, K = pix_to_face.shape
-
-    # Flatten for indexing
-    pix_to_face_flat = pix_to_face.view(N, H * W, K)
-    bary_coords_flat = bary_coords.view(N, H * W, K, 3)
-
-    # Get valid normals using face indices
-    mask = pix_to_face_flat >= 0
-    normals = torch.zeros((N, H * W, K, 3), device=device)
-    for i in range(K):
-        valid_idx = pix_to_face_flat[:, :, i][mask[:, :, i]]
-        if len(valid_idx) > 0:
-            normals[:, :, i, :][mask[:, :, i]] = mesh_faces_normals[valid_idx]
-
-    # Interpolate per-pixel normals
-    pixel_normals = (normals * bary_coords_flat).sum(dim=2)  # (N, H*W, 3)
-    pixel_normals = pixel_normals.view(N, H, W, 3)  # (N, H, W, 3)
-
-    # Normalize and convert to RGB
-    pixel_normals = torch.nn.functional.normalize(pixel_normals, dim=-1)
-    pixel_normals = (pixel_normals + 1.0) / 2.0  # [-1,1] -> [0,1]
-    normal_map = (pixel_normals[0].cpu().numpy() * 255).astype(np.uint8)
-
-    return normal_map
-
-def render_normals_to_video(poses, query_image_names, query_intrinsics, scaled_model_path, output_video_path, fps = 15, device='cpu'):
-    video_frames = []
-    
-    for i, pose in enumerate(poses):
-        rgb_path = query_image_names[i]
-        intrinsic = np.array(query_intrinsics[i])
-        pose = np.array(pose)
-        
-        # 读取 RGB 图像
-        rgb_img = cv2.imread(rgb_path)
-        height, width = rgb_img.shape[:2]
-        fovx, fovy = compute_fov(intrinsic, width, height)
-        # 渲染模型法线图
-        normal_map = render_normal_map(scaled_model_path, pose, width=width, height=height, fov=fovx, device=device)
-        
-        # 将法线图叠加到RGB图像上（可选）
-        # 注意：normal_map 应该是 [H, W, 3] 的 numpy 数组
-        alpha = 0.8  # 调整透明度
-        overlay = cv2.addWeighted(normal_map, alpha, rgb_img, 1 - alpha, 0)
-        
-        # 或者直接使用法线图作为输出帧
-        frame = overlay if normal_map is not None else rgb_img
-        
-        # 添加到视频帧列表中
-        video_frames.append(frame)
-
-    # 获取第一帧的尺寸信息
-    height, width, layers = video_frames[0].shape
-    
-    # 定义视频编码器
+
+def render_normals_to_video(poses, query_image_names, query_intrinsics, scaled_model_path, output_video_path, fps = 15, device='cpu', batch_size=8, alpha=0.8):
+    """
+    批量渲染法线图并叠加到 RGB 图像上，逐帧直接写入视频，不在内存中保留所有帧
+    """
+    renderer = NormalMapRenderer(scaled_model_path, device=device, batch_size=batch_size)
     fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    video_writer = cv2.VideoWriter(output_video_path, fourcc, fps, (width, height))
-    
-    # 写入视频帧
-    for frame in video_frames:
-        video_writer.write(frame)
-    
-    # 释放视频写入器
-    video_writer.release()
+    video_writer = None
+
+    for begin in range(0, len(poses), batch_size):
+        ids = range(begin, min(begin + batch_size, len(poses)))
+        rgb_imgs = [cv2.imread(query_image_names[i]) for i in ids]
+        height, width = rgb_imgs[0].shape[:2]
+        if any(img.shape[:2] != (height, width) for img in rgb_imgs):
+            raise ValueError("All frames of a video must have the same size.")
+        Ks = np.stack([np.array(query_intrinsics[i]) for i in ids])
+        normal_maps = renderer.render(np.stack([np.array(poses[i]) for i in ids]), Ks, width, height)
 
+        if video_writer is None:
+            video_writer = cv2.VideoWriter(output_video_path, fourcc, fps, (width, height))
+        for normal_map, rgb_img in zip(normal_maps, rgb_imgs):
+            # 将法线图叠加到RGB图像上
+            overlay = cv2.addWeighted(normal_map, alpha, rgb_img, 1 - alpha, 0)
+            video_writer.write(overlay)
+
+    if video_writer is not None:
+        video_writer.release()
+
+
+def benchmark(mesh_path, num_frames=300, width=640, height=480, batch_size=8, device='cpu', output_dir='/tmp/render_normals_benchmark'):
+    """
+    在 num_frames 个环绕位姿上比较逐帧 render_normal_map 与批量 render_normals_to_video 的耗时
+    """
+    import time
+    os.makedirs(output_dir, exist_ok=True)
+    rgb_path = os.path.join(output_dir, 'background.png')
+    cv2.imwrite(rgb_path, np.full((height, width, 3), 127, dtype=np.uint8))
+
+    mesh = load_objs_as_meshes([mesh_path], device='cpu')
+    verts = mesh.verts_packed().numpy()
+    center = (verts.max(0) + verts.min(0)) / 2
+    radius = np.linalg.norm(verts.max(0) - verts.min(0))
+    fx = 1.2 * width
+    K = np.array([[fx, 0, width / 2], [0, fx, height / 2], [0, 0, 1]])
+    poses = []
+    for angle in np.linspace(0, 2 * np.pi, num_frames, endpoint=False):
+        pose = np.eye(4)
+        pose[:3, :3] = cv2.Rodrigues(np.array([0, angle, 0], dtype=np.float64))[0]
+        pose[:3, 3] = -pose[:3, :3] @ center + np.array([0, 0, 2 * radius])
+        poses.append(pose)
+
+    begin = time.time()
+    render_normals_to_video(poses, [rgb_path] * num_frames, [K] * num_frames, mesh_path,
+                            os.path.join(output_dir, 'batched.mp4'), device=device, batch_size=batch_size)
+    batched_time = time.time() - begin
+
+    fov = compute_fov(K, width, height)[0]
+    begin = time.time()
+    for pose in poses:
+        render_normal_map(mesh_path, pose, width=width, height=height, fov=fov, device=device)
+    per_frame_time = time.time() - begin
+    print(f'{num_frames} frames, batched video: {batched_time:.2f}s, per-frame render_normal_map: {per_frame_time:.2f}s')
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mesh_path', type=str, required=True)
+    parser.add_argument('--num_frames', type=int, default=300)
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=480)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--device', type=str, default='cpu')
+    args = parser.parse_args()
+    benchmark(args.mesh_path, args.num_frames, args.width, args.height, args.batch_size, args.device)
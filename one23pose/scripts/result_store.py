@@ -0,0 +1,202 @@
+import json
+import os
+import struct
+
+import numpy as np
+
+MAGIC = b'O23RSLT1'
+HEADER_SIZE = 64
+ALIGNMENT = 64
+_HEADER = struct.Struct('<8sQQ')
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+class ResultStore:
+    """
+    Chunked, memory-mappable container of named arrays in a single file, replacing result.npz,
+    the per-frame depth PNGs and the intrinsics/poses JSON files.
+
+    Layout: a 64-byte header (magic, index offset, index length), 64-byte aligned data chunks and a
+    json index. Every array is a list of chunks along its first axis, so frames can be appended and
+    read one at a time through a memmap without loading the rest of the file. Every change writes a
+    new index after the current end of the file before the header is pointed at it, so an interrupted
+    append leaves the previous state readable (in-place replacements overwrite their old data).
+
+    mode: 'r' read only, 'a' read/write (created if missing), 'w' truncate and write
+    """
+    def __init__(self, path, mode='r'):
+        if mode not in ('r', 'a', 'w'):
+            raise ValueError(f"Unknown mode {mode}")
+        self.path = path
+        self.mode = mode
+        if mode == 'w' or (mode == 'a' and not os.path.exists(path)):
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(b'\0' * HEADER_SIZE)
+            self._index = {'arrays': {}, 'attrs': {}}
+            self._file = open(path, 'r+b')
+            self._end = HEADER_SIZE
+            self._flush_index()
+        else:
+            self._file = open(path, 'rb' if mode == 'r' else 'r+b')
+            magic, index_offset, index_length = _HEADER.unpack(self._file.read(_HEADER.size))
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not a result store")
+            self._file.seek(index_offset)
+            self._index = json.loads(self._file.read(index_length))
+            self._end = os.path.getsize(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def keys(self):
+        return list(self._index['arrays'].keys())
+
+    def __contains__(self, name):
+        return name in self._index['arrays']
+
+    def __getitem__(self, name):
+        return self.read(name)
+
+    @property
+    def attrs(self):
+        """json-serialisable metadata, saved with set_attrs"""
+        return dict(self._index['attrs'])
+
+    def set_attrs(self, **attrs):
+        self._check_writable()
+        self._index['attrs'].update(attrs)
+        self._flush_index()
+
+    def shape(self, name):
+        return tuple(self._entry(name)['shape'])
+
+    def dtype(self, name):
+        return np.dtype(self._entry(name)['dtype'])
+
+    def __len__(self):
+        return len(self._index['arrays'])
+
+    def num_frames(self, name):
+        return self.shape(name)[0]
+
+    def _entry(self, name):
+        if name not in self._index['arrays']:
+            raise KeyError(f"{name} not in {self.path}")
+        return self._index['arrays'][name]
+
+    def _check_writable(self):
+        if self.mode == 'r':
+            raise IOError(f"{self.path} is opened read only")
+
+    def _write_bytes(self, array, offset=None):
+        if offset is None:
+            offset = _align(self._end)
+        self._file.seek(offset)
+        if array.nbytes > 0:
+            self._file.write(memoryview(array.reshape(-1)).cast('B'))
+        self._end = max(self._end, offset + array.nbytes)
+        return offset
+
+    def _flush_index(self):
+        data = json.dumps(self._index).encode('utf-8')
+        offset = self._end
+        self._file.seek(offset)
+        self._file.write(data)
+        self._end = offset + len(data)
+        self._file.flush()
+        self._file.seek(0)
+        self._file.write(_HEADER.pack(MAGIC, offset, len(data)))
+        self._file.flush()
+
+    def _chunk_view(self, entry, chunk):
+        shape = (chunk['length'],) + tuple(entry['shape'][1:])
+        if chunk['length'] == 0:
+            return np.empty(shape, dtype=entry['dtype'])
+        return np.memmap(self.path, dtype=entry['dtype'], mode='r', offset=chunk['offset'], shape=shape)
+
+    def read(self, name):
+        """The whole array, a read-only memmap when it is stored in a single chunk"""
+        entry = self._entry(name)
+        if len(entry['shape']) == 0:
+            chunk = entry['chunks'][0]
+            return np.memmap(self.path, dtype=entry['dtype'], mode='r', offset=chunk['offset'], shape=(1,))[0]
+        chunks = [self._chunk_view(entry, chunk) for chunk in entry['chunks']]
+        if len(chunks) == 1:
+            return chunks[0]
+        if len(chunks) == 0:
+            return np.empty(entry['shape'], dtype=entry['dtype'])
+        return np.concatenate(chunks)
+
+    def frame(self, name, index):
+        """Lazily read frame `index` (along the first axis), only its chunk is mapped"""
+        entry = self._entry(name)
+        num_frames = entry['shape'][0]
+        if index < 0:
+            index += num_frames
+        if not 0 <= index < num_frames:
+            raise IndexError(f"frame {index} out of range for {name} with {num_frames} frames")
+        start = 0
+        for chunk in entry['chunks']:
+            if index < start + chunk['length']:
+                return self._chunk_view(entry, chunk)[index - start]
+            start += chunk['length']
+
+    def frames(self, name):
+        """Iterate over the frames of an array, one chunk mapped at a time"""
+        entry = self._entry(name)
+        for chunk in entry['chunks']:
+            view = self._chunk_view(entry, chunk)
+            for frame in view:
+                yield frame
+
+    def write(self, name, array):
+        """
+        Create or replace an array. A replacement that fits in the space of the stored single-chunk
+        array is written in place, otherwise the array is written at the end of the file.
+        """
+        self._check_writable()
+        array = np.ascontiguousarray(array)
+        entry = self._index['arrays'].get(name)
+        offset = None
+        if entry is not None and len(entry['chunks']) == 1 and entry['chunks'][0]['capacity'] >= array.nbytes:
+            offset = entry['chunks'][0]['offset']
+            capacity = entry['chunks'][0]['capacity']
+        else:
+            capacity = array.nbytes
+        offset = self._write_bytes(array, offset)
+        self._index['arrays'][name] = {
+            'dtype': array.dtype.str,
+            'shape': list(array.shape),
+            'chunks': [{'offset': offset, 'length': array.shape[0] if array.ndim > 0 else 1, 'capacity': capacity}],
+        }
+        self._flush_index()
+
+    def append(self, name, frames):
+        """Append frames along the first axis as a new chunk, creating the array if needed"""
+        self._check_writable()
+        frames = np.ascontiguousarray(frames)
+        if frames.ndim == 0:
+            raise ValueError("Can only append arrays with a frame axis")
+        entry = self._index['arrays'].get(name)
+        if entry is None:
+            entry = {'dtype': frames.dtype.str, 'shape': [0] + list(frames.shape[1:]), 'chunks': []}
+            self._index['arrays'][name] = entry
+        elif np.dtype(entry['dtype']) != frames.dtype or list(frames.shape[1:]) != entry['shape'][1:]:
+            raise ValueError(f"Cannot append {frames.dtype} {frames.shape[1:]} frames to {name} "
+                             f"of {entry['dtype']} {entry['shape'][1:]}")
+        offset = self._write_bytes(frames)
+        entry['chunks'].append({'offset': offset, 'length': frames.shape[0], 'capacity': frames.nbytes})
+        entry['shape'][0] += frames.shape[0]
+        self._flush_index()
@@ -0,0 +1,158 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+LAST_USED_FILE = '.last_used'
+META_FILE = 'meta.json'
+
+
+def hash_file(path, chunk_size=1 << 20):
+    """sha1 of a file's content"""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def hash_params(**params):
+    """sha1 of json-serialisable stage parameters, upstream stage keys included"""
+    return hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def dir_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def touch(path):
+    """Mark a cache entry or session dir as used now"""
+    with open(os.path.join(path, LAST_USED_FILE), 'w') as f:
+        f.write(str(time.time()))
+
+
+def last_used(path):
+    marker = os.path.join(path, LAST_USED_FILE)
+    return os.path.getmtime(marker if os.path.exists(marker) else path)
+
+
+class StageCache:
+    """
+    Content-addressed cache of pipeline stage outputs.
+    An entry is the set of artifacts (files/dirs relative to the session dir) a stage produced,
+    stored under root/stage/key. Entries and session dirs are evicted least recently used first
+    once their total size exceeds max_bytes; anything used within min_age seconds is kept.
+    """
+    def __init__(self, root, max_bytes=20 * 1024 ** 3, sessions_root=None, min_age=600):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.sessions_root = sessions_root
+        self.min_age = min_age
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def entry_dir(self, stage, key):
+        return os.path.join(self.root, stage, key)
+
+    def load(self, stage, key, session_dir):
+        """
+        Copy the artifacts of a cached entry into session_dir
+        :return: the meta dict stored with the entry, None on miss
+        """
+        entry = self.entry_dir(stage, key)
+        meta_file = os.path.join(entry, META_FILE)
+        if not os.path.exists(meta_file):
+            return None
+        with self._lock:
+            try:
+                with open(meta_file, 'r') as f:
+                    meta = json.load(f)
+                for rel_path in meta['artifacts']:
+                    src = os.path.join(entry, 'files', rel_path)
+                    dst = os.path.join(session_dir, rel_path)
+                    if os.path.isdir(src):
+                        shutil.copytree(src, dst, dirs_exist_ok=True)
+                    else:
+                        os.makedirs(os.path.dirname(dst), exist_ok=True)
+                        shutil.copy2(src, dst)
+                touch(entry)
+            except (OSError, KeyError, ValueError) as e:
+                logger.warning(f"Failed to load {stage} cache entry {key}: {e}")
+                return None
+        logger.info(f"Stage cache hit: {stage} {key}")
+        return meta
+
+    def save(self, stage, key, session_dir, artifacts, **meta):
+        """
+        :param artifacts: paths relative to session_dir making up the stage output
+        :param meta: extra json-serialisable values returned by load, e.g. output paths
+        """
+        entry = self.entry_dir(stage, key)
+        tmp_entry = f'{entry}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with self._lock:
+            try:
+                shutil.rmtree(tmp_entry, ignore_errors=True)
+                for rel_path in artifacts:
+                    src = os.path.join(session_dir, rel_path)
+                    dst = os.path.join(tmp_entry, 'files', rel_path)
+                    if os.path.isdir(src):
+                        shutil.copytree(src, dst)
+                    else:
+                        os.makedirs(os.path.dirname(dst), exist_ok=True)
+                        shutil.copy2(src, dst)
+                with open(os.path.join(tmp_entry, META_FILE), 'w') as f:
+                    json.dump({**meta, 'artifacts': list(artifacts)}, f)
+                touch(tmp_entry)
+                shutil.rmtree(entry, ignore_errors=True)
+                os.replace(tmp_entry, entry)
+            except OSError as e:
+                logger.warning(f"Failed to save {stage} cache entry {key}: {e}")
+                shutil.rmtree(tmp_entry, ignore_errors=True)
+                return
+        self.evict()
+
+    def _candidates(self):
+        candidates = []
+        for stage in os.listdir(self.root):
+            stage_dir = os.path.join(self.root, stage)
+            if not os.path.isdir(stage_dir):
+                continue
+            for key in os.listdir(stage_dir):
+                if key.endswith('.tmp'):
+                    continue
+                candidates.append(os.path.join(stage_dir, key))
+        if self.sessions_root is not None and os.path.isdir(self.sessions_root):
+            for name in os.listdir(self.sessions_root):
+                path = os.path.join(self.sessions_root, name)
+                if name.startswith('session_') and os.path.isdir(path):
+                    candidates.append(path)
+        return candidates
+
+    def evict(self):
+        """Delete least recently used entries/sessions until the total size fits max_bytes"""
+        with self._lock:
+            candidates = [(last_used(p), dir_size(p), p) for p in self._candidates()]
+            total = sum(size for _, size, _ in candidates)
+            now = time.time()
+            for used, size, path in sorted(candidates):
+                if total <= self.max_bytes:
+                    break
+                if now - used < self.min_age:
+                    continue
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+                logger.info(f"Stage cache evicted {path} ({size / 1e6:.1f}MB)")
@@ -1,2 +1,7 @@
 from .base import Sampler
-from .flow_euler import FlowEulerSampler, FlowEulerCfgSampler, FlowEulerGuidanceIntervalSampler
\ No newline at end of file
+from .flow_euler import FlowEulerSampler, FlowEulerCfgSampler, FlowEulerGuidanceIntervalSampler
+from .flow_solvers import (
+    FlowHeunSampler, FlowHeunCfgSampler, FlowHeunGuidanceIntervalSampler,
+    FlowMidpointSampler, FlowMidpointCfgSampler, FlowMidpointGuidanceIntervalSampler,
+    FlowDPMSolverSampler, FlowDPMSolverCfgSampler, FlowDPMSolverGuidanceIntervalSampler,
+)
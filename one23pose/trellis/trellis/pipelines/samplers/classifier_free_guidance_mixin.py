@@ -1,12 +1,59 @@
 from typing import *
+import torch
+import trellis.modules.sparse as sp
+
+
+def _cat_cfg_batch(cond, neg_cond):
+    """
+    Concatenate conditional and unconditional inputs along the batch dimension.
+    A dense neg_cond with batch size 1 is broadcast to the batch size of cond.
+    Returns None if the inputs cannot be batched.
+    """
+    if isinstance(cond, sp.SparseTensor) and isinstance(neg_cond, sp.SparseTensor):
+        return sp.sparse_cat([cond, neg_cond])
+    if isinstance(cond, torch.Tensor) and isinstance(neg_cond, torch.Tensor):
+        if neg_cond.shape[0] == 1 and cond.shape[0] > 1:
+            neg_cond = neg_cond.expand(cond.shape[0], *neg_cond.shape[1:])
+        if neg_cond.shape != cond.shape:
+            return None
+        return torch.cat([cond, neg_cond], dim=0)
+    return None
+
+
+def _split_cfg_batch(x_t, pred):
+    """
+    Split a batched prediction back into its conditional and unconditional halves.
+    Sparse predictions reuse the coords and layout of x_t.
+    """
+    if isinstance(x_t, sp.SparseTensor):
+        n = x_t.feats.shape[0]
+        return x_t.replace(pred.feats[:n]), x_t.replace(pred.feats[n:])
+    n = x_t.shape[0]
+    return pred[:n], pred[n:]
 
 
 class ClassifierFreeGuidanceSamplerMixin:
     """
     A mixin class for samplers that apply classifier-free guidance.
+
+    If the sampler has `batched_cfg` set, the conditional and unconditional predictions
+    are computed in a single forward pass over the concatenated batch.
     """
 
-    def _inference_model(self, model, x_t, t, cond, neg_cond, cfg_strength, **kwargs):
+    def _cfg_inference_model(self, model, x_t, t, cond, neg_cond, **kwargs):
+        """
+        Returns the conditional and unconditional predictions.
+        """
+        if getattr(self, 'batched_cfg', False):
+            batched_cond = _cat_cfg_batch(cond, neg_cond)
+            if batched_cond is not None:
+                batched_x_t = _cat_cfg_batch(x_t, x_t)
+                pred = super()._inference_model(model, batched_x_t, t, batched_cond, **kwargs)
+                return _split_cfg_batch(x_t, pred)
         pred = super()._inference_model(model, x_t, t, cond, **kwargs)
         neg_pred = super()._inference_model(model, x_t, t, neg_cond, **kwargs)
+        return pred, neg_pred
+
+    def _inference_model(self, model, x_t, t, cond, neg_cond, cfg_strength, **kwargs):
+        pred, neg_pred = self._cfg_inference_model(model, x_t, t, cond, neg_cond, **kwargs)
         return (1 + cfg_strength) * pred - cfg_strength * neg_pred
@@ -9,18 +9,29 @@ from .guidance_interval_mixin import GuidanceIntervalSamplerMixin
 import trellis.modules.sparse as sp
 from trellis.modules.spatial import patchify, unpatchify
 
+
+def _relative_change(x, x_ref):
+    if isinstance(x, sp.SparseTensor):
+        x, x_ref = x.feats, x_ref.feats
+    return ((x - x_ref).norm() / x_ref.norm().clamp_min(1e-12)).item()
+
+
 class FlowEulerSampler(Sampler):
     """
     Generate samples from a flow-matching model using Euler sampling.
 
     Args:
         sigma_min: The minimum scale of noise in flow.
+        batched_cfg: If True, classifier-free guidance samplers run the conditional and
+            unconditional predictions in one forward pass over the concatenated batch.
     """
     def __init__(
         self,
         sigma_min: float,
+        batched_cfg: bool = False,
     ):
         self.sigma_min = sigma_min
+        self.batched_cfg = batched_cfg
 
     def _eps_to_xstart(self, x_t, t, eps):
         assert x_t.shape == eps.shape
@@ -68,6 +79,17 @@ class FlowEulerSampler(Sampler):
         gt_v = self._xstart_to_v(x_0, gt_x_t, t)
         return gt_x_t, gt_v
 
+    def _step_velocity(self, model, x_t, t: float, t_prev: float, cond=None, solver_state: Optional[dict] = None, **kwargs):
+        """
+        The velocity v of the step x_{t_prev} = x_t - (t - t_prev) * v.
+        Euler uses the model velocity at t, higher-order solvers override this.
+        solver_state is a dict kept across the steps of one sampling run, for multistep solvers.
+
+        Returns:
+            pred_x_0, pred_eps, v
+        """
+        return self._get_model_prediction(model, x_t, t, cond, **kwargs)
+
     @torch.no_grad()
     def sample_once(
         self,
@@ -76,6 +98,7 @@ class FlowEulerSampler(Sampler):
         t: float,
         t_prev: float,
         cond: Optional[Any] = None,
+        solver_state: Optional[dict] = None,
         **kwargs
     ):
         """
@@ -87,6 +110,7 @@ class FlowEulerSampler(Sampler):
             t: The current timestep.
             t_prev: The previous timestep.
             cond: conditional information.
+            solver_state: state kept across steps by multistep solvers.
             **kwargs: Additional arguments for model inference.
 
         Returns:
@@ -94,7 +118,7 @@ class FlowEulerSampler(Sampler):
             - 'pred_x_prev': x_{t-1}.
             - 'pred_x_0': a prediction of x_0.
         """
-        pred_x_0, pred_eps, pred_v = self._get_model_prediction(model, x_t, t, cond, **kwargs)
+        pred_x_0, pred_eps, pred_v = self._step_velocity(model, x_t, t, t_prev, cond, solver_state, **kwargs)
         pred_x_prev = x_t - (t - t_prev) * pred_v
         return edict({"pred_x_prev": pred_x_prev, "pred_x_0": pred_x_0, "pred_eps": pred_eps})
     
@@ -200,6 +224,16 @@ class FlowEulerSampler(Sampler):
         ret.samples = sample
         return ret
     
+    def _euler_step_(self, x_t, t: float, t_prev: float, pred_v):
+        """
+        In-place Euler update x_t <- x_t - (t - t_prev) * v.
+        """
+        if isinstance(x_t, sp.SparseTensor):
+            x_t.feats.add_(pred_v.feats, alpha=-(t - t_prev))
+        else:
+            x_t.add_(pred_v, alpha=-(t - t_prev))
+        return x_t
+
     @torch.no_grad()
     def sample(
         self,
@@ -209,6 +243,9 @@ class FlowEulerSampler(Sampler):
         steps: int = 50,
         rescale_t: float = 1.0,
         verbose: bool = True,
+        keep_history: bool = True,
+        callback: Optional[Callable] = None,
+        early_exit_tol: Optional[float] = None,
         **kwargs
     ):
         """
@@ -221,24 +258,51 @@ class FlowEulerSampler(Sampler):
             steps: The number of steps to sample.
             rescale_t: The rescale factor for t.
             verbose: If True, show a progress bar.
+            keep_history: If True, keep the predictions of every step. Otherwise the sample is
+                updated in place and only the final sample is returned.
+            callback: Optional callable, called after every step as
+                callback(step, t, t_prev, pred_x_t, pred_x_0), e.g. for progress or previews.
+                With keep_history off, pred_x_t is updated in place by the next step.
+            early_exit_tol: If set, stop once the relative change of the predicted x_0 between
+                two steps is below this tolerance and return that prediction as the sample.
             **kwargs: Additional arguments for model_inference.
 
         Returns:
             a dict containing the following
             - 'samples': the model samples.
-            - 'pred_x_t': a list of prediction of x_t.
-            - 'pred_x_0': a list of prediction of x_0.
+            - 'pred_x_t': a list of prediction of x_t (empty if keep_history is False).
+            - 'pred_x_0': a list of prediction of x_0 (empty if keep_history is False).
+            - 'steps': the number of steps run.
         """
         sample = noise
+        if not keep_history:
+            # updated in place below, don't modify the caller's noise
+            sample = noise.replace(noise.feats.clone()) if isinstance(noise, sp.SparseTensor) else noise.clone()
         t_seq = np.linspace(1, 0, steps + 1)
         t_seq = rescale_t * t_seq / (1 + (rescale_t - 1) * t_seq)
         t_pairs = list((t_seq[i], t_seq[i + 1]) for i in range(steps))
-        ret = edict({"samples": None, "pred_x_t": [], "pred_x_0": []})
-        for t, t_prev in tqdm(t_pairs, desc="Sampling", disable=not verbose):
-            out = self.sample_once(model, sample, t, t_prev, cond, **kwargs)
-            sample = out.pred_x_prev
-            ret.pred_x_t.append(out.pred_x_prev)
-            ret.pred_x_0.append(out.pred_x_0)
+        ret = edict({"samples": None, "pred_x_t": [], "pred_x_0": [], "steps": 0})
+        solver_state = {}
+        last_x_0 = None
+        for step, (t, t_prev) in enumerate(tqdm(t_pairs, desc="Sampling", disable=not verbose)):
+            if keep_history:
+                out = self.sample_once(model, sample, t, t_prev, cond, solver_state=solver_state, **kwargs)
+                sample = out.pred_x_prev
+                pred_x_0 = out.pred_x_0
+                ret.pred_x_t.append(out.pred_x_prev)
+                ret.pred_x_0.append(out.pred_x_0)
+            else:
+                pred_x_0, _, pred_v = self._step_velocity(model, sample, t, t_prev, cond, solver_state, **kwargs)
+                self._euler_step_(sample, t, t_prev, pred_v)
+                del pred_v
+            ret.steps = step + 1
+            if callback is not None:
+                callback(step, t, t_prev, sample, pred_x_0)
+            if early_exit_tol is not None:
+                if last_x_0 is not None and _relative_change(pred_x_0, last_x_0) < early_exit_tol:
+                    sample = pred_x_0
+                    break
+                last_x_0 = pred_x_0
         ret.samples = sample
         return ret
 
@@ -0,0 +1,118 @@
+from typing import *
+import numpy as np
+from .flow_euler import FlowEulerSampler, FlowEulerCfgSampler, FlowEulerGuidanceIntervalSampler
+
+
+class FlowHeunSampler(FlowEulerSampler):
+    """
+    Generate samples from a flow-matching model using Heun's (trapezoidal) method.
+    Two model evaluations per step, the last step falls back to Euler.
+
+    Args:
+        sigma_min: The minimum scale of noise in flow.
+    """
+    def _step_velocity(self, model, x_t, t: float, t_prev: float, cond=None, solver_state: Optional[dict] = None, **kwargs):
+        pred_x_0, pred_eps, pred_v = self._get_model_prediction(model, x_t, t, cond, **kwargs)
+        if t_prev <= 0:
+            return pred_x_0, pred_eps, pred_v
+        x_euler = x_t - float(t - t_prev) * pred_v
+        _, _, pred_v_next = self._get_model_prediction(model, x_euler, t_prev, cond, **kwargs)
+        return pred_x_0, pred_eps, 0.5 * (pred_v + pred_v_next)
+
+
+class FlowMidpointSampler(FlowEulerSampler):
+    """
+    Generate samples from a flow-matching model using the explicit midpoint method.
+    Two model evaluations per step.
+
+    Args:
+        sigma_min: The minimum scale of noise in flow.
+    """
+    def _step_velocity(self, model, x_t, t: float, t_prev: float, cond=None, solver_state: Optional[dict] = None, **kwargs):
+        pred_x_0, pred_eps, pred_v = self._get_model_prediction(model, x_t, t, cond, **kwargs)
+        t_mid = 0.5 * (t + t_prev)
+        x_mid = x_t - float(t - t_mid) * pred_v
+        _, _, pred_v_mid = self._get_model_prediction(model, x_mid, t_mid, cond, **kwargs)
+        return pred_x_0, pred_eps, pred_v_mid
+
+
+class FlowDPMSolverSampler(FlowEulerSampler):
+    """
+    Generate samples from a flow-matching model using DPM-Solver++(2M).
+    The flow path x_t = alpha_t * x_0 + sigma_t * eps with alpha_t = 1 - t and
+    sigma_t = sigma_min + (1 - sigma_min) * t is integrated in the data prediction with a
+    second-order multistep update, so each step costs one model evaluation.
+    The first and last steps are first order.
+
+    Args:
+        sigma_min: The minimum scale of noise in flow.
+    """
+    def _alpha_sigma(self, t):
+        return 1 - t, self.sigma_min + (1 - self.sigma_min) * t
+
+    def _lambda(self, t):
+        alpha, sigma = self._alpha_sigma(t)
+        with np.errstate(divide='ignore'):
+            return np.log(alpha) - np.log(sigma)
+
+    def _step_velocity(self, model, x_t, t: float, t_prev: float, cond=None, solver_state: Optional[dict] = None, **kwargs):
+        pred_x_0, pred_eps, _ = self._get_model_prediction(model, x_t, t, cond, **kwargs)
+        if solver_state is None:
+            solver_state = {}
+        alpha_prev, sigma_prev = self._alpha_sigma(t_prev)
+        alpha_t, sigma_t = self._alpha_sigma(t)
+        h = self._lambda(t_prev) - self._lambda(t)
+        h_last = solver_state.get('h')
+        x_0_last = solver_state.get('x_0')
+        solver_state['h'], solver_state['x_0'] = h, pred_x_0
+
+        if sigma_prev <= 0:
+            # last step of a sigma_min = 0 flow lands on the data prediction
+            x_prev = pred_x_0
+        else:
+            d = pred_x_0
+            if x_0_last is not None and np.isfinite(h) and np.isfinite(h_last) and t_prev > 0:
+                r = h_last / h
+                d = float(1 + 0.5 / r) * pred_x_0 - float(0.5 / r) * x_0_last
+            # exp(-h) = (alpha_t / sigma_t) / (alpha_prev / sigma_prev), written without the logs
+            exp_neg_h = alpha_t * sigma_prev / (sigma_t * alpha_prev)
+            x_prev = float(sigma_prev / sigma_t) * x_t + float(alpha_prev * (1 - exp_neg_h)) * d
+        # as a velocity, so the update stays x_prev = x_t - (t - t_prev) * v
+        v = (x_t - x_prev) / float(t - t_prev)
+        return pred_x_0, pred_eps, v
+
+
+class FlowHeunCfgSampler(FlowEulerCfgSampler, FlowHeunSampler):
+    """
+    Generate samples from a flow-matching model using Heun's method with classifier-free guidance.
+    """
+
+
+class FlowHeunGuidanceIntervalSampler(FlowEulerGuidanceIntervalSampler, FlowHeunSampler):
+    """
+    Generate samples from a flow-matching model using Heun's method with classifier-free guidance and interval.
+    """
+
+
+class FlowMidpointCfgSampler(FlowEulerCfgSampler, FlowMidpointSampler):
+    """
+    Generate samples from a flow-matching model using the midpoint method with classifier-free guidance.
+    """
+
+
+class FlowMidpointGuidanceIntervalSampler(FlowEulerGuidanceIntervalSampler, FlowMidpointSampler):
+    """
+    Generate samples from a flow-matching model using the midpoint method with classifier-free guidance and interval.
+    """
+
+
+class FlowDPMSolverCfgSampler(FlowEulerCfgSampler, FlowDPMSolverSampler):
+    """
+    Generate samples from a flow-matching model using DPM-Solver++(2M) with classifier-free guidance.
+    """
+
+
+class FlowDPMSolverGuidanceIntervalSampler(FlowEulerGuidanceIntervalSampler, FlowDPMSolverSampler):
+    """
+    Generate samples from a flow-matching model using DPM-Solver++(2M) with classifier-free guidance and interval.
+    """
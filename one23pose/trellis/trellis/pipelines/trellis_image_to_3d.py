@@ -429,7 +429,7 @@ class TrellisImageTo3DPipeline(Pipeline):
         flow_model = self.models['sparse_structure_flow_model']
         reso = flow_model.resolution
         noise = torch.randn(num_samples, flow_model.in_channels, reso, reso, reso).to(self.device)
-        sampler_params = {**self.sparse_structure_sampler_params, **sampler_params}
+        sampler_params = {'keep_history': False, **self.sparse_structure_sampler_params, **sampler_params}
         z_s = self.sparse_structure_sampler.sample(
             flow_model,
             noise,
@@ -499,7 +499,7 @@ class TrellisImageTo3DPipeline(Pipeline):
             feats=torch.randn(coords.shape[0], flow_model.in_channels).to(self.device),
             coords=coords,
         )
-        sampler_params = {**self.slat_sampler_params, **sampler_params}
+        sampler_params = {'keep_history': False, **self.slat_sampler_params, **sampler_params}
         slat = self.slat_sampler.sample(
             flow_model,
             noise,
@@ -575,7 +575,7 @@ class TrellisImageTo3DPipeline(Pipeline):
             )
 
         # Sample structured latent
-        slat_sampler_params = {**self.slat_sampler_params, **slat_sampler_params}
+        slat_sampler_params = {'keep_history': False, **self.slat_sampler_params, **slat_sampler_params}
         slat = self.slat_sampler.sample(
             flow_model,
             noise,
@@ -858,7 +858,7 @@ class TrellisVGGTLORATo3DPipeline(TrellisImageTo3DPipeline):
             ss_flow_model = self.models['sparse_structure_flow_model']
             ss_cond = self.get_ss_cond(image_cond[:, :, 5:], aggregated_tokens_list, num_samples)
             # Sample structured latent
-            ss_sampler_params = {**self.sparse_structure_sampler_params, **sparse_structure_sampler_params}
+            ss_sampler_params = {'keep_history': False, **self.sparse_structure_sampler_params, **sparse_structure_sampler_params}
             reso = ss_flow_model.resolution
             ss_noise = torch.randn(num_samples, ss_flow_model.in_channels, reso, reso, reso).to(self.device)
             ss_slat = self.sparse_structure_sampler.sample(
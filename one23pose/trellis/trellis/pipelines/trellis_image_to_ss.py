@@ -150,7 +150,7 @@ class TrellisImageToSSPipeline(TrellisImageTo3DPipeline):
         noise = torch.randn(num_samples, flow_model.in_channels, reso, reso, reso).to(self.device)
         
         # Merge default and custom sampler parameters
-        sampler_params = {**self.sparse_structure_sampler_params, **sparse_structure_sampler_params}
+        sampler_params = {'keep_history': False, **self.sparse_structure_sampler_params, **sparse_structure_sampler_params}
         
         # Generate occupancy latent
         z_s = self.sparse_structure_sampler.sample(
@@ -147,38 +147,32 @@ class MeshExtractResult:
     def subdivide(self):
         """
         Subdivide the mesh by splitting each triangle into four smaller triangles.
+        Every edge gets one midpoint vertex, appended after the existing vertices in sorted edge order.
         """
-        new_vertices = []
-        new_faces = []
-        vertex_map = {}
+        num_vertices = self.vertices.shape[0]
+        faces = self.faces.long()
+        v0, v1, v2 = faces.unbind(dim=1)
 
-        def get_midpoint(v1, v2):
-            edge = tuple(sorted((v1, v2)))
-            if edge not in vertex_map:
-                midpoint = (self.vertices[v1] + self.vertices[v2]) / 2
-                vertex_map[edge] = len(new_vertices)
-                new_vertices.append(midpoint)
-            return vertex_map[edge]
+        # edges v0v1, v1v2, v2v0 of every face, packed into one sorted key per edge
+        edges = torch.cat([torch.stack([v0, v1], dim=1), torch.stack([v1, v2], dim=1), torch.stack([v2, v0], dim=1)], dim=0)
+        edges = edges.sort(dim=1).values
+        keys = edges[:, 0] * num_vertices + edges[:, 1]
+        unique_keys, inverse = torch.unique(keys, return_inverse=True)
+        new_vertices = (self.vertices[unique_keys // num_vertices] + self.vertices[unique_keys % num_vertices]) / 2
 
-        for face in self.faces:
-            v0, v1, v2 = face
-            a = get_midpoint(v0.item(), v1.item())
-            b = get_midpoint(v1.item(), v2.item())
-            c = get_midpoint(v2.item(), v0.item())
-
-            new_faces.append([v0.item(), a, c])
-            new_faces.append([v1.item(), b, a])
-            new_faces.append([v2.item(), c, b])
-            new_faces.append([a, b, c])
-
-        new_vertices = torch.stack(new_vertices)
-        new_faces = torch.tensor(new_faces, dtype=torch.long)
+        a, b, c = (inverse + num_vertices).view(3, -1)
+        new_faces = torch.stack([
+            torch.stack([v0, a, c], dim=1),
+            torch.stack([v1, b, a], dim=1),
+            torch.stack([v2, c, b], dim=1),
+            torch.stack([a, b, c], dim=1),
+        ], dim=1).reshape(-1, 3)
 
         self.vertices = torch.cat([self.vertices, new_vertices], dim=0)
         self.faces = new_faces
         self.face_normal = self.comput_face_normals(self.vertices, self.faces)
         self.vertex_normal = self.comput_v_normals(self.vertices, self.faces)
-        self.vertex_attrs = torch.zeros((self.vertices.shape[0], 3), dtype=torch.float32)
+        self.vertex_attrs = torch.zeros((self.vertices.shape[0], 3), dtype=torch.float32, device=self.vertices.device)
         
 class SparseFeatures2Mesh:
     def __init__(self, device="cuda", res=64, use_color=True):
@@ -28,6 +28,27 @@ import torch.nn.functional as F
 from torch.autograd import Variable
 import numpy as np
 from math import exp
+import time
+from contextlib import contextmanager
+from scipy.spatial import cKDTree
+
+
+@contextmanager
+def _timed(name: str, timings: Optional[dict], verbose: bool):
+    """
+    Record the wall time of a sub-step in timings[name] and print it if verbose.
+    """
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    begin = time.time()
+    yield
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    elapsed = time.time() - begin
+    if timings is not None:
+        timings[name] = elapsed
+    if verbose:
+        tqdm.write(f'{name}: {elapsed:.2f}s')
 
 @torch.no_grad()
 def _fill_holes(
@@ -506,37 +527,56 @@ def postprocess_mesh(
     return vertices, faces
 
 def to_trimesh(app_rep: Gaussian, mesh: MeshExtractResult, simplify: float = 0.95, debug: bool = False,
-    fill_holes: bool = True, fill_holes_max_size: float = 0.04, texture_size: int = 1024, verbose: bool = True) -> trimesh.Trimesh:
+    fill_holes: Optional[bool] = None, fill_holes_max_size: float = 0.04, texture_size: int = 1024, verbose: bool = True,
+    preset: Literal['texture', 'pose'] = 'texture', timings: Optional[dict] = None) -> trimesh.Trimesh:
+    """
+    Convert a generated asset to a trimesh mesh.
+
+    Args:
+        preset (str): 'texture' bakes an optimised UV texture from 100 rendered views.
+            'pose' returns a vertex-coloured mesh, see to_vertex_colored_trimesh.
+        fill_holes (bool): Whether to fill holes in the mesh. Defaults to on for 'texture' and off for 'pose'.
+        timings (dict): If given, filled with the wall time of every sub-step.
+    """
+    if fill_holes is None:
+        fill_holes = preset != 'pose'
+    if preset == 'pose':
+        return to_vertex_colored_trimesh(app_rep, mesh, simplify=simplify, debug=debug, fill_holes=fill_holes,
+                                         fill_holes_max_size=fill_holes_max_size, verbose=verbose, timings=timings)
     vertices = mesh.vertices.cpu().numpy()
     faces = mesh.faces.cpu().numpy()
 
     # mesh postprocess
-    vertices, faces = postprocess_mesh(
-        vertices, faces,
-        simplify=simplify > 0,
-        simplify_ratio=simplify,
-        fill_holes=fill_holes,
-        fill_holes_max_hole_size=fill_holes_max_size,
-        fill_holes_max_hole_nbe=int(250 * np.sqrt(1-simplify)),
-        fill_holes_resolution=1024,
-        fill_holes_num_views=1000,
-        debug=debug,
-        verbose=verbose,
-    )
+    with _timed('postprocess_mesh', timings, verbose):
+        vertices, faces = postprocess_mesh(
+            vertices, faces,
+            simplify=simplify > 0,
+            simplify_ratio=simplify,
+            fill_holes=fill_holes,
+            fill_holes_max_hole_size=fill_holes_max_size,
+            fill_holes_max_hole_nbe=int(250 * np.sqrt(1-simplify)),
+            fill_holes_resolution=1024,
+            fill_holes_num_views=1000,
+            debug=debug,
+            verbose=verbose,
+        )
 
-    vertices, faces, uvs = parametrize_mesh(vertices, faces)
+    with _timed('parametrize_mesh', timings, verbose):
+        vertices, faces, uvs = parametrize_mesh(vertices, faces)
     # bake texture
-    observations, extrinsics, intrinsics = render_multiview(app_rep, resolution=1024, nviews=100)
+    with _timed('render_multiview', timings, verbose):
+        observations, extrinsics, intrinsics = render_multiview(app_rep, resolution=1024, nviews=100)
     masks = [np.any(observation > 0, axis=-1) for observation in observations]
     extrinsics = [extrinsics[i].cpu().numpy() for i in range(len(extrinsics))]
     intrinsics = [intrinsics[i].cpu().numpy() for i in range(len(intrinsics))]
-    texture = bake_texture(
-        vertices, faces, uvs,
-        observations, masks, extrinsics, intrinsics,
-        texture_size=texture_size, mode='opt',
-        lambda_tv=0.01,
-        verbose=verbose
-    )
+    with _timed('bake_texture', timings, verbose):
+        texture = bake_texture(
+            vertices, faces, uvs,
+            observations, masks, extrinsics, intrinsics,
+            texture_size=texture_size, mode='opt',
+            lambda_tv=0.01,
+            verbose=verbose
+        )
     texture = Image.fromarray(texture)
 
     # rotate mesh (from z-up to y-up)
@@ -550,6 +590,72 @@ def to_trimesh(app_rep: Gaussian, mesh: MeshExtractResult, simplify: float = 0.9
     
     return mesh
 
+def gaussian_vertex_colors(app_rep: Gaussian, vertices: np.array, k: int = 8, min_opacity: float = 0.1) -> np.array:
+    """
+    Colour vertices from their nearest Gaussians, weighted by opacity and inverse distance.
+
+    Args:
+        app_rep (Gaussian): Gaussians in the same frame as the vertices.
+        vertices (np.array): Vertices of the mesh. Shape (V, 3).
+        k (int): Number of nearest Gaussians per vertex.
+        min_opacity (float): Gaussians below this opacity are ignored.
+
+    Returns:
+        np.array: uint8 RGBA colors. Shape (V, 4).
+    """
+    xyz = app_rep.get_xyz.detach().float().cpu().numpy()
+    colors = app_rep.get_color.detach().float().cpu().numpy()
+    opacity = app_rep.get_opacity.detach().float().cpu().numpy().reshape(-1)
+    keep = opacity >= min_opacity
+    if keep.sum() >= k:
+        xyz, colors, opacity = xyz[keep], colors[keep], opacity[keep]
+    k = min(k, len(xyz))
+    dists, idx = cKDTree(xyz).query(vertices, k=k)
+    dists, idx = dists.reshape(len(vertices), k), idx.reshape(len(vertices), k)
+    weights = opacity[idx] / (dists + 1e-6)
+    rgb = (weights[..., None] * colors[idx]).sum(axis=1) / weights.sum(axis=1, keepdims=True)
+    rgba = np.concatenate([rgb.clip(0, 1) * 255, np.full((len(vertices), 1), 255)], axis=1)
+    return rgba.round().astype(np.uint8)
+
+def to_vertex_colored_trimesh(app_rep: Gaussian, mesh: MeshExtractResult, simplify: float = 0.95, debug: bool = False,
+    fill_holes: bool = False, fill_holes_max_size: float = 0.04, fill_holes_num_views: int = 100, k: int = 8,
+    verbose: bool = True, timings: Optional[dict] = None) -> trimesh.Trimesh:
+    """
+    Pose-oriented export: a decimated mesh coloured by nearest-Gaussian colour transfer.
+    There is no UV unwrapping, multiview rendering or texture optimisation, the geometry and
+    approximate colour are all pose estimation needs.
+
+    Args:
+        simplify (float): Ratio of faces to remove by decimation.
+        fill_holes (bool): Whether to remove invisible faces and fill holes, off by default.
+        fill_holes_num_views (int): Number of views used by hole filling when enabled.
+        k (int): Number of nearest Gaussians averaged per vertex.
+        timings (dict): If given, filled with the wall time of every sub-step.
+    """
+    vertices = mesh.vertices.cpu().numpy()
+    faces = mesh.faces.cpu().numpy()
+
+    with _timed('postprocess_mesh', timings, verbose):
+        vertices, faces = postprocess_mesh(
+            vertices, faces,
+            simplify=simplify > 0,
+            simplify_ratio=simplify,
+            fill_holes=fill_holes,
+            fill_holes_max_hole_size=fill_holes_max_size,
+            fill_holes_max_hole_nbe=int(250 * np.sqrt(1-simplify)),
+            fill_holes_resolution=512,
+            fill_holes_num_views=fill_holes_num_views,
+            debug=debug,
+            verbose=verbose,
+        )
+
+    with _timed('vertex_colors', timings, verbose):
+        vertex_colors = gaussian_vertex_colors(app_rep, vertices, k=k)
+
+    # rotate mesh (from z-up to y-up)
+    vertices = vertices @ np.array([[1, 0, 0], [0, 0, -1], [0, 1, 0]])
+    return trimesh.Trimesh(vertices, faces, vertex_colors=vertex_colors, process=False)
+
 SR_cache = None
 
 def parametrize_mesh(vertices: np.array, faces: np.array):